@@ -1,7 +1,38 @@
 import unittest
+import tempfile
+import time
 import io
+import os
+import socket
+from unittest import mock
 
-from voiplib.util.packets import Packet, PacketError
+import numpy as np
+
+from voiplib.decode_cache import DecodeCache
+from voiplib.demux import Channel
+from voiplib.event_loop import EventLoop
+from voiplib.handshake import (
+    HandshakePool, x25519_key, x25519_exchange, seal_client_id,
+    open_client_id,
+)
+from voiplib.key_manager import CipherContext, KeyManager
+from voiplib.key_pool import KeyPool
+from voiplib.mixer import Mixer, minus_one
+from voiplib.opcodes import (
+    AUDIO, SET_GATE, HELLO, RSA_KEY, ROOM_KEY, CAP_X25519, CAP_ROOM_KEYS,
+)
+from voiplib.rooms import Rooms
+from voiplib.speakers import ActiveSpeakers
+from voiplib.state_manager import StateManager
+from voiplib.tickets import TicketIssuer
+from voiplib.timer_wheel import TimerWheel
+from voiplib.trunk import pack_rooms, unpack_rooms
+from voiplib.util import mmsg
+from voiplib.util.framer import PacketFramer
+from voiplib.util.opus import OpusEncoder
+from voiplib.util.packets import (
+    Packet, PacketError, BufferPool, pack_bundle, unpack_bundle,
+)
 
 
 class TestPackets(unittest.TestCase):
@@ -65,6 +96,487 @@ class TestPackets(unittest.TestCase):
         self.assertEqual(packet2.timestamp, 1563528913000)
         self.assertEqual(packet2.sequence, 1234)
 
+    def test_bundle(self):
+        frames = [(b'a' * 16, 1, b'first'), (b'b' * 16, 2, b''), (b'c' * 16, 3, b'third')]
+        bundle = pack_bundle(frames)
+        self.assertEqual(list(unpack_bundle(bundle)), frames)
+
+        with self.assertRaises(PacketError):
+            list(unpack_bundle(bundle[:-1]))
+
+    def test_sealed(self):
+        p_bytes = Packet.make_bytes(57, b'sealed data', 1563528913, 1234, sealed=True)
+
+        # Sealed packets carry no CRC, and the flag is stripped from the opcode
+        packet = Packet.from_bytes(p_bytes)
+        self.assertTrue(packet.sealed)
+        self.assertEqual(packet.opcode, 57)
+        self.assertEqual(packet.payload, b'sealed data')
+
+    def test_views(self):
+        pool = BufferPool(64, 1)
+        buffer = pool.acquire()
+        p_bytes = Packet(57, b'test data', 1563528913, 1234).digest()
+        buffer[:len(p_bytes)] = p_bytes
+
+        # Parsing in place should not copy the payload out of the buffer
+        packet = Packet.from_bytes(memoryview(buffer)[:len(p_bytes)], (pool, buffer))
+        self.assertEqual(packet.payload_view, b'test data')
+
+        # Once released, the packet must no longer depend on the buffer
+        packet.release()
+        buffer[:] = bytes(64)
+        self.assertEqual(packet.payload, b'test data')
+        self.assertIs(pool.acquire(), buffer)
+
+
+class TestCipher(unittest.TestCase):
+    def test_aead(self):
+        client = CipherContext(b'k' * 16, b'i' * 16, aead=True)
+        server = CipherContext(b'k' * 16, b'i' * 16, aead=True, server=True)
+        aad = Packet.associated_data(AUDIO, 1)
+
+        first = client.encrypt(b'audio', aad)
+        second = client.encrypt(b'audio', aad)
+        # Every packet uses a fresh nonce, and can be opened out of order
+        self.assertNotEqual(first, second)
+        self.assertEqual(server.decrypt(second, aad), b'audio')
+        self.assertEqual(server.decrypt(first, aad), b'audio')
+
+        with self.assertRaises(ValueError):
+            server.decrypt(first, Packet.associated_data(AUDIO, 2))
+        with self.assertRaises(ValueError):
+            # Each direction has its own salt
+            client.decrypt(first, aad)
+
+    def test_room_keys(self):
+        server, client = KeyManager(), KeyManager()
+        server.set_room_key(0, 1, b'k' * 16, server=True)
+        client.set_room_key(0, 1, b'k' * 16)
+        sealed = server.get_room_cipher(0).encrypt(b'audio')
+
+        # The previous key is kept for audio in flight during a rotation
+        client.set_room_key(0, 2, b'n' * 16)
+        self.assertEqual(client.get_room_cipher(0).epoch, 2)
+        self.assertEqual(client.get_room_cipher(0, 1).decrypt(sealed), b'audio')
+
+        client.set_room_key(0, 3, b'm' * 16)
+        self.assertIsNone(client.get_room_cipher(0, 1))
+
+
+class TestKeyPool(unittest.TestCase):
+    def test_key_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'key.pem')
+            key = KeyPool(path=path).take()
+
+            # The saved key should be reused, rather than a new one made
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+            self.assertEqual(KeyPool(path=path).take(), key)
+
+
+class TestHandshake(unittest.TestCase):
+    def test_x25519(self):
+        client, client_pub = x25519_key()
+        server, server_pub = x25519_key()
+        salt = client_pub + server_pub
+
+        keys = x25519_exchange(server, client_pub, salt)
+        self.assertEqual(x25519_exchange(client, server_pub, salt), keys)
+        sealed = seal_client_id(keys[2], b'c' * 16)
+        self.assertEqual(open_client_id(keys[2], sealed), b'c' * 16)
+
+        # Anybody without the same keys should be caught
+        other = x25519_exchange(x25519_key()[0], server_pub, salt)
+        with self.assertRaises(ValueError):
+            open_client_id(other[2], sealed)
+
+    def test_admission(self):
+        class Controller:
+            loop = None
+
+            def drop(self, sock, addr=None):
+                sock.shutdown(socket.SHUT_RDWR)
+        pool = HandshakePool(Controller(), max_pending=3, timeout=0.05,
+                             rate=1, burst=2)
+        pairs = [socket.socketpair() for _ in range(4)]
+        self.addCleanup(lambda: [i.close() for p in pairs for i in p])
+
+        # Each address is limited to its burst, and everybody to the cap
+        self.assertTrue(pool.admit(pairs[0][0], ('a', 1)))
+        self.assertTrue(pool.admit(pairs[1][0], ('a', 2)))
+        self.assertFalse(pool.admit(pairs[2][0], ('a', 3)))
+        self.assertTrue(pool.admit(pairs[2][0], ('b', 1)))
+        self.assertFalse(pool.admit(pairs[3][0], ('c', 1)))
+
+        # Clients who stall are disconnected
+        time.sleep(0.1)
+        pool.sweep()
+        self.assertEqual(pairs[0][1].recv(1), b'')
+        self.assertEqual(pool.stats(), {
+            'started': 3, 'completed': 0, 'failed': 0, 'timed_out': 3,
+            'rejected': 2, 'pending': 0,
+        })
+
+
+    def test_malformed(self):
+        class Controller:
+            loop = None
+            CAPS = CAP_X25519
+            done = []
+
+            def send_packet(self, *args, **kwargs):
+                pass
+
+            def drop(self, sock, addr=None):
+                pass
+
+            def _server_auth_done(self, sock, *args, **kwargs):
+                self.done.append(sock)
+        # Client ids would otherwise come from the database
+        patch = mock.patch.object(KeyManager, 'generate_client_id',
+                                  lambda key, addr: b'c' * 16)
+        patch.start()
+        self.addCleanup(patch.stop)
+        pool = HandshakePool(Controller(), workers=1)
+        pool.start()
+        now = int(time.time())
+
+        # A client sending garbage fails, and the worker carries on
+        pool.admit('bad', ('a', 1))
+        pool.feed('bad', Packet(HELLO, b'', now, 0))
+        pool.feed('bad', Packet(RSA_KEY, b'garbage', now, 0))
+        pool.admit('good', ('a', 2))
+        pool.feed('good', Packet(HELLO, bytes((CAP_X25519,))
+                                 + x25519_key()[1], now, 0))
+        for _ in range(100):
+            if pool.stats()['completed']:
+                break
+            time.sleep(0.01)
+        self.assertEqual(Controller.done, ['good'])
+        self.assertEqual(pool.stats()['failed'], 1)
+
+
+class TestTickets(unittest.TestCase):
+    def test_redeem(self):
+        issuer = TicketIssuer()
+        ticket = issuer.issue(b'c' * 16, b's' * 16)
+        forged = ticket[:-1] + bytes((ticket[-1] ^ 1,))
+
+        # Tickets are only good once, and only from the server issuing them
+        self.assertIsNone(issuer.redeem(forged))
+        self.assertEqual(issuer.redeem(ticket), (b'c' * 16, b's' * 16))
+        self.assertIsNone(issuer.redeem(ticket))
+        self.assertIsNone(TicketIssuer().redeem(issuer.issue(b'c' * 16, b's' * 16)))
+
+        expired = TicketIssuer(lifetime=-1)
+        self.assertIsNone(expired.redeem(expired.issue(b'c' * 16, b's' * 16)))
+
+
+class TestTimerWheel(unittest.TestCase):
+    def test_advance(self):
+        wheel = TimerWheel(tick=1, slots=4, levels=3)
+        start = wheel._start
+        wheel.schedule('near', 2)
+        wheel.schedule('far', 37)
+        wheel.schedule('gone', 3)
+        wheel.cancel('gone')
+
+        # Timers far enough ahead to sit in an outer wheel still fire on time
+        self.assertEqual(wheel.advance(start + 1), [])
+        self.assertEqual(wheel.advance(start + 2), ['near'])
+        self.assertEqual(wheel.advance(start + 36), [])
+        self.assertEqual(wheel.advance(start + 37), ['far'])
+        self.assertEqual(len(wheel), 0)
+
+
+class TestEventLoop(unittest.TestCase):
+    def test_errors(self):
+        loop = EventLoop()
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+
+        def fail():
+            raise RuntimeError('fail')
+
+        # Failing callbacks of every kind are logged, and the loop carries on
+        got = []
+        loop.register(a, lambda _: got.append(a.recv(16)))
+        loop.register(b, lambda _: fail())
+        loop.call_later(0, fail)
+        loop.call_later(0, got.append, 'timer')
+        loop.call_soon_threadsafe(fail)
+        loop.call_soon_threadsafe(got.append, 'pending')
+        b.send(b'x')
+        a.send(b'y')
+        loop.run_once(0.1)
+        self.assertEqual(got, [b'x', 'timer', 'pending'])
+
+
+class TestMixer(unittest.TestCase):
+    def test_minus_one(self):
+        frames = np.array([[1, 30000, -2], [2, 30000, 0]], dtype='<h')
+        pcm, amps = minus_one(frames)
+
+        # Each speaker hears everybody else, clipped to the sample range
+        self.assertEqual(pcm.tolist(), [[2, 30000, 0], [1, 30000, -2],
+                                        [3, 32767, -2]])
+        self.assertAlmostEqual(amps[2], np.sqrt((9 + 32767 ** 2 + 4) / 3))
+
+    def test_shared(self):
+        class Cache:
+            def decode(self, client_id, sequence, payload):
+                return np.full(Mixer.SAMPLES, payload[0], dtype='<h')
+        mixer = Mixer(Cache())
+        for n, i in enumerate((b'a', b'b', b'c')):
+            mixer.feed(i, 0, b'\0\0' + bytes((n + 1,)))
+        members = {1: frozenset((b'a', b'b', b'c', b'x', b'y', b'z'))}
+        mixes = {i: payload for _, i, payload in mixer.mix(members)}
+
+        # Only the speakers need their own encoders
+        self.assertEqual(len(mixer._encoders), 4)
+        self.assertEqual(mixes[b'x'], mixes[b'y'])
+        self.assertEqual(mixes[b'x'], mixes[b'z'])
+        self.assertEqual(len(mixes), 6)
+
+        mixer.retain((), {})
+        self.assertEqual(mixer._encoders, {})
+
+
+class TestFramer(unittest.TestCase):
+    def test_burst(self):
+        pipe = io.BytesIO()
+        for i in range(5):
+            pipe.write(Packet(57, b'x' * i, 1563528913, i).digest())
+        pipe.seek(0)
+
+        # A single read should yield every packet in the burst
+        framer = PacketFramer(pipe)
+        framer.recv()
+        packets = list(framer.packets())
+        self.assertEqual([i.sequence for i in packets], list(range(5)))
+        self.assertEqual(packets[4].payload, b'xxxx')
+
+    def test_partial(self):
+        p_bytes = Packet(57, b'test data', 1563528913, 1234).digest()
+        framer = PacketFramer(None, size=8)
+
+        # Packets split across reads should only be yielded once complete
+        framer.feed(p_bytes[:10])
+        self.assertIsNone(framer.next_packet())
+        framer.feed(p_bytes[10:])
+        self.assertEqual(framer.next_packet().payload, b'test data')
+        self.assertEqual(len(framer), 0)
+
+    def test_closed(self):
+        with self.assertRaises(ConnectionResetError):
+            next(PacketFramer(io.BytesIO()))
+
+    def test_views(self):
+        p_bytes = Packet(57, b'test data', 1563528913, 1234).digest()
+        framer = PacketFramer(None, size=len(p_bytes))
+        framer.feed(p_bytes)
+        held = framer.next_packet()
+
+        # Data viewed by a packet still held should never be overwritten
+        framer.feed(Packet(57, b'more data', 1563528913, 1235).digest())
+        self.assertEqual(bytes(held.payload_view), b'test data')
+        packet = framer.next_packet()
+        packet.release()
+        self.assertEqual(packet.payload, b'more data')
+
+
+@unittest.skipUnless(mmsg.available, 'recvmmsg and sendmmsg are unavailable')
+class TestMmsg(unittest.TestCase):
+    def test_round_trip(self):
+        recv = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        send = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(recv.close)
+        self.addCleanup(send.close)
+        recv.bind(('127.0.0.1', 0))
+        send.bind(('127.0.0.1', 0))
+        addr = recv.getsockname()
+
+        # Every bytes-like object is sent, and arrives whole
+        datagrams = [(addr, b'one'), (addr, bytearray(b'two')),
+                     (addr, memoryview(b'three'))]
+        self.assertEqual(mmsg.DatagramSender(count=2).send(send, datagrams), 3)
+        batch = mmsg.DatagramBatch(count=4, size=16)
+        received = []
+        while len(received) < 3:
+            batch.recv(recv)
+            received += [(bytes(data), src) for data, src in batch]
+        self.assertEqual(received, [(b'one', send.getsockname()),
+                                    (b'two', send.getsockname()),
+                                    (b'three', send.getsockname())])
+
+
+class TestRooms(unittest.TestCase):
+    def test_listeners(self):
+        rooms = Rooms()
+        rooms.join(b'a', 0)
+        rooms.join(b'b', 0)
+        rooms.join(b'b', 1)
+        rooms.join(b'a', 1)
+        self.assertEqual(rooms.listeners(b'a'), {b'b'})
+
+        # Clients sharing another room should still hear each other
+        rooms.leave(b'b', 0)
+        self.assertEqual(rooms.listeners(b'a'), {b'b'})
+        self.assertEqual(rooms.leave_all(b'a'), [0, 1])
+        self.assertEqual(rooms.listeners(b'b'), frozenset())
+        self.assertEqual(rooms.rooms_of(b'b'), {1})
+
+    def test_stage(self):
+        rooms = Rooms()
+        for i in (b'a', b'b', b'c'):
+            rooms.join(i, 0)
+        rooms.set_stage(0, [b'a'])
+        self.assertEqual(rooms.listeners(b'a'), {b'b', b'c'})
+        self.assertEqual(rooms.listeners(b'b'), frozenset())
+
+        # The audience should still hear each other in ordinary rooms
+        rooms.join(b'b', 1)
+        rooms.join(b'c', 1)
+        self.assertEqual(rooms.listeners(b'b'), {b'c'})
+
+        rooms.set_stage(0, None)
+        self.assertEqual(rooms.listeners(b'b'), {b'a', b'c'})
+
+    def test_changes(self):
+        rooms = Rooms()
+        rooms.track_changes()
+        rooms.join(b'a', 0)
+        rooms.set_stage(0, [b'a'])
+        for i in range(100):
+            rooms.join(bytes((i,)) * 16, 0)
+        rooms.leave(b'a', 0)
+        rooms.join(b'a', 2)
+
+        # Replaying the changes elsewhere gives the same rooms
+        copy = Rooms()
+        copy.apply(rooms.take_changes())
+        self.assertEqual(list(copy), list(rooms))
+        self.assertEqual(copy.stages, rooms.stages)
+        self.assertEqual(copy.listeners(b'a'), rooms.listeners(b'a'))
+        self.assertEqual(rooms.take_changes(), [])
+
+    def test_snapshot(self):
+        rooms = Rooms()
+        rooms.join(b'a', 0)
+        rooms.join(b'b', 0)
+        snapshot = rooms.snapshot()
+
+        # Later changes should not reach the snapshot
+        rooms.join(b'c', 0)
+        rooms.leave(b'a', 0)
+        self.assertEqual(snapshot[0], {b'a', b'b'})
+        self.assertEqual(snapshot.listeners(b'a'), {b'b'})
+        self.assertEqual(snapshot.rooms_of(b'a'), {0})
+
+
+class TestStateManager(unittest.TestCase):
+    def test_rekey(self):
+        class Controller:
+            def __init__(self):
+                self.sent = []
+
+            def send_packet(self, opcode, payload, to=None, client_id=None):
+                self.sent.append(opcode)
+        sock = Controller()
+        km = KeyManager()
+        sm = StateManager(sock, Controller(), km)
+        clients = [bytes((i,)) * 16 for i in range(10)]
+        for i in clients:
+            km.register(i, None, None, b'k' * 16, b'i' * 16, i,
+                        caps=CAP_ROOM_KEYS)
+            sm.set_rooms(i, [0])
+
+        # A crowd joining or leaving should cost a single rotation
+        sm.flush_room_keys()
+        self.assertEqual(sock.sent, [ROOM_KEY] * 10)
+        for i in clients[:5]:
+            sm.set_rooms(i, [])
+        sm.flush_room_keys()
+        self.assertEqual(sock.sent, [ROOM_KEY] * 15)
+        self.assertEqual(km.get_room_cipher(0).epoch, 1)
+
+
+class TestTrunk(unittest.TestCase):
+    def test_rooms(self):
+        members = {b'a' * 16: [0, 2], b'b' * 16: []}
+        payload = pack_rooms(members)
+        self.assertEqual(unpack_rooms(payload), members)
+
+        with self.assertRaises(ValueError):
+            unpack_rooms(payload[:-1])
+
+
+class TestDecodeCache(unittest.TestCase):
+    def test_cache(self):
+        cache = DecodeCache(size=2)
+        frame = OpusEncoder().encode(bytes(OpusEncoder.FRAME_SIZE))
+        first = cache.decode(b'a', 0, frame)
+        self.assertIs(cache.decode(b'a', 0, frame), first)
+        cache.decode(b'a', 1, frame)
+        cache.decode(b'a', 2, frame)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+        # The least recently used frame is evicted, and evicted frames are
+        # not decoded out of order
+        self.assertIsNone(cache.decode(b'a', 0, frame))
+        cache.decode(b'a', 1, frame)
+        cache.decode(b'a', 3, frame)
+        self.assertIsNone(cache.decode(b'a', 2, frame))
+        self.assertIsNotNone(cache.decode(b'a', 1, frame))
+        self.assertEqual((cache.hits, cache.misses), (3, 6))
+
+        # Sequence numbers wrap around
+        cache.decode(b'b', 0xffff, frame)
+        self.assertIsNotNone(cache.decode(b'b', 0, frame))
+
+        # Forgotten speakers start afresh
+        cache.forget(b'a')
+        self.assertIsNotNone(cache.decode(b'a', 0, frame))
+
+
+class TestSpeakers(unittest.TestCase):
+    def test_hysteresis(self):
+        speakers = ActiveSpeakers(1)
+        self.assertTrue(speakers.update(b'a', 1000, 0))
+        self.assertFalse(speakers.update(b'b', 1200, 0))
+
+        # Only a clearly louder speaker should take over
+        for i in range(10):
+            speakers.update(b'a', 1000, 0)
+            speakers.update(b'b', 3000, 0)
+        self.assertEqual(speakers.active, {b'b'})
+
+        # A speaker who falls silent should give up their place
+        self.assertTrue(speakers.update(b'a', 10, 1))
+
+
+class TestDemux(unittest.TestCase):
+    def test_priority(self):
+        channel = Channel(2, 4)
+        channel.put((None, None, Packet(SET_GATE, b'', 0, 0)))
+        for i in range(10):
+            channel.put((None, None, Packet(AUDIO, b'', 0, i)))
+
+        # A burst of audio must not evict control packets
+        self.assertEqual(channel.get()[2].opcode, SET_GATE)
+        self.assertEqual(channel.get()[2].sequence, 6)
+        self.assertEqual(channel.stats()['dropped'], 6)
+
+    def test_stale_audio(self):
+        channel = Channel(2, 4, 0.01)
+        channel.put((None, None, Packet(AUDIO, b'', 0, 0)))
+        time.sleep(0.02)
+
+        self.assertIsNone(channel.get())
+        self.assertEqual(channel.stats()['expired'], 1)
+
 
 if __name__ == '__main__':
     unittest.main()
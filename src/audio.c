@@ -319,7 +319,12 @@ static int Gate_set_threshold(GateObject *self, PyObject *value, void *closure)
     return 0;
 }
 
+static PyObject* Gate_get_gain(GateObject *self, void *closure) {
+    return PyFloat_FromDouble(self->gain);
+}
+
 static PyGetSetDef Gate_getsetters[] = {
+    {"gain", (getter) Gate_get_gain, NULL, "", NULL},
     {"attack", (getter) Gate_get_attack, (setter) Gate_set_attack, "", NULL},
     {"hold", (getter) Gate_get_hold, (setter) Gate_set_hold, "", NULL},
     {"release", (getter) Gate_get_release, (setter) Gate_set_release, "", NULL},
@@ -36,21 +36,23 @@ static int CRC_init(CRCObject *self, PyObject *args, PyObject *kwds) {
 }
 
 static PyObject* CRC_call(CRCObject *self, PyObject *args, PyObject *kwds) {
-    const char* data;
-    Py_ssize_t dlen;
+    Py_buffer buffer;
     int accumulator = 0;
     static char *kwlist[] = {"data", "accumulator", NULL};
 
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "s#|k", kwlist,
-                                     &data, &dlen, &accumulator))
+    // Accept any bytes-like object, so memoryviews can be checked in place
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "y*|k", kwlist,
+                                     &buffer, &accumulator))
         return NULL;
 
-    for (int i = 0; i < dlen; i++) {
+    const char* data = buffer.buf;
+    for (Py_ssize_t i = 0; i < buffer.len; i++) {
         int j = ((accumulator >> (self->_size - 8)) ^ data[i]) & 0xff;
         accumulator = ((accumulator << 8) ^ self->table[j]) & ((1 << self->_size) - 1);
     }
+    PyBuffer_Release(&buffer);
 
-    char* data_out = PyMem_Malloc(2);
+    char data_out[2];
     data_out[0] = (uint8_t)(accumulator >> 8);
     data_out[1] = (uint8_t)(accumulator);
     return PyBytes_FromStringAndSize(data_out, 2);
@@ -4,7 +4,37 @@ if __name__ == '__main__':
     if 'server' in sys.argv:
         from .server import Server
 
-        Server().mainloop()
+        from .config import TCP_PORT, CONTROL_PORT, PEER_TIMEOUT
+
+        workers = 1
+        if '--workers' in sys.argv:
+            workers = int(sys.argv[sys.argv.index('--workers') + 1])
+        port = TCP_PORT
+        if '--port' in sys.argv:
+            port = int(sys.argv[sys.argv.index('--port') + 1])
+        control_port = CONTROL_PORT
+        if '--control-port' in sys.argv:
+            control_port = int(sys.argv[sys.argv.index('--control-port') + 1])
+        peer_timeout = PEER_TIMEOUT
+        if '--peer-timeout' in sys.argv:
+            peer_timeout = float(
+                sys.argv[sys.argv.index('--peer-timeout') + 1])
+
+        # Each --peer host:port links to another server
+        peers = []
+        for n, arg in enumerate(sys.argv):
+            if arg == '--peer':
+                host, _, peer_port = sys.argv[n + 1].rpartition(':')
+                peers.append((host, int(peer_port)))
+
+        Server(
+            event_loop='--event-loop' in sys.argv,
+            workers=workers,
+            port=port,
+            control_port=control_port,
+            peers=peers,
+            peer_timeout=peer_timeout,
+        ).mainloop()
     else:
         from .client import Client
 
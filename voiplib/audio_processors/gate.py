@@ -6,5 +6,12 @@ class Gate(AudioProcessor):
     def __init__(self, attack, hold, release, threshold, exp=0.9):
         self.gate = Gate_(attack, hold, release, threshold, exp)
 
+    @property
+    def closed(self):
+        """
+        Whether the gate is currently silencing the signal entirely.
+        """
+        return self.gate.gain == 0
+
     def process(self, data, *args):
         return self.gate.feed(data)
@@ -4,14 +4,26 @@ from ..util.opus import OpusEncoder, OpusDecoder
 
 
 class OpusEncProcessor(AudioProcessor):
-    def __init__(self):
+    # While the gate is closed, only every this many frames are sent, to
+    # keep the stream, and any NAT mappings along the way, alive
+    KEEPALIVE = 20
+
+    def __init__(self, gate=None):
         self.log = loggers.getLogger(__name__ + '.' + self.__class__.__name__)
 
         self.encoder = OpusEncoder()
         self.buffer = b''
 
+        # Frames the gate silenced throughout are not sent at all. Listeners
+        # treat the missing frames as silence.
+        self.gate = gate
+        self._opened = False
+        self._silent = 0
+
     def process(self, data, *args):
         self.buffer += data
+        if self.gate is not None and not self.gate.closed:
+            self._opened = True
         if len(self.buffer) < self.encoder.FRAME_SIZE:
             return
         frame = self.buffer[:self.encoder.FRAME_SIZE]
@@ -20,6 +32,17 @@ class OpusEncProcessor(AudioProcessor):
             self.log.warning('Audio underrun detected! Flushing buffer!')
             self.buffer = self.buffer[:self.encoder.FRAME_SIZE]
 
+        if self.gate is not None:
+            opened, self._opened = self._opened, not self.gate.closed
+            if opened:
+                self._silent = 0
+            else:
+                # The first silent frame ends the talk spurt, after which
+                # only keepalives are sent
+                self._silent += 1
+                if self._silent % self.KEEPALIVE != 1:
+                    return None
+
         return self.encoder.encode(frame)
 
 
@@ -5,8 +5,9 @@ import numpy as np
 import pyaudio
 
 from .audio_processors import OpusEncProcessor, OpusDecProcessor
-from .util.packets import Packet
+from .util.packets import Packet, unpack_bundle
 from .muxer import Muxer
+from .opcodes import AUDIO
 from . import loggers
 
 
@@ -56,25 +57,46 @@ class AudioIO:
         self.log.info(f'   and "{self.outputs[0][1]}" as output')
 
         # Create our two dummy pipelines
-        self.pipeline = [OpusEncProcessor()]
+        self.encoder = OpusEncProcessor()
+        self.pipeline = [self.encoder]
         self.back_pipeline = [OpusDecProcessor()]
         self._back_pipeline = {}
 
         # Setup a muxer instance for the output pipeline
         self.muxer = Muxer()
 
+        self._running = False
+        self._threads = []
+
     def begin(self) -> None:
         """
         Start the audio interface and begin feeding the pipelines
         """
-        threading.Thread(target=self._audio_player, daemon=True).start()
-        threading.Thread(target=self._in_watcher, daemon=True).start()
+        self._running = True
+        self._threads = [
+            threading.Thread(target=self._audio_player, daemon=True),
+            threading.Thread(target=self._in_watcher, daemon=True),
+        ]
+        for i in self._threads:
+            i.start()
+
+    def close(self) -> None:
+        """
+        Stop the audio interface, and release the audio devices.
+        """
+        self._running = False
+        # Each thread notices within a frame or so
+        for i in self._threads:
+            i.join(1)
+        self.in_stream.close()
+        self.out_stream.close()
+        self.pa.terminate()
 
     def _audio_player(self) -> None:
         """
         Constantly flush data from the muxer and feed it to the output device
         """
-        while True:
+        while self._running:
             frame = self.muxer.read()
             if frame is None:
                 continue
@@ -115,6 +137,22 @@ class AudioIO:
         # Let the muxer know there's new data
         self.muxer.write(data, packet.client_id)
 
+    def feed_bundle(self, packet: Packet, skip: bytes=None) -> None:
+        """
+        Feed every frame of an AUDIO_BUNDLE packet into the pipeline, as
+        though each had arrived in its own AUDIO packet.
+
+        :param Packet packet: The bundle packet
+        :param bytes skip: A client id whose frames should be ignored. Bundles
+                           sent to a whole room include our own audio.
+        """
+        for origin, sequence, data in unpack_bundle(packet.payload):
+            if origin == skip:
+                continue
+            frame = Packet(AUDIO, data, packet.timestamp, sequence, origin)
+            frame.source_addr = packet.source_addr
+            self.feed(data, frame)
+
     def _in_watcher(self) -> None:
         """
         This thread monitors the incomming audio stream and spawns a new thread
@@ -125,11 +163,12 @@ class AudioIO:
         complete before the next chunk of data is waiting in the buffer.
         """
         sequence = 0
-        while True:
+        while self._running:
             data = self.in_stream.read(
                 self.CHUNK, exception_on_overflow=False)
             threading.Thread(target=self._handle_in_data,
                              args=(data, sequence)).start()
+            sequence = (sequence + 1) % 0xff_ff
 
     def _handle_in_data(self, data: bytes, sequence: int) -> None:
         """
@@ -141,6 +180,9 @@ class AudioIO:
         :param bytes data: The raw PCM data
         :param int sequence: The audio sequence number
         """
+        if not self._running:
+            return
+
         # Calculate the RMS of the audio
         samps = np.ndarray((len(data) // 2), '<h', data).astype(np.int32)
         amp = np.sqrt(np.mean(samps ** 2))
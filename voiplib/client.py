@@ -1,17 +1,25 @@
 import struct
 import threading
+import time
 import traceback
+from typing import Optional, Tuple
 
 from .socket_controller import SocketController, SocketMode, KeyManager
 from .audio_processors import Gate, Compressor, NullSink, TransmitAudio
 from .audioio import AudioIO
-from .opcodes import AUDIO, REGISTER_UDP, SET_GATE, SET_COMP
-from .config import TCP_PORT, SERVER
+from .opcodes import (
+    AUDIO, AUDIO_BUNDLE, REGISTER_UDP, SET_GATE, SET_COMP, UDP_BUNDLE,
+    ROOM_KEY, CAP_ROOM_KEYS, TICKET, CAP_RESUME, HEARTBEAT, CAP_HEARTBEAT,
+)
+from .config import TCP_PORT, SERVER, HEARTBEAT_INTERVAL, PEER_TIMEOUT
+from .key_pool import pool as key_pool
+from .util.packets import PacketError
 from . import loggers
 
 
 class Client:
-    def __init__(self, no_input: bool=False, no_output: bool=False):
+    def __init__(self, no_input: bool=False, no_output: bool=False,
+                 ticket: Optional[Tuple[bytes, bytes, bytes]]=None):
         # Create a logging instance
         self.log = loggers.getLogger(__name__ + '.' + self.__class__.__name__)
 
@@ -22,9 +30,15 @@ class Client:
         # Prepare for the state provided by the server
         self.client_id = None
         self.km = KeyManager()
+        # The resumption ticket to present when connecting, replaced by the
+        # one the server issues us
+        self.ticket = ticket
+        # When the server was last heard from over TCP
+        self._last_heard = time.monotonic()
 
         # Setup the socket used for TCP communication
         self.sock = SocketController(km=self.km)
+        self.sock.CAPS |= CAP_ROOM_KEYS | CAP_RESUME | CAP_HEARTBEAT
         self.sock.connect(SERVER, TCP_PORT)
         self.sock.start()
         self.sock.tcp_lost_hook = self.kill
@@ -49,6 +63,8 @@ class Client:
         self.aio.pipeline.insert(0, self.gate)
         self.aio.pipeline.insert(0, self.comp)
         self.aio.pipeline.append(TransmitAudio(self.udp_send))
+        # Stop sending audio while the gate is closed
+        self.aio.encoder.gate = self.gate
 
         # If we aren't actually outputting anything, add a null sink.
         # This module never returns data, terminating the pipeline early.
@@ -65,6 +81,17 @@ class Client:
         self._alive = False
         self.kill_me_now.set()
 
+    def close(self) -> None:
+        """
+        Release the sockets and audio devices of a client which has died, so
+        that nothing more is sent under its keys. Its threads exit.
+        """
+        self.kill()
+        self.aio.close()
+        self.sock.close()
+        self.udp_send.close()
+        self.udp_recv.close()
+
     def tcp_mainloop(self) -> None:
         """
         The main loop to handle TCP communications.
@@ -75,6 +102,10 @@ class Client:
         while self._alive:
             # Wait for a new packet
             pkt = self.sock.get_packet(True)
+            if pkt is None:
+                # The client has been closed
+                continue
+            self._last_heard = time.monotonic()
 
             if pkt[2].opcode == SET_GATE:
                 # Decode the payload
@@ -116,6 +147,41 @@ class Client:
 
                 self.log.debug(f'Set comp to: {attack}, {release}, '
                                f'{threshold}')
+            elif pkt[2].opcode == ROOM_KEY:
+                # Decode the payload
+                try:
+                    room, epoch = struct.unpack('!BH', pkt[2].payload[:3])
+                except struct.error:
+                    continue
+
+                # Install the new media key for the room
+                self.km.set_room_key(room, epoch, pkt[2].payload[3:19])
+                self.log.debug(f'New key for room {room} (epoch {epoch})')
+            elif pkt[2].opcode == TICKET:
+                # Keep the ticket, along with the key of this session, so the
+                # session can be resumed should we reconnect
+                _, __, key, ___ = self.km.registered[self.client_id]
+                self.ticket = (self.client_id, key, bytes(pkt[2].payload))
+
+    def heartbeat_mainloop(self) -> None:
+        """
+        Send the server a heartbeat every few seconds, so it knows we are
+        still here while we are silent. The server answers each one, so if
+        nothing is heard from it for too long, the connection is presumed
+        dead even though it was never closed, and the client is killed to
+        reconnect.
+        """
+        while self._alive:
+            if time.monotonic() - self._last_heard > PEER_TIMEOUT:
+                self.log.warning('No heartbeat from server')
+                self.kill()
+                return
+            try:
+                self.sock.send_packet(HEARTBEAT, b'')
+            except OSError:
+                self.kill()
+                return
+            self.kill_me_now.wait(HEARTBEAT_INTERVAL)
 
     def udp_mainloop(self) -> None:
         """
@@ -129,10 +195,18 @@ class Client:
         while self._alive:
             # Wait for a new packet
             pkt = self.udp_recv.get_packet(True)
+            if pkt is None:
+                continue
 
             if pkt[2].opcode == AUDIO:
                 # Feed the pipeline
                 self.aio.feed(pkt[2].payload, pkt[2])
+            elif pkt[2].opcode == AUDIO_BUNDLE:
+                # Frames from several clients, coalesced by the server
+                try:
+                    self.aio.feed_bundle(pkt[2], skip=self.client_id)
+                except PacketError:
+                    self.log.warning('Invalid audio bundle')
 
     def mainloop(self) -> None:
         """
@@ -141,21 +215,28 @@ class Client:
         classical loop. Instead, it spawns child threads, then waits for the
         death flag to be set.
         """
-        # Perform TCP authentication before continuing
-        self.client_id = self.sock.do_tcp_client_auth()
+        # Perform TCP authentication before continuing, resuming our last
+        # session if we can
+        self.client_id = self.sock.do_tcp_client_auth(self.ticket)
+        self.ticket = None
         # Inform the UDP controllers of the changes
         self.udp_send.client_id = self.client_id
         self.udp_recv.client_id = self.client_id
 
         self.log.info(f'Received client ID: {self.client_id}')
 
-        # Inform the server as to the UDP port aquired by the client
-        pld = struct.pack('!H', self.udp_port)
+        # Inform the server as to the UDP port aquired by the client, and
+        # that we are able to unpack bundled audio
+        pld = struct.pack('!HB', self.udp_port, UDP_BUNDLE)
         self.sock.send_packet(REGISTER_UDP, pld)
 
         # Spawn the two child threads
         threading.Thread(target=self.tcp_mainloop, daemon=True).start()
         threading.Thread(target=self.udp_mainloop, daemon=True).start()
+        if self.km.get_caps(self.client_id) & CAP_HEARTBEAT:
+            self._last_heard = time.monotonic()
+            threading.Thread(target=self.heartbeat_mainloop,
+                             daemon=True).start()
 
         # Wait for a death flag to be set.
         # The only case in which this flag should be set is in the case of an
@@ -172,17 +253,33 @@ def main(*args, **kwargs) -> None:
     """
     loggers.createFileLogger(__name__)
     log = loggers.getLogger(__name__)
+    # Have a key ready by the time the first connection needs one, and the
+    # next ready for any reconnect
+    key_pool.start()
 
+    ticket = None
     while True:
+        client = None
         try:
             # Create a new client instance, and start it
-            Client(*args, **kwargs).mainloop()
+            client = Client(*args, ticket=ticket, **kwargs)
+            client.mainloop()
         except ConnectionRefusedError:
             # Expected error. Show a critical warning.
             log.critical('Connecting to server failed!')
         except:
             # Unexpected error, print the traceback to the console.
             traceback.print_exc()
+        if client is not None:
+            # Carry the last ticket issued over to the next client, so it can
+            # resume the session rather than start a new one
+            ticket = client.ticket
+            # Stop the old client before the next one takes over the audio
+            # devices
+            try:
+                client.close()
+            except Exception:
+                traceback.print_exc()
         log.info('Attempting to reconnect')
 
 
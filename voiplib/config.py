@@ -4,3 +4,13 @@ TCP_PORT = 25734
 CONTROL_PORT = 25735
 
 SERVER = 'nlaptop.local'
+
+# A file to keep the client's handshake key in, so that it is generated only
+# once rather than for every connection. When `None`, each connection uses a
+# fresh key from the background key pool.
+KEY_FILE = None
+
+# Seconds between the heartbeats of clients which send them, and how long
+# either end may go without hearing from the other before giving up on it
+HEARTBEAT_INTERVAL = 5
+PEER_TIMEOUT = 15
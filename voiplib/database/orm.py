@@ -324,11 +324,12 @@ class DB:
         self.tables = []
 
         self.connection = None
-        threading.Thread(target=self._monitor, args=(path, ), daemon=True).start()
 
         self._queue = []
         self._queue_ready = threading.Event()
         self._queue_lock = threading.Lock()
+
+        threading.Thread(target=self._monitor, args=(path, ), daemon=True).start()
     
     def _enqueue(self, f):
         with self._queue_lock:
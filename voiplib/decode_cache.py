@@ -0,0 +1,126 @@
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+from .util.opus import OpusDecoder
+
+
+class DecodeCache:
+    """
+    Decoded audio frames, shared by everything on the server which needs
+    PCM, so that each frame is decoded at most once however many consumers
+    it has.
+
+    Frames are keyed by speaker and sequence number, and held as read-only
+    int16 arrays. Once `size` frames are held, the least recently used are
+    evicted. Each speaker has their own Opus decoder, as decoding carries
+    state from one frame to the next. For the same reason, a frame older
+    than the last one decoded is never decoded, as that would upset the
+    decoder for the frames which follow. It is only served while cached.
+
+    Decoding happens outside the cache's lock, so that frames of different
+    speakers can be decoded at once.
+    """
+    # One second of audio from fifty speakers, or about 2MiB of PCM
+    SIZE = 2500
+    # Sequence numbers are 16 bits, and wrap around
+    SEQUENCE_MOD = 1 << 16
+
+    def __init__(self, size: int=SIZE) -> None:
+        """
+        :param int size: The most frames to hold at once
+        """
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+        self._frames = OrderedDict()
+        # The decoder, lock and last sequence number decoded of each speaker
+        self._speakers = {}
+        # Decoders no longer in use, ready to be given to the next speaker
+        self._spare = []
+        self._lock = threading.Lock()
+
+    def decode(self, client_id: bytes, sequence: int,
+               data: bytes) -> Optional[np.ndarray]:
+        """
+        Decode a frame of Opus audio, unless it already has been.
+
+        :param bytes client_id: The speaker
+        :param int sequence: The sequence number of the frame
+        :param bytes data: The Opus frame, without the amplitude
+        :returns: The frame's samples. These are shared, so must not be
+                  modified. `None` if the frame is no longer cached, and is
+                  older than the last frame decoded for the speaker.
+        :raises OpusError: If the frame could not be decoded
+        """
+        data = bytes(data)
+        key = (client_id, sequence)
+        with self._lock:
+            pcm = self._cached(key, data)
+            if pcm is not None:
+                self.hits += 1
+                return pcm
+            speaker = self._speakers.get(client_id)
+            if speaker is None:
+                decoder = self._spare.pop() if self._spare else OpusDecoder()
+                speaker = self._speakers[client_id] = [decoder,
+                                                       threading.Lock(), None]
+
+        with speaker[1]:
+            with self._lock:
+                # Somebody else may have decoded it while we waited
+                pcm = self._cached(key, data)
+                if pcm is not None:
+                    self.hits += 1
+                    return pcm
+                self.misses += 1
+            decoder, _, last = speaker
+            if decoder is None:
+                # The speaker was forgotten while we waited
+                return None
+            # Drop frames older than the last one decoded, allowing for the
+            # sequence number wrapping around
+            mod = self.SEQUENCE_MOD
+            if last is not None and (sequence - last) % mod > mod // 2:
+                return None
+
+            pcm = np.frombuffer(decoder.decode(data), '<h')
+            speaker[2] = sequence
+
+            with self._lock:
+                self._frames[key] = (data, pcm)
+                self._frames.move_to_end(key)
+                while len(self._frames) > self.size:
+                    self._frames.popitem(last=False)
+            return pcm
+
+    def _cached(self, key: tuple, data: bytes) -> Optional[np.ndarray]:
+        # The data is compared too, as older clients do not number their
+        # frames, and numbers wrap around
+        cached = self._frames.get(key)
+        if cached is not None and cached[0] == data:
+            self._frames.move_to_end(key)
+            return cached[1]
+        return None
+
+    def forget(self, client_id: bytes) -> None:
+        """
+        Release the decoder of a speaker who has left. Their frames are left
+        to be evicted.
+
+        :param bytes client_id: The speaker
+        """
+        with self._lock:
+            speaker = self._speakers.pop(client_id, None)
+        if speaker is None:
+            return
+
+        # Wait for any frame still being decoded
+        with speaker[1]:
+            decoder, speaker[0] = speaker[0], None
+        decoder.reset()
+        with self._lock:
+            self._spare.append(decoder)
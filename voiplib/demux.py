@@ -0,0 +1,249 @@
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from . import loggers
+from .opcodes import AUDIO, AUDIO_BUNDLE
+
+
+class RingBuffer:
+    """
+    A fixed-size FIFO backed by a preallocated list of slots. Pushing onto a
+    full buffer overwrites, and returns, the oldest item.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._slots = [None] * size
+        self._head = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def push(self, item) -> Optional[object]:
+        """
+        Push an item onto the tail of the buffer.
+
+        :returns: The item evicted to make room, if any
+        """
+        tail = (self._head + self._count) % self.size
+        evicted = self._slots[tail] if self._count == self.size else None
+        self._slots[tail] = item
+        if self._count == self.size:
+            self._head = (self._head + 1) % self.size
+        else:
+            self._count += 1
+        return evicted
+
+    def peek(self) -> Optional[object]:
+        """
+        Return the item at the head of the buffer without removing it.
+        """
+        return self._slots[self._head] if self._count else None
+
+    def pop(self) -> Optional[object]:
+        """
+        Remove and return the item at the head of the buffer.
+        """
+        if not self._count:
+            return None
+        item = self._slots[self._head]
+        self._slots[self._head] = None
+        self._head = (self._head + 1) % self.size
+        self._count -= 1
+        return item
+
+    def remove_at(self, n: int) -> object:
+        """
+        Remove and return the n-th item from the head. This is O(n), and is
+        only intended for the legacy predicate matching.
+        """
+        items = [self.pop() for _ in range(self._count)]
+        item = items.pop(n)
+        for i in items:
+            self.push(i)
+        return item
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self._slots[(self._head + i) % self.size]
+
+
+class Channel:
+    """
+    A bounded queue of received packets, waiting to be collected.
+
+    Control and audio packets are held in seperate ring buffers. Control
+    packets are always collected first, and are only dropped once their own
+    buffer is full, so a burst of audio can never evict them. Audio packets
+    are instead dropped once they are older than `max_age`, as stale audio
+    is worse than no audio at all.
+    """
+
+    # Opcodes which are held in the audio class
+    AUDIO_OPCODES = {AUDIO, AUDIO_BUNDLE}
+    # Log every this many dropped packets, rather than every drop
+    LOG_EVERY = 100
+
+    def __init__(self, control_size: int, audio_size: int,
+                 max_age: Optional[float]=None) -> None:
+        """
+        :param int control_size: The number of control packets to hold
+        :param int audio_size: The number of audio packets to hold
+        :param float max_age: The age in seconds past which audio packets are
+                              discarded. `None` disables the age limit.
+        """
+        self.log = loggers.getLogger(__name__ + '.' + self.__class__.__name__)
+
+        self.max_age = max_age
+        self.closed = False
+
+        self._control = RingBuffer(control_size)
+        self._audio = RingBuffer(audio_size)
+        self._cond = threading.Condition(threading.Lock())
+
+        # Counters, for monitoring
+        self.received = 0
+        self.dropped = 0
+        self.expired = 0
+        self.high_water = 0
+
+    def __len__(self) -> int:
+        return len(self._control) + len(self._audio)
+
+    def put(self, item: Tuple) -> int:
+        """
+        Push a packet onto the channel and wake one waiter.
+
+        :param tuple item: The (sock, addr, packet) triple to push
+        :returns: The number of packets discarded to make room
+        """
+        if item[2].opcode in self.AUDIO_OPCODES:
+            ring = self._audio
+        else:
+            ring = self._control
+
+        with self._cond:
+            self.received += 1
+            dropped = ring.push((time.monotonic(), item)) is not None
+            self.dropped += dropped
+            total = self.dropped
+            self.high_water = max(self.high_water, len(self))
+            self._cond.notify()
+        if dropped:
+            self._log_drops(total, 1)
+        return int(dropped)
+
+    def put_many(self, items: List[Tuple]) -> int:
+        """
+        Push a batch of packets onto the channel, taking the lock once.
+
+        :param list items: The (sock, addr, packet) triples to push
+        :returns: The number of packets discarded to make room
+        """
+        now = time.monotonic()
+        dropped = 0
+        with self._cond:
+            for item in items:
+                if item[2].opcode in self.AUDIO_OPCODES:
+                    ring = self._audio
+                else:
+                    ring = self._control
+                dropped += ring.push((now, item)) is not None
+            self.received += len(items)
+            self.dropped += dropped
+            total = self.dropped
+            self.high_water = max(self.high_water, len(self))
+            self._cond.notify(len(items))
+        if dropped:
+            self._log_drops(total, dropped)
+        return dropped
+
+    def _log_drops(self, total: int, dropped: int) -> None:
+        """
+        Log that packets were dropped, once every `LOG_EVERY` drops rather
+        than for each one.
+
+        :param int total: The number of packets dropped so far
+        :param int dropped: How many of those were just dropped
+        """
+        if (total - dropped - 1) // self.LOG_EVERY != (total - 1) // self.LOG_EVERY:
+            self.log.error('Queue to large!')
+
+    def _expire(self) -> None:
+        """
+        Discard any audio at the head of the queue older than `max_age`.
+        The condition must be held.
+        """
+        if self.max_age is None:
+            return
+        cutoff = time.monotonic() - self.max_age
+        while self._audio and self._audio.peek()[0] < cutoff:
+            self._audio.pop()
+            self.expired += 1
+
+    def _pop(self, check: Optional[Callable]) -> Optional[Tuple]:
+        """
+        Remove the first matching packet, control packets first.
+        The condition must be held.
+        """
+        self._expire()
+        for ring in (self._control, self._audio):
+            if check is None:
+                if ring:
+                    return ring.pop()[1]
+                continue
+            for n, (_, i) in enumerate(ring):
+                if check(i):
+                    return ring.remove_at(n)[1]
+        return None
+
+    def get(self, blocking: bool=False, check: Optional[Callable]=None,
+            timeout: Optional[float]=None) -> Optional[Tuple]:
+        """
+        Pop up to one packet from the channel.
+
+        :param bool blocking: Whether to wait for a packet to arrive
+        :param func check: A legacy predicate used to select a specific
+                           packet. This requires scanning every packet held,
+                           so is O(n) rather than O(1).
+        :param float timeout: The longest time to block for
+        :returns: The packet, or `None` if no packet was available in time or
+                  the channel was closed
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                item = self._pop(check)
+                if item is not None:
+                    return item
+
+                if not blocking or self.closed:
+                    return None
+                if deadline is None:
+                    self._cond.wait()
+                elif not self._cond.wait(deadline - time.monotonic()):
+                    return None
+
+    def close(self) -> None:
+        """
+        Close the channel, waking every thread blocked on it.
+        """
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        """
+        Return the occupancy and drop counters for this channel.
+        """
+        return {
+            'control': len(self._control),
+            'audio': len(self._audio),
+            'received': self.received,
+            'dropped': self.dropped,
+            'expired': self.expired,
+            'high_water': self.high_water,
+        }
+
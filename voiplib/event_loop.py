@@ -0,0 +1,177 @@
+import heapq
+import itertools
+import selectors
+import threading
+import time
+from socket import socket, socketpair
+from typing import Callable, Optional
+
+from . import loggers
+
+
+EVENT_READ = selectors.EVENT_READ
+EVENT_WRITE = selectors.EVENT_WRITE
+
+
+class EventLoop:
+    """
+    A minimal single-threaded reactor built on :mod:`selectors`.
+
+    Any number of socket controllers can share one loop, in which case every
+    socket they own is serviced from the thread that calls :func:`run`. None
+    of the methods on this class, other than :func:`call_soon_threadsafe` and
+    :func:`stop`, are safe to call from another thread.
+    """
+
+    def __init__(self) -> None:
+        self.log = loggers.getLogger(__name__ + '.' + self.__class__.__name__)
+
+        self._selector = selectors.DefaultSelector()
+        self._running = False
+
+        # Timers are kept as a heap of (deadline, tie breaker, callback, args)
+        self._timers = []
+        self._counter = itertools.count()
+
+        # Callbacks queued from other threads, and the socket pair used to
+        # wake the selector when one is added.
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._wake_r, self._wake_w = socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.register(self._wake_r, self._drain_wakeup)
+
+    def register(self, sock: socket, callback: Callable[[int], None],
+                 events: int=EVENT_READ) -> None:
+        """
+        Start watching a socket. The callback is called with the mask of
+        events that are ready each time the socket becomes ready.
+
+        :param socket sock: The socket(5) to watch
+        :param func callback: The function to call when the socket is ready
+        :param int events: The event mask to watch for
+        """
+        self._selector.register(sock, events, callback)
+
+    def modify(self, sock: socket, events: int) -> None:
+        """
+        Change the set of events being watched for on a registered socket.
+
+        :param socket sock: The socket(5) to modify
+        :param int events: The new event mask
+        """
+        key = self._selector.get_key(sock)
+        if key.events != events:
+            self._selector.modify(sock, events, key.data)
+
+    def unregister(self, sock: socket) -> None:
+        """
+        Stop watching a socket. Unknown sockets are silently ignored.
+
+        :param socket sock: The socket(5) to forget
+        """
+        try:
+            self._selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def call_later(self, delay: float, callback: Callable, *args) -> list:
+        """
+        Schedule a callback to be run after a delay.
+
+        :param float delay: The delay in seconds
+        :param func callback: The function to call
+        :returns: A handle which can be passed to :func:`cancel`
+        """
+        timer = [time.monotonic() + delay, next(self._counter), callback, args]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def cancel(self, timer: list) -> None:
+        """
+        Cancel a timer previously returned by :func:`call_later`.
+        """
+        # Cancelled timers are left on the heap and skipped when they expire
+        timer[2] = None
+
+    def call_soon_threadsafe(self, callback: Callable, *args) -> None:
+        """
+        Schedule a callback to be run on the loop thread at the next
+        iteration. This is the only way other threads should interact with
+        the loop.
+        """
+        with self._pending_lock:
+            self._pending.append((callback, args))
+        try:
+            self._wake_w.send(b'\0')
+        except BlockingIOError:
+            # The wakeup pipe is full, so the loop is already due to wake
+            pass
+
+    def _drain_wakeup(self, _) -> None:
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _dispatch(self, callback: Callable, *args) -> None:
+        try:
+            callback(*args)
+        except Exception as e:
+            # A single misbehaving connection or timer must never take down
+            # the loop, as everything else is serviced by it too.
+            self.log.error(f'Unhandled error in event callback: {e!r}')
+
+    def _run_pending(self) -> None:
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+        for callback, args in pending:
+            self._dispatch(callback, *args)
+
+    def _next_timeout(self) -> Optional[float]:
+        # Drop any cancelled timers sitting at the top of the heap
+        while self._timers and self._timers[0][2] is None:
+            heapq.heappop(self._timers)
+        if not self._timers:
+            return None
+        return max(0, self._timers[0][0] - time.monotonic())
+
+    def _run_timers(self) -> None:
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, __, callback, args = heapq.heappop(self._timers)
+            if callback is not None:
+                self._dispatch(callback, *args)
+
+    def run_once(self, timeout: Optional[float]=None) -> None:
+        """
+        Run a single iteration of the loop, dispatching every socket that is
+        ready and every timer that has expired.
+
+        :param float timeout: The longest time to wait for an event
+        """
+        next_timer = self._next_timeout()
+        if next_timer is not None:
+            timeout = next_timer if timeout is None else min(timeout, next_timer)
+
+        for key, mask in self._selector.select(timeout):
+            self._dispatch(key.data, mask)
+
+        self._run_timers()
+        self._run_pending()
+
+    def run(self) -> None:
+        """
+        Run the loop until :func:`stop` is called.
+        """
+        self._running = True
+        while self._running:
+            self.run_once()
+
+    def stop(self) -> None:
+        """
+        Request the loop stop after the current iteration.
+        """
+        self.call_soon_threadsafe(setattr, self, '_running', False)
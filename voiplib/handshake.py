@@ -0,0 +1,505 @@
+import queue
+import threading
+import time
+from socket import socket
+from typing import Dict, Optional, Tuple
+
+from Crypto import Random
+from Crypto.Cipher import PKCS1_v1_5, AES
+from Crypto.Hash import SHA256
+from Crypto.Protocol.DH import key_agreement, import_x25519_public_key
+from Crypto.Protocol.KDF import HKDF
+from Crypto.PublicKey import ECC, RSA
+
+from .key_manager import KeyManager
+from .opcodes import *
+from .util.packets import Packet
+from . import loggers
+
+
+Address = Tuple[str, int]
+
+# The size of a raw X25519 public key
+X25519_KEY_SIZE = 32
+# The size of the random value each side contributes when resuming
+RESUME_RANDOM_SIZE = 16
+
+
+def x25519_key() -> Tuple[ECC.EccKey, bytes]:
+    """
+    Generate an ephemeral X25519 key pair.
+
+    :returns: The private key, and the raw public key to send
+    """
+    private = ECC.generate(curve='Curve25519')
+    return private, private.public_key().export_key(format='raw')
+
+
+def x25519_exchange(private: ECC.EccKey, peer: bytes,
+                    salt: bytes) -> Tuple[bytes, bytes, bytes]:
+    """
+    Complete an X25519 key exchange.
+
+    :param EccKey private: Our ephemeral private key
+    :param bytes peer: The raw public key of the other party
+    :param bytes salt: Both public keys, the client's first
+    :returns: The session key and IV, and a key used once to confirm the
+              exchange
+    :raises ValueError: If the public key is invalid
+    """
+    return key_agreement(
+        eph_priv=private, eph_pub=import_x25519_public_key(bytes(peer)),
+        kdf=lambda secret: derive_keys(secret, salt),
+    )
+
+
+def derive_keys(secret: bytes, salt: bytes) -> Tuple[bytes, bytes, bytes]:
+    """
+    Derive the keys of a session from a shared secret.
+
+    :param bytes secret: The secret both parties hold
+    :param bytes salt: Values both parties contributed to this session
+    :returns: The session key and IV, and a key used once to confirm the
+              exchange
+    """
+    material = HKDF(bytes(secret), 48, salt, SHA256)
+    return material[:16], material[16:32], material[32:]
+
+
+def seal_client_id(confirm: bytes, client_id: bytes) -> bytes:
+    """
+    Seal a newly issued client id, proving we hold the same keys.
+    """
+    # The confirmation key is only ever used once, so a fixed nonce is safe
+    cipher = AES.new(confirm, AES.MODE_GCM, nonce=bytes(12))
+    sealed, tag = cipher.encrypt_and_digest(client_id)
+    return sealed + tag
+
+
+def open_client_id(confirm: bytes, sealed: bytes) -> bytes:
+    """
+    The inverse of :func:`seal_client_id`.
+
+    :raises ValueError: If the keys did not match
+    """
+    cipher = AES.new(confirm, AES.MODE_GCM, nonce=bytes(12))
+    return cipher.decrypt_and_verify(sealed[:-16], sealed[-16:])
+
+
+class HandshakeFailed(Exception):
+    """
+    Raised when a connected client initiates a handshake, then proceeds to fail
+    the handshake.
+    """
+    pass
+
+
+class ServerHandshake:
+    """
+    The server side of the client-server handshake.
+
+    The handshake is expressed as a state machine which is stepped one packet
+    at a time, as packets arrive, by a :class:`HandshakePool`.
+
+    Clients offering `CAP_X25519` send an X25519 key with their HELLO, and
+    the handshake completes with our reply. Everybody else goes on to
+    exchange an AES key under RSA, taking three round trips more.
+
+    Clients offering `CAP_RESUME` are issued a ticket once the handshake
+    completes. When they reconnect, the ticket follows the rest of their
+    HELLO, along with a random value. If it can be redeemed, the client gets
+    back their previous id, under keys derived from the ticket, and the key
+    exchange is skipped. Otherwise the handshake carries on as if no ticket
+    had been sent.
+    """
+    # The handshake is finished, and no more packets are expected
+    DONE = -1
+
+    def __init__(self, controller, sock: socket, addr: Address) -> None:
+        """
+        :param SocketController controller: The controller owning the socket
+        :param socket sock: The socket(5) of the connecting client
+        :param tuple addr: The address of the connecting client
+        """
+        self.controller = controller
+        self.sock = sock
+        self.addr = addr
+
+        # The state is the opcode we are waiting on next
+        self.state = HELLO
+        self.client_id = None
+        # The capabilities both ends support
+        self.caps = 0
+
+        self._key = None
+        self._iv = None
+        self._aes = None
+        # When the next packet from the client is due by. This is managed by
+        # the :class:`HandshakePool` stepping the handshake.
+        self.deadline = None
+
+    @property
+    def done(self) -> bool:
+        return self.state == self.DONE
+
+    def abort(self) -> None:
+        """
+        Inform the client the handshake has failed. Dropping them is left to
+        whoever is stepping the handshake.
+        """
+        self.controller.send_packet(ABRT, b'', to=self.sock)
+        raise HandshakeFailed
+
+    def feed(self, packet: Packet) -> bool:
+        """
+        Advance the handshake with the next packet from the client.
+
+        :param Packet packet: The packet received from the client
+        :returns: If the handshake has now completed
+        :raises HandshakeFailed: If the client deviates from the handshake
+        """
+        if packet.opcode != self.state:
+            self.abort()
+
+        if self.state == HELLO:
+            # ACK the initial HELLO. Clients which offer capabilities are told
+            # which of them we share, older clients get an empty ACK.
+            if packet.payload:
+                offered = packet.payload[0]
+                self.caps = offered & self.controller.CAPS
+                client_key, rest = b'', packet.payload[1:]
+                if offered & CAP_X25519:
+                    client_key = rest[:X25519_KEY_SIZE]
+                    rest = rest[X25519_KEY_SIZE:]
+
+                if (self.caps & CAP_RESUME
+                        and len(rest) > RESUME_RANDOM_SIZE
+                        and self._resume(rest[:RESUME_RANDOM_SIZE],
+                                         rest[RESUME_RANDOM_SIZE:])):
+                    return self.done
+                if (self.caps & CAP_X25519
+                        and len(client_key) == X25519_KEY_SIZE):
+                    self._exchange(client_key)
+                    return self.done
+                self.caps &= ~CAP_X25519
+                self.controller.send_packet(ACK, bytes((self.caps,)), to=self.sock)
+            else:
+                self.controller.send_packet(ACK, b'', to=self.sock)
+            self.state = RSA_KEY
+
+        elif self.state == RSA_KEY:
+            try:
+                client_key = RSA.importKey(packet.payload)
+            except (ValueError, IndexError, TypeError):
+                self.abort()
+
+            # Construct a new AES 256 cipher
+            self._key = Random.get_random_bytes(16)
+            self._iv = Random.new().read(AES.block_size)
+            self._aes = AES.new(self._key, AES.MODE_CBC, self._iv)
+            self.client_id = KeyManager.generate_client_id(self._key, self.addr)
+
+            # Encrypt the AES parameters using RSA, then send them
+            try:
+                cipher = PKCS1_v1_5.new(client_key)
+                resp = cipher.encrypt(self._key + self.client_id + self._iv)
+            except (ValueError, TypeError):
+                # The key is too short, or can not encrypt
+                self.abort()
+            self.controller.send_packet(AES_KEY, resp, to=self.sock)
+            self.state = AES_CHECK
+
+        elif self.state == AES_CHECK:
+            # Check the nonce-based AES check
+            aes2 = AES.new(self._key, AES.MODE_CBC, self._iv)
+            try:
+                valid = aes2.decrypt(packet.payload) == self.client_id
+            except ValueError:
+                # Not a whole number of blocks
+                valid = False
+            if not valid:
+                self.abort()
+
+            self.state = self.DONE
+            self.controller._server_auth_done(
+                self.sock, self.addr, self.client_id,
+                self._aes, aes2, self._key, self._iv, self.caps
+            )
+
+        return self.done
+
+    def _exchange(self, client_key: bytes) -> None:
+        """
+        Complete the handshake with the X25519 key a client sent with their
+        HELLO. The ACK carries our own key, and the client's new id sealed
+        with the result, so the client needs nothing more from us.
+        """
+        private, public = x25519_key()
+        try:
+            self._key, self._iv, confirm = x25519_exchange(
+                private, client_key, bytes(client_key) + public)
+        except ValueError:
+            self.abort()
+        self.client_id = KeyManager.generate_client_id(self._key, self.addr)
+
+        self.state = self.DONE
+        self.controller._server_auth_done(
+            self.sock, self.addr, self.client_id,
+            AES.new(self._key, AES.MODE_CBC, self._iv),
+            AES.new(self._key, AES.MODE_CBC, self._iv),
+            self._key, self._iv, self.caps,
+            reply=bytes((self.caps,)) + public
+            + seal_client_id(confirm, self.client_id),
+        )
+
+    def _resume(self, client_random: bytes, ticket: bytes) -> bool:
+        """
+        Complete the handshake with a resumption ticket.
+
+        :returns: If the ticket was redeemed. If not, nothing has been sent.
+        """
+        redeemed = self.controller.tickets.redeem(ticket)
+        if redeemed is None:
+            return False
+        self.client_id, secret = redeemed
+
+        server_random = Random.get_random_bytes(RESUME_RANDOM_SIZE)
+        self._key, self._iv, confirm = derive_keys(
+            secret, bytes(client_random) + server_random)
+
+        # The client may have reconnected before we noticed them leave
+        old = self.controller.km.sock_from_id(self.client_id)
+
+        self.state = self.DONE
+        self.controller._server_auth_done(
+            self.sock, self.addr, self.client_id,
+            AES.new(self._key, AES.MODE_CBC, self._iv),
+            AES.new(self._key, AES.MODE_CBC, self._iv),
+            self._key, self._iv, self.caps,
+            reply=bytes((self.caps,)) + server_random
+            + seal_client_id(confirm, self.client_id),
+        )
+
+        if old is not None:
+            # The session has moved over, so the old connection no longer
+            # belongs to anybody, and is cleaned up as any other would be
+            self.controller.drop(old)
+        return True
+
+
+class HandshakePool:
+    """
+    Every handshake a server has in progress, and the admission control in
+    front of them.
+
+    Each handshake is stepped as its packets arrive. On an event loop the
+    loop steps them itself, as none of the steps block. Otherwise a fixed
+    number of worker threads step them, however many clients are connecting,
+    and reader threads only hand packets over. Either way:
+
+    - At most `max_pending` handshakes are in progress at once. Further
+      connections are dropped as soon as they are accepted.
+    - Each address may start `rate` handshakes a second, in bursts of up to
+      `burst`, so one peer reconnecting in a loop can not crowd out others.
+    - A client which goes `timeout` seconds without sending the next packet
+      of the handshake is dropped.
+    """
+    WORKERS = 4
+    MAX_PENDING = 256
+    # Seconds each step of the handshake is given
+    TIMEOUT = 5
+    # Handshakes started per second, and in a burst, from each address
+    RATE = 5
+    BURST = 20
+    # Seconds between checks for handshakes past their deadline
+    SWEEP_INTERVAL = 1
+
+    def __init__(self, controller, workers: int=WORKERS,
+                 max_pending: int=MAX_PENDING, timeout: float=TIMEOUT,
+                 rate: float=RATE, burst: int=BURST) -> None:
+        """
+        :param SocketController controller: The controller accepting clients
+        :param int workers: The threads stepping handshakes, when not on an
+                            event loop
+        :param int max_pending: The most handshakes in progress at once
+        :param float timeout: Seconds each step of the handshake is given
+        :param float rate: Handshakes each address may start per second
+        :param int burst: Handshakes each address may start at once
+        """
+        self.log = loggers.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.controller = controller
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.rate = rate
+        self.burst = burst
+
+        # How many handshakes have been started, and how each ended
+        self._counts = dict.fromkeys(
+            ('started', 'completed', 'failed', 'timed_out', 'rejected'), 0)
+
+        self._pending = {}
+        # The tokens left to each address, and when they were last counted
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._jobs = None
+        self._last_sweep = time.monotonic()
+
+    def __contains__(self, sock: socket) -> bool:
+        return sock in self._pending
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def start(self) -> None:
+        """
+        Begin checking deadlines, and when not on an event loop, start the
+        worker threads.
+        """
+        loop = self.controller.loop
+        if loop is not None:
+            loop.call_later(self.SWEEP_INTERVAL, self._tick)
+            return
+
+        self._jobs = queue.Queue(self.max_pending)
+        for _ in range(self.workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def admit(self, sock: socket, addr: Address) -> bool:
+        """
+        Begin the handshake of a newly accepted client, unless too many are
+        already in progress, or the client's address has started too many.
+
+        :returns: If the client was admitted. If not, the caller should drop
+                  them.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(addr[0], (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if len(self._pending) >= self.max_pending or tokens < 1:
+                self._buckets[addr[0]] = (tokens, now)
+                self._counts['rejected'] += 1
+                return False
+            self._buckets[addr[0]] = (tokens - 1, now)
+
+            handshake = ServerHandshake(self.controller, sock, addr)
+            handshake.deadline = now + self.timeout
+            self._pending[sock] = handshake
+            self._counts['started'] += 1
+        return True
+
+    def feed(self, sock: socket, packet: Packet) -> None:
+        """
+        Hand a packet received during a handshake to the handshake.
+        """
+        if self._jobs is None:
+            self._step(sock, packet)
+            return
+        try:
+            self._jobs.put_nowait((sock, packet))
+        except queue.Full:
+            # Every handshake has at most one packet outstanding, unless
+            # somebody is flooding us
+            self.log.warning('Handshake queue is full')
+            self._fail(sock)
+
+    def forget(self, sock: socket) -> None:
+        """
+        Discard the handshake of a client who has disconnected, if it is in
+        progress.
+        """
+        self._end(sock, 'failed')
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return the number of handshakes in progress, how many have been
+        started, and how each of those ended. Rejected connections never
+        start a handshake.
+        """
+        with self._lock:
+            return dict(self._counts, pending=len(self._pending))
+
+    def _end(self, sock: socket, outcome: str) -> Optional[ServerHandshake]:
+        """
+        Remove a handshake which has ended, and count how it ended.
+
+        :returns: The handshake, unless it had already ended
+        """
+        with self._lock:
+            handshake = self._pending.pop(sock, None)
+            if handshake is not None:
+                self._counts[outcome] += 1
+        return handshake
+
+    def _worker(self) -> None:
+        while True:
+            try:
+                self._step(*self._jobs.get(timeout=self.SWEEP_INTERVAL))
+            except queue.Empty:
+                pass
+            if time.monotonic() - self._last_sweep >= self.SWEEP_INTERVAL:
+                self.sweep()
+
+    def _tick(self) -> None:
+        self.controller.loop.call_later(self.SWEEP_INTERVAL, self._tick)
+        self.sweep()
+
+    def _step(self, sock: socket, packet: Packet) -> None:
+        handshake = self._pending.get(sock)
+        if handshake is None:
+            return
+        try:
+            done = handshake.feed(packet)
+        except HandshakeFailed:
+            self.log.warning(f'Handshake with {handshake.addr} failed')
+            self._fail(sock)
+            return
+        except Exception as e:
+            # Nothing a client sends may take down the thread stepping
+            # everybody else's handshakes
+            self.log.error(f'Error in handshake with {handshake.addr}: {e!r}')
+            self._fail(sock)
+            return
+
+        if done:
+            self._end(sock, 'completed')
+        else:
+            handshake.deadline = time.monotonic() + self.timeout
+
+    def sweep(self) -> None:
+        """
+        Drop every client whose handshake is past its deadline, and forget
+        addresses which have not started a handshake in a while.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._last_sweep = now
+            expired = [i for i in self._pending.values() if i.deadline <= now]
+            for handshake in expired:
+                del self._pending[handshake.sock]
+            self._counts['timed_out'] += len(expired)
+
+            # Buckets which have refilled are the same as no bucket at all
+            full = self.burst / self.rate
+            for addr in [a for a, (_, last) in self._buckets.items()
+                         if now - last > full]:
+                del self._buckets[addr]
+
+        for handshake in expired:
+            self.log.info(f'Handshake with {handshake.addr} timed out')
+            self._drop(handshake)
+
+    def _fail(self, sock: socket) -> None:
+        """
+        End a handshake which has failed, and drop the client.
+        """
+        handshake = self._end(sock, 'failed')
+        if handshake is not None:
+            self._drop(handshake)
+
+    def _drop(self, handshake: ServerHandshake) -> None:
+        """
+        Disconnect a client whose handshake did not complete.
+        """
+        self.controller.drop(handshake.sock, handshake.addr)
@@ -522,6 +522,26 @@ class RoomsPane(QWidget):
         self.cols[n].addWidget(heading)
 
         view = QListView()
+
+        if n > 0:
+            mode = QComboBox(self.cols[n])
+            mode.addItems(['Everyone speaks', 'Mix on server', 'Stage'])
+            mode.currentIndexChanged.connect(self.set_mode(n - 1))
+            self.cols[n].addWidget(mode)
+
+            # Several speakers may be selected at once
+            view.setSelectionMode(QAbstractItemView.ExtendedSelection)
+            speakers = QPushButton('Selected are speakers', self.cols[n])
+            speakers.clicked.connect(self.set_speakers(n, view))
+            self.cols[n].addWidget(speakers)
+
+            topk = QSpinBox(self.cols[n])
+            topk.setRange(0, 255)
+            topk.setPrefix('Loudest ')
+            topk.setSpecialValueText('Everyone speaks')
+            topk.valueChanged.connect(self.set_topk(n - 1))
+            self.cols[n].addWidget(topk)
+
         self.models[n] = MetadataListModel(n == 0)
         self.models[n].data_changed = self.data_changed
         view.setModel(self.models[n])
@@ -533,6 +553,30 @@ class RoomsPane(QWidget):
 
         self.columns.addWidget(self.cols[n])
 
+    def set_mode(self, room):
+        def _set_mode(index):
+            mode = (ROOM_FORWARD, ROOM_MIX, ROOM_STAGE)[index]
+            SocketManager.sock.send_packet(SET_ROOM_MODE, struct.pack('!BB', room, mode))
+
+        return _set_mode
+
+    def set_speakers(self, n, view):
+        def _set_speakers(_=False):
+            model = self.models[n]
+            speakers = b''.join(
+                model.data(i, model.MetadataRole)['client_id']
+                for i in view.selectionModel().selectedIndexes()
+            )
+            SocketManager.sock.send_packet(SET_SPEAKERS, bytes([n - 1]) + speakers)
+
+        return _set_speakers
+
+    def set_topk(self, room):
+        def _set_topk(k):
+            SocketManager.sock.send_packet(SET_ROOM_TOPK, struct.pack('!BB', room, k))
+
+        return _set_topk
+
     def open_client(self, model):
         def _open_client(index):
             data = model.data(index, model.MetadataRole)
@@ -1,18 +1,135 @@
 import hashlib
+import itertools
 from typing import Tuple, Optional, TypeVar
 from socket import socket
 
 from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Util.Padding import pad, unpad
 
 from .database import Devices
+from .opcodes import CAP_AEAD
 
 
 AESt = TypeVar('AES')
 
 
+class CipherContext:
+    """
+    The encryption state for a single client. One context is created per
+    client when they are registered, and then reused for every packet.
+
+    Two schemes are supported. The legacy scheme pads each payload and
+    encrypts it with AES-CBC from a fixed IV. The AEAD scheme instead seals
+    each payload with AES-GCM, under a nonce built from a per-direction salt
+    and a packet counter. The counter is prepended to the payload, so every
+    packet can be opened on its own, in any order, and without padding.
+    """
+    # The length of the counter carried at the start of sealed payloads
+    COUNTER_LENGTH = 8
+    TAG_LENGTH = 16
+
+    def __init__(self, key: bytes, iv: bytes, aead: bool=False,
+                 server: bool=False, counter: int=0) -> None:
+        """
+        :param bytes key: The shared AES key
+        :param bytes iv: The IV used by the legacy scheme
+        :param bool aead: Whether to use the AEAD scheme
+        :param bool server: Whether we are the server side of the connection,
+                            which selects the salt used in each direction
+        :param int counter: The first packet counter to use
+        """
+        self.key = key
+        self.iv = iv
+        self.aead = aead
+
+        # Each direction uses its own salt, so that both ends counting from
+        # zero never reuse a nonce.
+        ours, theirs = (b'server', b'client') if server else (b'client', b'server')
+        self._send_salt = SHA256.new(key + ours).digest()[:4]
+        self._recv_salt = SHA256.new(key + theirs).digest()[:4]
+        # Shared by every controller using this key manager. Taking the next
+        # value is atomic, so no lock is needed.
+        self._counter = itertools.count(counter)
+
+    def encrypt(self, payload: bytes, aad: bytes=b'') -> bytes:
+        """
+        Encrypt a payload for sending.
+
+        :param bytes payload: The plaintext payload
+        :param bytes aad: Data to authenticate, but not encrypt. Only used
+                          by the AEAD scheme.
+        """
+        if not self.aead:
+            return AES.new(self.key, AES.MODE_CBC, self.iv).encrypt(pad(payload, 16))
+
+        counter = next(self._counter).to_bytes(self.COUNTER_LENGTH, 'big')
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=self._send_salt + counter,
+                         mac_len=self.TAG_LENGTH)
+        cipher.update(aad)
+        data, tag = cipher.encrypt_and_digest(payload)
+        return b''.join((counter, data, tag))
+
+    def decrypt(self, payload: bytes, aad: bytes=b'') -> bytes:
+        """
+        Decrypt a received payload.
+
+        :param bytes payload: The encrypted payload
+        :param bytes aad: The authenticated data the sender used
+        :raises ValueError: If the payload is malformed, or fails
+                            authentication
+        """
+        if not self.aead:
+            return unpad(AES.new(self.key, AES.MODE_CBC, self.iv).decrypt(payload), 16)
+
+        if len(payload) < self.COUNTER_LENGTH + self.TAG_LENGTH:
+            raise ValueError('Sealed payload too short')
+        counter = payload[:self.COUNTER_LENGTH]
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=self._recv_salt + bytes(counter),
+                         mac_len=self.TAG_LENGTH)
+        cipher.update(aad)
+        return cipher.decrypt_and_verify(
+            payload[self.COUNTER_LENGTH:-self.TAG_LENGTH],
+            payload[-self.TAG_LENGTH:]
+        )
+
+
+class RoomCipher(CipherContext):
+    """
+    A media key shared by every member of a room. Audio sealed with it can be
+    sent to the whole room as a single copy.
+    """
+
+    def __init__(self, room: int, epoch: int, key: bytes,
+                 server: bool=False, counter: int=0) -> None:
+        """
+        :param int room: The room the key belongs to
+        :param int epoch: The generation of the key, which increases each
+                          time the room's membership changes
+        :param bytes key: The media key
+        :param bool server: Whether we are the server, and so the sender
+        :param int counter: The first packet counter to use
+        """
+        super().__init__(key, b'', True, server, counter)
+        self.room = room
+        self.epoch = epoch
+
+
 class KeyManager:
-    def __init__(self) -> None:
+    # The top bits of every packet counter are the shard number, so that
+    # processes sharing keys never send under the same nonce
+    SHARD_SHIFT = 48
+
+    def __init__(self, shard: int=0) -> None:
+        """
+        :param int shard: The number of this process, when several processes
+                          send using the same keys
+        """
+        self._counter = shard << self.SHARD_SHIFT
         self.registered = {}
+        self._ciphers = {}
+        self._caps = {}
+        self._rooms = {}
         self._socks = {}
 
     @staticmethod
@@ -56,8 +173,70 @@ class KeyManager:
         # design.
         return a, a
 
+    def get_cipher(self, client_id: bytes) -> Optional[CipherContext]:
+        """
+        Return the cached cipher context for a client, identified by their
+        client id.
+
+        :param bytes client_id: The client id to lookup
+        """
+        return self._ciphers.get(client_id)
+
+    def get_caps(self, client_id: bytes) -> int:
+        """
+        Return the capabilities negotiated with a client.
+
+        :param bytes client_id: The client id to lookup
+        """
+        return self._caps.get(client_id, 0)
+
+    def set_room_key(self, room: int, epoch: int, key: bytes,
+                     server: bool=False) -> None:
+        """
+        Install a new media key for a room. The previous key is kept, so that
+        audio already in flight when the key rotates can still be opened.
+
+        :param int room: The room the key belongs to
+        :param int epoch: The generation of the key
+        :param bytes key: The media key
+        :param bool server: Whether we are the server for this room
+        """
+        previous = self._rooms.get(room)
+        self._rooms[room] = (
+            RoomCipher(room, epoch, key, server, self._counter),
+            previous[0] if previous else None
+        )
+
+    def get_room_cipher(self, room: int,
+                        epoch: Optional[int]=None) -> Optional[RoomCipher]:
+        """
+        Return the media key of a room.
+
+        :param int room: The room to lookup
+        :param int epoch: The generation of key wanted, or `None` for the
+                          current key
+        """
+        keys = self._rooms.get(room)
+        if keys is None:
+            return None
+        if epoch is None:
+            return keys[0]
+        for i in keys:
+            if i is not None and i.epoch == epoch:
+                return i
+        return None
+
+    def forget_room(self, room: int) -> None:
+        """
+        Discard every media key held for a room.
+
+        :param int room: The room to forget
+        """
+        self._rooms.pop(room, None)
+
     def register(self, client_id: bytes, aes1: AES, aes2: AES, key: bytes,
-                 iv: bytes, sock: socket) -> None:
+                 iv: bytes, sock: socket, caps: int=0,
+                 server: bool=False) -> None:
         """
         Register a new client to the key manager.
 
@@ -67,8 +246,14 @@ class KeyManager:
         :param bytes key: The key used to create further AES instances
         :param bytes iv: The initialisation vector for the AES algorithm
         :param socket sock: The socket this client is utilising currently
+        :param int caps: The capabilities negotiated with the client
+        :param bool server: Whether we are the server for this client
         """
         self.registered[client_id] = (aes1, aes2, key, iv)
+        self._ciphers[client_id] = CipherContext(
+            key, iv, bool(caps & CAP_AEAD), server, self._counter
+        )
+        self._caps[client_id] = caps
         self._socks[client_id] = sock
 
     def sock_from_id(self, client_id: bytes) -> Optional[socket]:
@@ -104,3 +289,5 @@ class KeyManager:
             del self._socks[client_id]
         if client_id in self.registered:
             del self.registered[client_id]
+        self._ciphers.pop(client_id, None)
+        self._caps.pop(client_id, None)
@@ -0,0 +1,106 @@
+import os
+import queue
+import threading
+from typing import Optional
+
+from Crypto import Random
+from Crypto.PublicKey import RSA
+
+from .config import KEY_FILE
+from . import loggers
+
+
+class KeyPool:
+    """
+    The RSA key pairs used by clients during the handshake.
+
+    Generating a key pair takes long enough to hold up connecting, so keys
+    are generated ahead of time on a background thread, and each handshake
+    takes one which is already waiting. The pool is only filled once a key
+    is first wanted, or :func:`start` is called, so processes which never
+    make a handshake never generate a key at all.
+
+    When given a key file, the key is instead loaded from that file, or
+    generated once and saved to it, then reused by every handshake.
+    """
+    BITS = 1024
+    # The keys held ready. Each handshake uses its own key, so this is the
+    # number of connections which can be made back to back without waiting.
+    SIZE = 2
+
+    def __init__(self, size: int=SIZE, path: Optional[str]=None) -> None:
+        """
+        :param int size: The number of keys to hold ready
+        :param str path: The file to load the key from and save it to, if
+                         a single key should be kept
+        """
+        self.log = loggers.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.size = size
+        self.path = path
+
+        self._keys = queue.Queue(size)
+        self._key = None
+        self._lock = threading.Lock()
+        self._started = False
+
+    def generate(self) -> RSA.RsaKey:
+        """
+        Generate a new key pair, without using the pool.
+        """
+        self.log.info('Generating RSA key')
+        key = RSA.generate(self.BITS, Random.new().read)
+        self.log.info('Key gen finished')
+        return key
+
+    def start(self) -> None:
+        """
+        Begin filling the pool in the background, if it is not already
+        being filled. This spawns a thread, then returns.
+        """
+        with self._lock:
+            if self._started or self.path is not None:
+                return
+            self._started = True
+        threading.Thread(target=self._fill, daemon=True).start()
+
+    def _fill(self) -> None:
+        while True:
+            # This blocks while the pool is full
+            self._keys.put(self.generate())
+
+    def take(self) -> RSA.RsaKey:
+        """
+        Take a key pair for a handshake, waiting for one to be generated if
+        none are ready.
+        """
+        if self.path is not None:
+            return self._load()
+        self.start()
+        return self._keys.get()
+
+    def _load(self) -> RSA.RsaKey:
+        """
+        Load the key from the key file, creating the file if needed.
+        """
+        with self._lock:
+            if self._key is not None:
+                return self._key
+            try:
+                with open(self.path, 'rb') as f:
+                    self._key = RSA.importKey(f.read())
+                return self._key
+            except FileNotFoundError:
+                pass
+            except (ValueError, IndexError, TypeError) as e:
+                self.log.warning(f'Replacing unreadable key file: {e}')
+
+            self._key = self.generate()
+            # The file holds a private key, so only we may read it
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._key.exportKey('PEM'))
+            return self._key
+
+
+# Every controller in the process shares one pool
+pool = KeyPool(path=KEY_FILE)
@@ -0,0 +1,171 @@
+import struct
+import threading
+from typing import Container, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from .decode_cache import DecodeCache
+from .demux import RingBuffer
+from .util.opus import OpusEncoder, OpusError
+from . import loggers
+
+
+def minus_one(frames: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Mix one frame of a room.
+
+    :param frames: One row of samples per speaker
+    :returns: The samples and RMS amplitude of each mix. Row n is the room
+              without speaker n, and the last row is the whole room.
+    """
+    stack = frames.astype(np.int32)
+    total = stack.sum(axis=0)
+    mixed = np.clip(np.vstack((total - stack, total)), -1 << 15, (1 << 15) - 1)
+    amps = np.sqrt(np.mean(mixed.astype(np.float64) ** 2, axis=1))
+    return mixed.astype('<h'), amps
+
+
+class Mixer:
+    """
+    Mixes the audio of rooms in server mixing mode, so that each member is
+    sent a single stream rather than one stream per speaker.
+
+    Frames are decoded, through the server's shared decode cache, as they
+    arrive, and held until the next mix. Each mix
+    takes at most one frame from every speaker, sums the frames of each room
+    once, then subtracts each speaker's own frame from the sum, so every
+    member hears everybody but themself. As an Opus encoder carries state
+    between frames, each speaker's mix is encoded with their own encoder.
+    Everybody else hears the same mix, which is encoded once per room.
+    """
+    SAMPLES = OpusEncoder.SAMPLES_PER_FRAME
+    # The frames held per speaker, to ride out jitter between mixes
+    DEPTH = 3
+
+    def __init__(self, cache: DecodeCache, shard: int=0) -> None:
+        """
+        :param DecodeCache cache: The cache to decode frames through
+        :param int shard: The process mixing, which is part of the origin of
+                          every mixed stream. When several processes mix a
+                          room, each sends its listeners a seperate stream,
+                          which the client mixes as it would any others.
+        """
+        self.log = loggers.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.cache = cache
+        self.shard = shard
+
+        self._lock = threading.Lock()
+        self._frames = {}
+        self._encoders = {}
+
+    def origin(self, room: int) -> bytes:
+        """
+        The client id mixed audio for a room is sent from.
+        """
+        return struct.pack('!14sBB', b'mix', self.shard, room)
+
+    def feed(self, client_id: bytes, sequence: int, payload: bytes) -> None:
+        """
+        Decode a frame of audio, and hold it until the next mix.
+
+        :param bytes client_id: The speaker
+        :param int sequence: The sequence number of the frame
+        :param bytes payload: The AUDIO payload, including the amplitude
+        """
+        try:
+            frame = self.cache.decode(client_id, sequence, payload[2:])
+        except OpusError as e:
+            self.log.warning(f'Failed to decode audio for {client_id}: {e}')
+            return
+        if frame is None or frame.shape != (self.SAMPLES,):
+            return
+
+        with self._lock:
+            if client_id not in self._frames:
+                self._frames[client_id] = RingBuffer(self.DEPTH)
+            self._frames[client_id].push(frame)
+
+    def retain(self, speakers: Iterable[bytes],
+               members: Dict[int, FrozenSet[bytes]]) -> None:
+        """
+        Release the state of every speaker and listener no longer in a mixed
+        room.
+
+        :param speakers: Clients who may still be mixed
+        :param dict members: The members of each mixed room
+        """
+        speakers = set(speakers)
+        with self._lock:
+            for i in [i for i in self._frames if i not in speakers]:
+                del self._frames[i]
+            # Encoders without a listener are shared by the whole room
+            for i in [i for i in self._encoders if i[0] not in members
+                      or i[1] is not None and i[1] not in members[i[0]]]:
+                del self._encoders[i]
+
+    def _take(self) -> Dict[bytes, np.ndarray]:
+        """
+        Take the oldest held frame of every speaker.
+        """
+        with self._lock:
+            frames = {}
+            for client_id, ring in self._frames.items():
+                frame = ring.pop()
+                if frame is not None:
+                    frames[client_id] = frame
+            return frames
+
+    def mix(self, members: Dict[int, FrozenSet[bytes]],
+            listeners: Optional[Container[bytes]]=None
+            ) -> List[Tuple[int, bytes, bytes]]:
+        """
+        Mix one frame of audio for every room.
+
+        :param dict members: The members of each mixed room
+        :param listeners: The members to mix for, if not all of them. Members
+                          connected to a linked server, for instance, are
+                          heard in the mix but mixed for by their own server.
+        :returns: (room, listener, payload) triples, where the payload is
+                  ready to be sent as AUDIO from :func:`origin`. Rooms where
+                  nobody spoke produce nothing.
+        """
+        frames = self._take()
+        if not frames:
+            return []
+
+        mixes = []
+        for room, clients in members.items():
+            speakers = [i for i in clients if i in frames]
+            if not speakers:
+                continue
+
+            pcm, amps = minus_one(np.stack([frames[i] for i in speakers]))
+
+            rows = {j: n for n, j in enumerate(speakers)}
+            everyone = len(speakers)
+            shared = None
+            for i in clients:
+                if listeners is not None and i not in listeners:
+                    continue
+                row = rows.get(i)
+                if row is None:
+                    # Everybody who is not speaking hears the whole room, so
+                    # it is only encoded once
+                    if shared is None:
+                        shared = self._encode(room, None, pcm[everyone],
+                                              amps[everyone])
+                    mixes.append((room, i, shared))
+                elif len(speakers) > 1:
+                    # Speakers hear the room minus themself. A lone speaker
+                    # has nobody else to hear.
+                    mixes.append((room, i, self._encode(room, i, pcm[row],
+                                                        amps[row])))
+        return mixes
+
+    def _encode(self, room: int, listener: Optional[bytes], pcm: np.ndarray,
+                amp: float) -> bytes:
+        with self._lock:
+            encoder = self._encoders.get((room, listener))
+            if encoder is None:
+                encoder = self._encoders[(room, listener)] = OpusEncoder()
+        return struct.pack('!H', min(int(amp), 0xffff)) + encoder.encode(pcm.tobytes())
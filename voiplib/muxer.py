@@ -8,6 +8,10 @@ class Muxer:
     Mix multiple streams of audio info a single output stream.
     """
     BUFFER = 1
+    # The length of a frame in seconds. Speakers send nothing while their
+    # gate is closed, so if nobody sends a frame for this long, silence is
+    # played rather than waiting.
+    FRAME_TIME = 0.02
 
     def __init__(self) -> None:
         """
@@ -46,7 +50,7 @@ class Muxer:
                 break
         else:
             self._has_frame.clear()
-            self._has_frame.wait()
+            self._has_frame.wait(self.FRAME_TIME)
 
         frame = np.zeros((960,), dtype='<i')
 
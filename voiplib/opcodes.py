@@ -11,6 +11,41 @@ AES_CHECK = 5
 # Main protocol
 AUDIO = 10
 REGISTER_UDP = 11
+# Several AUDIO frames, from different clients, sent as one packet
+AUDIO_BUNDLE = 23
+# Distributes a room's media key, and audio sealed with that key
+ROOM_KEY = 24
+ROOM_AUDIO = 25
+# A resumption ticket, issued once a handshake completes
+TICKET = 31
+# Sent by clients while they have nothing else to say, and echoed back
+HEARTBEAT = 32
+# Between linked servers: the members of each server's rooms, and audio from
+# one of those members
+TRUNK_ROOMS = 28
+TRUNK_AUDIO = 29
+
+# REGISTER_UDP flags
+UDP_BUNDLE = 0x01
+
+# SET_ROOM_MODE modes
+ROOM_FORWARD = 0
+ROOM_MIX = 1
+# A few designated speakers, heard by a listen-only audience
+ROOM_STAGE = 2
+
+# HELLO capability flags
+CAP_AEAD = 0x01
+CAP_ROOM_KEYS = 0x02
+# Offered by servers linking to another server, rather than by clients
+CAP_TRUNK = 0x04
+# HELLO carries an ephemeral X25519 key, and the handshake completes in the
+# reply to it
+CAP_X25519 = 0x08
+# Clients are issued tickets, which resume their session when reconnecting
+CAP_RESUME = 0x10
+# Clients send heartbeats, and are disconnected when they stop
+CAP_HEARTBEAT = 0x20
 
 # Control surface
 SET_GATE = 12
@@ -24,3 +59,9 @@ SET_ROOMS = 19
 START_RECORD = 20
 STOP_RECORD = 21
 GET_RECORD = 22
+# Switch a room between forwarding and server mixing
+SET_ROOM_MODE = 26
+# Limit a room to forwarding its loudest few speakers
+SET_ROOM_TOPK = 27
+# Designate the speakers of a stage room
+SET_SPEAKERS = 30
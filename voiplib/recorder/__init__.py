@@ -1,3 +1,3 @@
 from .recording import Recording
-from .recorder import Recorder
+from .recorder import Recorder, RecordingQueue
 from .wav_file import WAVFile
@@ -1,19 +1,37 @@
 import base64
+import queue
+import threading
+import time
+from typing import Optional
 
-from ..util.opus import OpusDecoder
+from ..decode_cache import DecodeCache
+from ..util.opus import OpusEncoder
+from .recording import Recording
 from .. import loggers
 
 
 class Recorder:
     FLUSH_EVERY = 10
+    # Clients send nothing while their gate is closed. Gaps of at least this
+    # many frames are recorded as silence, while shorter gaps are assumed to
+    # be jitter.
+    GAP_FRAMES = 3
 
-    def __init__(self) -> None:
+    def __init__(self, cache: DecodeCache=None) -> None:
+        """
+        :param DecodeCache cache: The cache to decode frames through. Sharing
+                                  the cache with anything else decoding audio
+                                  means each frame is decoded only once.
+        """
+        self.cache = cache or DecodeCache()
         self.recording = set()
         self.rec_start = {}
 
         self.recordings = {}
         self._counts = {}
-        self._decoders = {}
+        self._last = {}
+        # Recordings are fed from their own thread, but stopped from others
+        self._lock = threading.Lock()
 
         self.log = loggers.getLogger(__name__ + '.' + self.__class__.__name__)
     
@@ -25,29 +43,74 @@ class Recorder:
         """
         return './recording/' + base64.b64encode(client_id).strip(b'=').decode().replace('/', '_')
 
-    def feed(self, client_id: bytes, audio: bytes) -> None:
+    def start(self, client_id: bytes) -> None:
+        """
+        Begin recording a client.
+
+        :param bytes client_id: The client id to record
+        """
+        self.recording.add(client_id)
+        self.rec_start[client_id] = time.time()
+
+    def stop(self, client_id: bytes) -> None:
+        """
+        Stop recording a client, and write out what remains of the recording.
+
+        :param bytes client_id: The client id being recorded
+        """
+        with self._lock:
+            if client_id not in self.recording:
+                return
+            # Stop recording the client
+            self.recording.remove(client_id)
+            if client_id in self.recordings:
+                # Write any remaining buffer to disk
+                self.recordings[client_id].flush()
+                self.recordings[client_id].finish()
+                # Clean up after the recorder
+                del self.recordings[client_id]
+                del self._counts[client_id]
+                self._last.pop(client_id, None)
+
+    def feed(self, client_id: bytes, sequence: int, audio: bytes,
+             now: Optional[float]=None) -> None:
         """
         Feed a frame of audio into the recorder.
 
         :param bytes client_id: The client id of the speaker
+        :param int sequence: The sequence number of the frame
         :param bytes audio: The frame of audio to record
+        :param float now: The monotonic time the frame arrived
         """
-        # Check if we are actually recording them
-        if client_id not in self.recording:
-            return
+        with self._lock:
+            # Check if we are actually recording them
+            if client_id not in self.recording:
+                return
+            self._feed(client_id, sequence, audio,
+                       time.monotonic() if now is None else now)
 
+    def _feed(self, client_id: bytes, sequence: int, audio: bytes,
+              now: float) -> None:
         # Setup initial recording state for new clients
         if client_id not in self.recordings:
             self.recordings[client_id] = Recording(
                 self.gen_filename(client_id))
-            self._decoders[client_id] = OpusDecoder()
             self._counts[client_id] = 0
         
         # Decode the audio from Opus to PCM
-        audio = self._decoders[client_id].decode(audio[2:])
-        if audio is None:
-            self.log.warning('Failed to decode audio!')
-            return
+        audio = self.cache.decode(client_id, sequence, audio[2:])
+        # A frame too late to decode is recorded as silence
+        audio = (bytes(OpusEncoder.FRAME_SIZE) if audio is None
+                 else audio.tobytes())
+        # Fill any gap left while the client's gate was closed with silence
+        if client_id in self._last:
+            frame = OpusEncoder.FRAME_LENGTH / 1000
+            missing = round((now - self._last[client_id]) / frame) - 1
+            if missing >= self.GAP_FRAMES:
+                self.recordings[client_id].write(
+                    bytes(OpusEncoder.FRAME_SIZE * missing))
+        self._last[client_id] = now
+
         # Forward the PCM to the recorder
         self.recordings[client_id].write(audio)
 
@@ -57,3 +120,60 @@ class Recorder:
             self.recordings[client_id].flush()
             self.recordings[client_id].finish()
             self._counts[client_id] = 0
+
+
+class RecordingQueue:
+    """
+    Feeds a recorder from a thread of its own, so that decoding and disk IO
+    never hold up the routing of live audio.
+
+    The queue between the two is bounded. Should the recorder fall behind,
+    frames being recorded are dropped, rather than the caller being made to
+    wait.
+    """
+    # Ten seconds of audio from a single speaker
+    SIZE = 500
+    # Log every this many dropped frames, rather than every drop
+    LOG_EVERY = 100
+
+    def __init__(self, recorder: Recorder, size: int=SIZE) -> None:
+        """
+        :param Recorder recorder: The recorder to feed
+        :param int size: The most frames waiting to be recorded
+        """
+        self.log = loggers.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.recorder = recorder
+        self.dropped = 0
+
+        self._queue = queue.Queue(size)
+        threading.Thread(target=self._mainloop, daemon=True).start()
+
+    def put(self, client_id: bytes, sequence: int, audio: bytes) -> None:
+        """
+        Queue a frame of audio to be recorded, if the speaker is being
+        recorded. This never blocks.
+
+        :param bytes client_id: The client id of the speaker
+        :param int sequence: The sequence number of the frame
+        :param bytes audio: The frame of audio to record
+        """
+        if client_id not in self.recorder.recording:
+            return
+        try:
+            # The audio may be a view of a buffer which is about to be reused
+            self._queue.put_nowait(
+                (client_id, sequence, bytes(audio), time.monotonic()))
+        except queue.Full:
+            if self.dropped % self.LOG_EVERY == 0:
+                self.log.warning('Recorder is falling behind, dropping frames')
+            self.dropped += 1
+
+    def _mainloop(self) -> None:
+        while True:
+            client_id, sequence, audio, now = self._queue.get()
+            # This may fail if there is a disk IO failure, or if the audio
+            # payload is malformed.
+            try:
+                self.recorder.feed(client_id, sequence, audio, now)
+            except Exception as e:
+                self.log.warning(f'Failed to record audio for {client_id}: {e}')
@@ -0,0 +1,317 @@
+import threading
+from typing import (
+    AbstractSet, Dict, FrozenSet, Iterable, Iterator, List, Optional,
+    Sequence, Tuple,
+)
+
+
+class Rooms:
+    """
+    The members of every room, indexed by client as well as by room.
+
+    Alongside the members of each room, the set of clients able to hear each
+    client is maintained as membership changes, so that routing a packet is
+    a single dictionary lookup. Everything handed out is a frozenset which is
+    replaced, rather than modified, when membership changes, so readers never
+    need to take the lock.
+
+    In most rooms every member hears every other. A stage room instead has a
+    few speakers, heard by everybody, and an audience who are never heard.
+    The audience are left out of the index entirely, so a stage costs one
+    entry per speaker and member, rather than one per pair of members.
+
+    The members of a room, and the listeners of a client, are only frozen
+    again when next read, so a crowd joining a stage costs one rebuild of
+    each, rather than one per member joining.
+
+    Changes can be kept in a journal, with :func:`track_changes`, so that
+    they can be replayed onto a copy elsewhere with :func:`apply`.
+    """
+
+    def __init__(self) -> None:
+        self._members = []
+        self._rooms = {}
+        self._listeners = {}
+        # For each client, the number of rooms in which they are heard by
+        # each other client. A pair stop hearing each other when this
+        # reaches zero.
+        self._shared = {}
+        # The speakers of each stage room. This is replaced, rather than
+        # modified, when it changes.
+        self._stages = {}
+        # Clients whose listeners need rebuilding, and the members of rooms
+        # changed since they were last frozen
+        self._dirty = set()
+        self._open = {}
+        # The changes made since they were last taken, if being tracked
+        self._journal = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        # The index travels with the rooms, so need not be rebuilt on arrival
+        with self._lock:
+            self._flush()
+            state = {k: v for k, v in self.__dict__.items() if k != '_lock'}
+            state['_dirty'] = set()
+            state['_open'] = {}
+            state['_journal'] = None
+            state['_members'] = list(self._members)
+            state['_shared'] = {k: dict(v) for k, v in self._shared.items()}
+            state['_rooms'] = dict(self._rooms)
+            state['_listeners'] = dict(self._listeners)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def snapshot(self) -> 'Rooms':
+        """
+        Take a consistent copy of the rooms, unaffected by later changes. The
+        copy is only for reading, so the counts needed to change it are left
+        behind.
+        """
+        rooms = Rooms()
+        with self._lock:
+            self._flush()
+            rooms._members = list(self._members)
+            rooms._rooms = dict(self._rooms)
+            rooms._listeners = dict(self._listeners)
+            rooms._stages = self._stages
+        return rooms
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    def __getitem__(self, room: int) -> FrozenSet[bytes]:
+        if self._open:
+            with self._lock:
+                self._flush()
+        return self._members[room]
+
+    def __iter__(self) -> Iterator[FrozenSet[bytes]]:
+        if self._open:
+            with self._lock:
+                self._flush()
+        return iter(list(self._members))
+
+    @property
+    def stages(self) -> Dict[int, FrozenSet[bytes]]:
+        """
+        The speakers of every stage room.
+        """
+        return self._stages
+
+    def stage(self, room: int) -> Optional[FrozenSet[bytes]]:
+        """
+        The speakers of a room, or `None` if every member is a speaker.
+        """
+        return self._stages.get(room)
+
+    def track_changes(self) -> None:
+        """
+        Start keeping a journal of every change, to be taken with
+        :func:`take_changes`.
+        """
+        with self._lock:
+            if self._journal is None:
+                self._journal = []
+
+    def take_changes(self) -> List[Tuple[str, tuple]]:
+        """
+        Take the changes made since the last call, as (method, args) pairs.
+        """
+        with self._lock:
+            changes, self._journal = self._journal or [], []
+        return changes
+
+    def apply(self, changes: Sequence[Tuple[str, tuple]]) -> None:
+        """
+        Replay changes taken from another instance with :func:`take_changes`.
+        """
+        for method, args in changes:
+            if method in ('grow', 'join', 'leave', 'set_stage'):
+                getattr(self, method)(*args)
+
+    def _record(self, method: str, *args) -> None:
+        # The lock must be held
+        if self._journal is not None:
+            self._journal.append((method, args))
+
+    def grow(self, count: int) -> None:
+        """
+        Make sure at least `count` rooms exist.
+        """
+        with self._lock:
+            if len(self._members) < count:
+                self._record('grow', count)
+            while len(self._members) < count:
+                self._members.append(frozenset())
+
+    def rooms_of(self, client_id: bytes) -> FrozenSet[int]:
+        """
+        The rooms a client is a member of.
+        """
+        return self._rooms.get(client_id, frozenset())
+
+    def listeners(self, client_id: bytes) -> FrozenSet[bytes]:
+        """
+        Every other client able to hear a client, through at least one room.
+        """
+        if self._dirty:
+            with self._lock:
+                self._flush()
+        return self._listeners.get(client_id, frozenset())
+
+    def _speakers(self, room: int,
+                  members: AbstractSet[bytes]) -> AbstractSet[bytes]:
+        """
+        The members of a room who are heard. On a stage this only looks at
+        the speakers, never the audience.
+        """
+        stage = self._stages.get(room)
+        return members if stage is None else members & stage
+
+    def _hear(self, speaker: bytes, listener: bytes, delta: int) -> None:
+        """
+        Adjust the number of rooms in which one client hears another. The
+        lock must be held.
+        """
+        self._dirty.add(speaker)
+        shared = self._shared.setdefault(speaker, {})
+        shared[listener] = shared.get(listener, 0) + delta
+        if not shared[listener]:
+            del shared[listener]
+
+    def _link(self, client_id: bytes, room: int, members: AbstractSet[bytes],
+              delta: int) -> None:
+        """
+        Adjust who hears whom as a client joins or leaves the other members
+        of a room. The lock must be held.
+        """
+        stage = self._stages.get(room)
+        if stage is None or client_id in stage:
+            for i in members:
+                self._hear(client_id, i, delta)
+        for i in self._speakers(room, members):
+            self._hear(i, client_id, delta)
+
+    def _current(self, room: int) -> AbstractSet[bytes]:
+        # The lock must be held
+        members = self._open.get(room)
+        return self._members[room] if members is None else members
+
+    def _edit(self, room: int) -> set:
+        """
+        The members of a room, as a set which may be changed in place. The
+        lock must be held.
+        """
+        members = self._open.get(room)
+        if members is None:
+            members = self._open[room] = set(self._members[room])
+        return members
+
+    def _flush(self) -> None:
+        """
+        Freeze the members of every room which changed, and rebuild the
+        listeners of every client whose listeners changed. The lock must be
+        held.
+        """
+        for n, members in self._open.items():
+            self._members[n] = frozenset(members)
+        self._open.clear()
+        for i in self._dirty:
+            shared = self._shared.get(i)
+            if shared:
+                self._listeners[i] = frozenset(shared)
+            else:
+                self._shared.pop(i, None)
+                self._listeners.pop(i, None)
+        self._dirty.clear()
+
+    def join(self, client_id: bytes, room: int) -> bool:
+        """
+        Add a client to a room, creating it if needed.
+
+        :returns: If the client was not already a member
+        """
+        self.grow(room + 1)
+        with self._lock:
+            if client_id in self._current(room):
+                return False
+
+            members = self._edit(room)
+            self._link(client_id, room, members, 1)
+            members.add(client_id)
+            self._rooms[client_id] = self.rooms_of(client_id) | {room}
+            self._record('join', client_id, room)
+        return True
+
+    def leave(self, client_id: bytes, room: int) -> bool:
+        """
+        Remove a client from a room.
+
+        :returns: If the client was a member
+        """
+        with self._lock:
+            if (room >= len(self._members)
+                    or client_id not in self._current(room)):
+                return False
+
+            members = self._edit(room)
+            members.discard(client_id)
+            self._link(client_id, room, members, -1)
+
+            rooms = self.rooms_of(client_id) - {room}
+            if rooms:
+                self._rooms[client_id] = rooms
+            else:
+                self._rooms.pop(client_id, None)
+            self._record('leave', client_id, room)
+        return True
+
+    def set_stage(self, room: int,
+                  speakers: Optional[Iterable[bytes]]) -> None:
+        """
+        Make a room a stage, with only some of its members speaking, or make
+        every member a speaker again.
+
+        :param int room: The room to change
+        :param speakers: The clients who may speak, who need not be members
+                         yet, or `None` for everybody
+        """
+        self.grow(room + 1)
+        with self._lock:
+            members = self._current(room)
+            # Undo the room under its old rules, then redo it under the new
+            self._link_all(room, members, -1)
+            stages = dict(self._stages)
+            if speakers is None:
+                stages.pop(room, None)
+            else:
+                stages[room] = frozenset(speakers)
+            self._stages = stages
+            self._link_all(room, members, 1)
+            self._record('set_stage', room, stages.get(room))
+
+    def _link_all(self, room: int, members: AbstractSet[bytes],
+                  delta: int) -> None:
+        """
+        Adjust who hears whom for every member of a room. The lock must be
+        held.
+        """
+        for i in self._speakers(room, members):
+            for j in members:
+                if j != i:
+                    self._hear(i, j, delta)
+
+    def leave_all(self, client_id: bytes) -> List[int]:
+        """
+        Remove a client from every room they are in.
+
+        :returns: The rooms the client was removed from
+        """
+        rooms = sorted(self.rooms_of(client_id))
+        for i in rooms:
+            self.leave(client_id, i)
+        return rooms
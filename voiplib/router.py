@@ -0,0 +1,501 @@
+import struct
+import threading
+import time
+from itertools import repeat
+from typing import Dict, FrozenSet
+
+from .recorder import Recorder, RecordingQueue
+from .rooms import Rooms
+from .speakers import ActiveSpeakers
+from .decode_cache import DecodeCache
+from .key_manager import RoomCipher
+from .mixer import Mixer
+from .socket_controller import SocketController, SocketMode, KeyManager
+from .event_loop import EventLoop
+from .opcodes import *
+from .util.packets import Packet, pack_bundle
+
+
+class RoutingTable:
+    """
+    An immutable snapshot of everything needed to route audio: where each
+    listener is, how they want their audio, who they share rooms with, the
+    media key of each room, which rooms are mixed by the server, which
+    forward only their loudest speakers, and which link reaches each member
+    connected to another server.
+
+    A new table is built and swapped in once per frame if any of these
+    changed, so the audio path can read the current table without taking any
+    lock.
+    """
+    __slots__ = ('addresses', 'bundled', 'rooms', 'room_ciphers', 'keyed',
+                 'mixed', 'topk', 'trunks', 'departed')
+
+    def __init__(self, addresses: Dict[bytes, tuple]=None,
+                 bundled: FrozenSet[bytes]=frozenset(), rooms: Rooms=None,
+                 room_ciphers: Dict[int, RoomCipher]=None,
+                 keyed: Dict[int, FrozenSet[bytes]]=None,
+                 mixed: Dict[int, FrozenSet[bytes]]=None,
+                 topk: Dict[int, ActiveSpeakers]=None,
+                 trunks: Dict[bytes, bytes]=None) -> None:
+        """
+        :param dict addresses: The UDP address of each listening client
+        :param frozenset bundled: Listeners which accept AUDIO_BUNDLE
+        :param Rooms rooms: A copy of the room membership
+        :param dict room_ciphers: The current media key of each room
+        :param dict keyed: The listening members of each room holding its
+                           media key
+        :param dict mixed: The members of each room mixed by the server
+        :param dict topk: The active speakers of each room limited to its
+                          loudest speakers. Only the audio path may change
+                          these.
+        :param dict trunks: The link to each member of a room connected to
+                            a linked server
+        """
+        self.addresses = addresses or {}
+        self.bundled = bundled
+        self.rooms = rooms or Rooms()
+        self.room_ciphers = room_ciphers or {}
+        self.keyed = keyed or {}
+        self.mixed = mixed or {}
+        self.topk = topk or {}
+        self.trunks = trunks or {}
+        # Listeners who have left since the table was built, whose keys may
+        # already be forgotten, so they are sent nothing sealed with them.
+        # Besides the active speakers, this is the only part of the table
+        # which changes.
+        self.departed = set()
+
+
+class AudioRouter:
+    """
+    Forwards audio received over UDP to every client allowed to hear it.
+
+    The routing state is kept seperate from the rest of the server, so that
+    the same routing can be run by each worker process when the server is
+    spread over several processes.
+    """
+    # How often, in seconds, bundled audio is flushed to listeners. This
+    # matches the length of one audio frame.
+    BUNDLE_INTERVAL = 0.02
+
+    def __init__(self, km: KeyManager, loop: EventLoop=None) -> None:
+        """
+        :param KeyManager km: The key manager holding every client's keys
+        :param EventLoop loop: The event loop to schedule bundle flushes on,
+                               if any
+        """
+        self.km = km
+        self.loop = loop
+
+        self.udp_send = SocketController(SocketMode.UDP, km=self.km)
+        # Everything needing PCM decodes through this, so that each frame
+        # is only ever decoded once
+        self.decode_cache = DecodeCache()
+        # Setup a recorder. Audio is recorded on a thread of its own, so a
+        # slow disk can only ever cost recorded frames, never live ones.
+        self.recorder = Recorder(self.decode_cache)
+        self.recording = RecordingQueue(self.recorder)
+
+        # The members of each room, and who each client can hear
+        self.rooms = Rooms()
+        self.cont_udp_port = None
+        # Rooms in server mixing mode, and the mixer shared between them
+        self.mixed_rooms = set()
+        self.mixer = Mixer(self.decode_cache)
+        # The active speakers of rooms limited to their loudest speakers
+        self.active_speakers = {}
+        # Members of rooms on linked servers, and the link to each
+        self.remote_members = {}
+
+        # The UDP mutex serialises changes to the listeners, and rebuilding
+        # the routing table from them. Audio is routed using only the table.
+        self.udp_lock = threading.Lock()
+        self.udp_listeners = {}
+        self.udp_bundled = set()
+        self.routes = RoutingTable()
+        # Set when the table is out of date, and rebuilt on the next tick
+        self._routes_stale = False
+
+        # Frames waiting for listeners which accept AUDIO_BUNDLE. Frames for
+        # listeners holding room keys are held per room.
+        self._bundle_lock = threading.Lock()
+        self._bundles = {}
+        self._room_bundles = {}
+
+    def rebuild_routes(self) -> None:
+        """
+        Rebuild the routing table from the current state, then swap it in.
+        """
+        with self.udp_lock:
+            self._rebuild_routes()
+
+    def routes_changed(self) -> None:
+        """
+        Note that the routing table is out of date. This must be called after
+        any change to the rooms or room keys. Rather than being rebuilt
+        straight away, it is rebuilt once per frame by :func:`flush_routes`,
+        so a burst of changes, such as a crowd joining a room, costs only a
+        single rebuild.
+        """
+        self._routes_stale = True
+
+    def flush_routes(self) -> None:
+        """
+        Rebuild the routing table, if it is out of date.
+        """
+        if self._routes_stale:
+            self._routes_stale = False
+            self.rebuild_routes()
+
+    def _rebuild_routes(self) -> None:
+        """
+        Rebuild the routing table. The UDP mutex must be held.
+        """
+        rooms = self.rooms.snapshot()
+        listening = {i for i in self.udp_listeners
+                     if self.km.get_caps(i) & CAP_ROOM_KEYS}
+
+        room_ciphers, keyed, mixed = {}, {}, {}
+        for n in range(len(rooms)):
+            if n in self.mixed_rooms:
+                mixed[n] = rooms[n]
+                continue
+            cipher = self.km.get_room_cipher(n)
+            if cipher is not None:
+                room_ciphers[n] = cipher
+                keyed[n] = rooms[n] & listening
+        self.mixer.retain(frozenset().union(*mixed.values()), mixed)
+
+        # Replacing the attribute is atomic, so the table is never seen half
+        # built
+        self.routes = RoutingTable(
+            dict(self.udp_listeners), frozenset(self.udp_bundled), rooms,
+            room_ciphers, keyed, mixed, dict(self.active_speakers),
+            self.remote_members,
+        )
+
+    def set_room_mode(self, room: int, mode: int) -> None:
+        """
+        Switch a room between forwarding each speaker's audio to every
+        member, and mixing the room into a single stream per member. Stage
+        rooms are forwarded, their speakers being kept with the rooms.
+
+        :param int room: The room to switch
+        :param int mode: One of `ROOM_FORWARD`, `ROOM_MIX` or `ROOM_STAGE`
+        """
+        with self.udp_lock:
+            if mode == ROOM_MIX:
+                self.mixed_rooms.add(room)
+            else:
+                self.mixed_rooms.discard(room)
+            self._rebuild_routes()
+
+    def set_room_topk(self, room: int, k: int) -> None:
+        """
+        Limit a room to forwarding only its `k` loudest speakers.
+
+        :param int room: The room to limit
+        :param int k: The number of speakers to forward, or zero for all
+        """
+        with self.udp_lock:
+            if k:
+                self.active_speakers[room] = ActiveSpeakers(k)
+            else:
+                self.active_speakers.pop(room, None)
+            self._rebuild_routes()
+
+    def register_listener(self, client_id: bytes, addr, flags: int) -> None:
+        """
+        Start sending audio to a client.
+
+        :param bytes client_id: The listening client
+        :param tuple addr: The address to send the client audio on
+        :param int flags: The REGISTER_UDP flags the client sent
+        """
+        with self.udp_lock:
+            self.udp_listeners[client_id] = addr
+            if flags & UDP_BUNDLE:
+                self.udp_bundled.add(client_id)
+            else:
+                self.udp_bundled.discard(client_id)
+            self._routes_stale = True
+
+    def forget_listener(self, client_id: bytes) -> None:
+        """
+        Stop sending audio to a client.
+
+        :param bytes client_id: The client which has left
+        """
+        with self.udp_lock:
+            if client_id in self.udp_listeners:
+                del self.udp_listeners[client_id]
+            self.udp_bundled.discard(client_id)
+            self.routes.departed.add(client_id)
+            self._routes_stale = True
+        with self._bundle_lock:
+            self._bundles.pop(client_id, None)
+        self.decode_cache.forget(client_id)
+
+    def udp_mainloop(self):
+        """
+        The mainloop for UDP sections of the server. This handles mainly
+        routing of audio between mutliple clients.
+        """
+        while True:
+            self.handle_udp(self.udp_recv.get_packet(True))
+
+    def handle_udp(self, pkt) -> None:
+        """
+        Handle a single packet received on the UDP socket.
+        """
+        self.log.debug(f'UDP packet from {pkt[1]}: {pkt[2].opcode}')
+        if pkt[2].opcode == AUDIO:
+            self.route_audio(pkt[2])
+        elif pkt[2].opcode == TRUNK_AUDIO:
+            link_id = pkt[2].client_id
+            speaker = pkt[2].payload[:16]
+            # Only members the linked server has told us of may be spoken
+            # for, so a link can never impersonate anybody else
+            if self.routes.trunks.get(speaker) != link_id:
+                self.log.warning(f'Unexpected trunk audio from {pkt[1]}')
+                return
+            self.route_audio(Packet(
+                AUDIO, pkt[2].payload[16:], pkt[2].timestamp,
+                pkt[2].sequence, speaker,
+            ), from_trunk=True)
+
+    def route_audio(self, packet: Packet, from_trunk: bool=False) -> None:
+        """
+        Forward a frame of audio to everybody allowed to hear it.
+
+        :param Packet packet: The AUDIO packet, from the speaker
+        :param bool from_trunk: If the audio arrived from a linked server. It
+                                is then only forwarded to clients of this
+                                server, as every server is sent audio
+                                directly by the server its speaker is on.
+        """
+        # The table may be replaced at any moment, so only this copy of
+        # it is used for the packet
+        routes = self.routes
+        listeners = routes.addresses
+        # Locate all the clients in the same room. Both are kept
+        # indexed by client, so no rooms need to be searched.
+        rooms = routes.rooms.rooms_of(packet.client_id)
+        stages = routes.rooms.stages
+        if stages and not rooms.isdisjoint(stages):
+            rooms = frozenset(n for n in rooms if n not in stages
+                              or packet.client_id in stages[n])
+            if not rooms:
+                # The audience of a stage is never heard, so nothing they
+                # send is recorded, decoded or forwarded
+                return
+        can_listen = routes.rooms.listeners(packet.client_id)
+
+        # Hand the packet to the recorder, if the speaker is being
+        # recorded
+        self.recording.put(packet.client_id, packet.sequence,
+                           packet.payload)
+        # Members of mixed rooms hear the speaker in the mix instead, so
+        # only the remaining rooms are forwarded
+        forwarded = rooms
+        if routes.mixed and not rooms.isdisjoint(routes.mixed):
+            self.mixer.feed(packet.client_id, packet.sequence,
+                            packet.payload)
+            forwarded = forwarded.difference(routes.mixed)
+        # Rooms limited to their loudest speakers may not want this one
+        if routes.topk and not forwarded.isdisjoint(routes.topk):
+            amp = 0
+            if len(packet.payload) >= 2:
+                amp = struct.unpack_from('!H', packet.payload)[0]
+            forwarded = frozenset(
+                n for n in forwarded if n not in routes.topk
+                or routes.topk[n].update(packet.client_id, amp))
+        if forwarded != rooms:
+            rooms = forwarded
+            can_listen = frozenset().union(
+                *(routes.rooms[n] for n in rooms)) - {packet.client_id}
+
+        # If a control surface is attached, forward the packet
+        # there, too.
+        if self.cont_udp_port is not None:
+            can_listen = can_listen | {self.cont_udp_port}
+
+        # Clients holding a room's media key share a single copy of
+        # the audio per room, rather than each having their own.
+        datagrams = []
+        served = set()
+        keyed_any = set()
+        for n in rooms:
+            keyed = routes.keyed.get(n, frozenset()) - {packet.client_id}
+            keyed_any.update(keyed)
+
+            direct = keyed.difference(routes.bundled, served)
+            served.update(direct)
+            if direct:
+                data = self.udp_send.make_room_packet(
+                    routes.room_ciphers[n], AUDIO,
+                    packet.payload, origin=packet.client_id)
+                # Every datagram shares the one sealed copy, so an audience
+                # of thousands costs no more encryption than one listener
+                datagrams.extend(
+                    zip(map(listeners.__getitem__, direct), repeat(data)))
+            if len(direct) < len(keyed):
+                self._bundle_room_frame(routes, n, packet, datagrams)
+
+        # Retransmit the audio to all other clients allowed to
+        # listen. Each copy is encrypted for its listener, then the
+        # whole fan-out is flushed at once. Listeners that accept
+        # bundles instead have the frame held until the next tick.
+        if keyed_any:
+            can_listen = can_listen.difference(keyed_any)
+        for i in can_listen:
+            if i not in listeners or i in routes.departed:
+                continue
+            if i in routes.bundled:
+                self._bundle_frame(i, listeners[i], packet, datagrams)
+            else:
+                datagrams.append((listeners[i], self.udp_send.make_packet(
+                    AUDIO, packet.payload, client_id=i,
+                    origin=packet.client_id)))
+
+        # Members on linked servers are reached through their server, which
+        # is sent a single copy however many of them there are. Each server
+        # mixes and limits its own rooms, so every room is considered here.
+        if routes.trunks and not from_trunk:
+            links = {routes.trunks[i]
+                     for i in routes.rooms.listeners(packet.client_id)
+                     if i in routes.trunks}
+            payload = packet.client_id + packet.payload
+            for link_id in links:
+                addr = listeners.get(link_id)
+                if addr is not None and link_id not in routes.departed:
+                    datagrams.append((addr, self.udp_send.make_packet(
+                        TRUNK_AUDIO, payload, sequence=packet.sequence,
+                        client_id=link_id, origin=link_id)))
+        self.udp_send.send_many(datagrams)
+
+    def _bundle_room_frame(self, routes: RoutingTable, room: int, packet,
+                           datagrams) -> None:
+        """
+        Hold an audio frame for the bundled, keyed, members of a room until
+        the next bundle flush.
+        """
+        with self._bundle_lock:
+            frames = self._room_bundles.setdefault(room, [])
+            if any(i[0] == packet.client_id for i in frames):
+                datagrams.extend(self._make_room_bundle(routes, room, frames))
+                frames = self._room_bundles[room] = []
+            frames.append((packet.client_id, packet.sequence, packet.payload))
+
+    def _make_room_bundle(self, routes: RoutingTable, room: int,
+                          frames) -> list:
+        """
+        Build the single packet carrying a set of held frames to a room, and
+        pair it with the address of each member it should be sent to.
+        Members only ever hear themselves in a bundle of several frames, and
+        discard their own frame from it.
+        """
+        cipher = routes.room_ciphers.get(room)
+        if cipher is None:
+            return []
+        origins = {i[0] for i in frames}
+        members = [i for i in routes.keyed[room]
+                   if i in routes.bundled and origins != {i}]
+        if not members:
+            return []
+
+        if len(frames) == 1:
+            origin, _, payload = frames[0]
+            data = self.udp_send.make_room_packet(cipher, AUDIO, payload, origin)
+        else:
+            data = self.udp_send.make_room_packet(
+                cipher, AUDIO_BUNDLE, pack_bundle(frames))
+        return [(routes.addresses[i], data) for i in members]
+
+    def _bundle_frame(self, client_id: bytes, addr, packet, datagrams) -> None:
+        """
+        Hold an audio frame for a listener until the next bundle flush.
+
+        :param bytes client_id: The listening client
+        :param tuple addr: The UDP address of the listening client
+        :param Packet packet: The audio packet to forward
+        :param list datagrams: Packets to be sent once routing is complete
+        """
+        with self._bundle_lock:
+            frames = self._bundles.setdefault(client_id, [])
+            if any(i[0] == packet.client_id for i in frames):
+                # The speaker has already moved on to their next frame, so
+                # send the bundle early rather than delay it further.
+                datagrams.append((addr, self._make_bundle(client_id, frames)))
+                frames = self._bundles[client_id] = []
+            frames.append((packet.client_id, packet.sequence, packet.payload))
+
+    def _make_bundle(self, client_id: bytes, frames) -> bytes:
+        """
+        Build the packet carrying a set of held frames to a listener.
+        A lone frame is sent as a plain AUDIO packet.
+        """
+        if len(frames) == 1:
+            origin, _, payload = frames[0]
+            return self.udp_send.make_packet(
+                AUDIO, payload, client_id=client_id, origin=origin)
+        return self.udp_send.make_packet(
+            AUDIO_BUNDLE, pack_bundle(frames), client_id=client_id)
+
+    def flush_bundles(self) -> None:
+        """
+        Send every listener the audio frames held for them since the last
+        flush, coalesced into one packet per listener.
+        """
+        with self._bundle_lock:
+            bundles, self._bundles = self._bundles, {}
+            room_bundles, self._room_bundles = self._room_bundles, {}
+
+        routes = self.routes
+        datagrams = [
+            (routes.addresses[i], self._make_bundle(i, frames))
+            for i, frames in bundles.items()
+            if frames and i in routes.addresses and i not in routes.departed
+        ]
+        for room, frames in room_bundles.items():
+            datagrams.extend(self._make_room_bundle(routes, room, frames))
+        self.udp_send.send_many(datagrams)
+
+    def flush_mixes(self) -> None:
+        """
+        Send every member of a mixed room one frame of the room's mix.
+        """
+        routes = self.routes
+        if not routes.mixed:
+            return
+
+        datagrams = []
+        mixes = self.mixer.mix(routes.mixed, routes.addresses)
+        for room, listener, payload in mixes:
+            addr = routes.addresses.get(listener)
+            if addr is not None and listener not in routes.departed:
+                datagrams.append((addr, self.udp_send.make_packet(
+                    AUDIO, payload, client_id=listener,
+                    origin=self.mixer.origin(room))))
+        self.udp_send.send_many(datagrams)
+
+    def bundle_mainloop(self):
+        """
+        Flush bundled and mixed audio once per frame.
+        """
+        while True:
+            time.sleep(self.BUNDLE_INTERVAL)
+            self.flush_routes()
+            self.flush_bundles()
+            self.flush_mixes()
+
+    def _bundle_tick(self) -> None:
+        """
+        Event loop equivalent of :func:`bundle_mainloop`.
+        """
+        # Reschedule first, so that one failed flush does not end them all
+        self.loop.call_later(self.BUNDLE_INTERVAL, self._bundle_tick)
+        self.flush_routes()
+        self.flush_bundles()
+        self.flush_mixes()
@@ -1,11 +1,17 @@
+import functools
 import threading
 import struct
 import time
-from socket import socket
+from socket import socket, gethostbyname
+from typing import Callable, Iterable, Tuple
 
+from .event_loop import EventLoop
+from .router import AudioRouter
 from .socket_controller import SocketController, SocketMode, KeyManager
 from .state_manager import StateManager
-from .recorder import Recorder
+from .timer_wheel import TimerWheel
+from .trunk import TrunkLink, pack_rooms, unpack_rooms
+from .workers import Replicator
 from .opcodes import *
 from .config import *
 from . import loggers
@@ -16,73 +22,246 @@ from .database.orm import DB, Primary
 from .database import Devices, GateConfig, CompConfig
 
 
-class Server:
-    def __init__(self) -> None:
+class Server(AudioRouter):
+    def __init__(self, event_loop: bool=False, workers: int=1,
+                 port: int=TCP_PORT, control_port: int=CONTROL_PORT,
+                 peers: Iterable[Tuple[str, int]]=(),
+                 peer_timeout: float=PEER_TIMEOUT) -> None:
         """
         Create a new server instance.
+
+        :param bool event_loop: Service every socket from a single thread
+                                using an event loop, rather than spawning
+                                threads for each connection.
+        :param int workers: The number of processes to route audio with,
+                            including this one. Each additional worker
+                            shares the UDP port, and is sent a copy of the
+                            routing state as it changes.
+        :param int port: The port to serve clients on, over both TCP and UDP
+        :param int control_port: The port to serve control surfaces on
+        :param peers: The (host, port) of each server to link to. Rooms span
+                      every linked server, so a mesh of servers needs each
+                      pair linked, with one of the pair naming the other.
+        :param float peer_timeout: Seconds a client sending heartbeats may
+                                   go without sending anything before they
+                                   are disconnected
         """
         loggers.createFileLogger(__name__)
 
         self.log = loggers.getLogger(__name__ + '.' + self.__class__.__name__)
 
         # Create our local key manager
-        self.km = KeyManager()
+        super().__init__(KeyManager(), EventLoop() if event_loop else None)
+
+        # Start the worker processes before any state exists to replicate
+        self.replicator = None
+        if workers > 1:
+            self.replicator = Replicator(workers - 1, port)
 
         # Create the 4 sockets the server will need to operate
-        self.sock = SocketController(km=self.km)
-        self.cont_sock = SocketController()
-        self.udp_recv = SocketController(SocketMode.UDP, km=self.km)
-        self.udp_send = SocketController(SocketMode.UDP, km=self.km)
+        self.sock = SocketController(km=self.km, loop=self.loop)
+        self.sock.CAPS |= CAP_ROOM_KEYS | CAP_TRUNK | CAP_RESUME | CAP_HEARTBEAT
+        self.cont_sock = SocketController(loop=self.loop)
+        self.udp_recv = SocketController(SocketMode.UDP, km=self.km,
+                                         loop=self.loop, batched=True)
 
         # Setup a state manager and bind it to the sockets
         self.sm = StateManager(self.sock, self.cont_sock, self.km)
-        # Setup a recorder
-        self.recorder = Recorder()
+        self.rooms = self.sm.rooms
+        # Workers are sent each change to the rooms, rather than the rooms
+        if self.replicator is not None:
+            self.rooms.track_changes()
+        self._remote_sent = None
+        self.sm.rooms_hook = self.rooms_changed
+        self.sm.room_key_hook = self.room_key_changed
 
         # Bind all the sockets to their respective hosts and ports
-        self.udp_recv.bind('', TCP_PORT)
+        self.port = port
+        self.udp_recv.bind('', port, reuse_port=workers > 1)
         self.udp_recv.start()
 
-        self.sock.bind(HOST, TCP_PORT)
+        self.sock.bind(HOST, port)
         self.sock.listen(10)
 
-        self.cont_sock.bind(HOST, CONTROL_PORT)
+        self.cont_sock.bind(HOST, control_port)
         self.cont_sock.listen(10)
-        self.cont_udp_port = None
 
         self.sock.start()
         self.cont_sock.start()
 
-        self.udp_lock = threading.Lock()
-        self.udp_listeners = {}
+        # When each client sending heartbeats was last heard from. Rather
+        # than a timer each, every client is checked on by one timer wheel.
+        self.peer_timeout = peer_timeout
+        self.last_seen = {}
+        self.wheel = TimerWheel()
 
         # Bind event hooks to the controller
         self.sock.tcp_lost_hook = self.tcp_lost
         self.sock.new_tcp_hook = self.new_tcp
 
+        # On an event loop, packets are handled as soon as they arrive rather
+        # than being collected by the mainloop threads.
+        if self.loop is not None:
+            self.sock.packet_hook = lambda *pkt: self.handle_tcp(pkt)
+            self.cont_sock.packet_hook = lambda *pkt: self.handle_cont(pkt)
+            self.udp_recv.packet_hook = lambda *pkt: self.handle_udp(pkt)
+            self.loop.call_later(self.BUNDLE_INTERVAL, self._bundle_tick)
+            self.loop.call_later(self.wheel.tick, self._wheel_tick)
+
+        # Links to other servers, whether we made them or they did. Links
+        # made by the other server are reached through `sock`, so map to
+        # `None`. Each link is sent our rooms whenever they change.
+        self.links = {}
+        self._synced = {}
+        for host, peer_port in peers:
+            link = TrunkLink(host, peer_port, self.km)
+            link.up_hook = self._on_loop(functools.partial(self.link_up, link))
+            link.down_hook = self._on_loop(self.link_down)
+            link.packet_hook = self._on_loop(self.handle_trunk)
+            link.start()
+
+    def _on_loop(self, callback: Callable) -> Callable:
+        """
+        Wrap a callback made from another thread, so that on an event loop it
+        is run by the loop instead.
+        """
+        if self.loop is None:
+            return callback
+        return functools.partial(self.loop.call_soon_threadsafe, callback)
+
     def tcp_lost(self, sock: socket, _) -> None:
         """
         A handler that is bound to a socket controller, called when a TCP
-        client disconnects. This function grabs the udp mutex, then clears out
-        any now-unneeded state for that client.
+        client disconnects. This function clears out any now-unneeded state
+        for that client. Only removing them from the routing table takes the
+        udp mutex, so audio is never held up by the database.
         """
-        with self.udp_lock:
-            client_id = self.km.id_from_sock(sock)
-            if not client_id:
-                # Not sure who this socket was, ignore them.
-                return
+        client_id = self.km.id_from_sock(sock)
+        if not client_id:
+            # Not sure who this socket was, ignore them.
+            return
+        if client_id in self.links:
+            self.link_down(client_id)
+            return
+
+        self.last_seen.pop(client_id, None)
+        self.wheel.cancel(client_id)
+        self.forget_listener(client_id)
+        self.km.forget(client_id)
+        self.replicate('forget', client_id)
 
-            if client_id in self.udp_listeners:
-                del self.udp_listeners[client_id]
-            self.km.forget(client_id)
+        # Log the event
+        target_device = Devices.select(deviceID=client_id.decode('latin-1'))
+        if target_device:
+            history.insert(target_device, history.EVENT_DCON)
 
-            # Log the event
-            target_device = Devices.select(deviceID=client_id.decode('latin-1'))
-            if target_device:
-                history.insert(target_device, history.EVENT_DCON)
+        # Inform the control surface a client has left.
+        self.cont_sock.send_packet(CLIENT_LEAVE, client_id)
+
+    def rooms_changed(self) -> None:
+        """
+        A hook bound to the state manager, called when room membership
+        changes. Everything depending on the rooms is brought up to date on
+        the next tick, by :func:`flush_routes`.
+        """
+        self.routes_changed()
+
+    def flush_routes(self) -> None:
+        # Keys are rotated first, so that the table is built with them
+        self.sm.flush_room_keys()
+        if not self._routes_stale:
+            return
+        self.remote_members = remote = self.sm.remote
+        super().flush_routes()
+
+        if self.replicator is not None:
+            # The remote members are replaced, never modified, when they
+            # change
+            changed = remote is not self._remote_sent
+            self._remote_sent = remote
+            changes = self.rooms.take_changes()
+            if changes or changed:
+                self.replicate('room_changes', changes,
+                               remote if changed else None)
+        self.sync_trunks()
+
+    def link_up(self, link: TrunkLink, link_id: bytes) -> None:
+        """
+        A hook bound to each trunk we make, called once the other server has
+        accepted it.
+        """
+        self.links[link_id] = link
+        _, __, key, iv = self.km.registered[link_id]
+        self.replicate('register', link_id, key, iv,
+                       self.km.get_caps(link_id), False)
+
+        # The other server receives audio on the port it serves TCP on
+        addr = (gethostbyname(link.host), link.port)
+        self.register_listener(link_id, addr, 0)
+        self.replicate('listener', link_id, addr, 0)
+        # Tell the other server where to send its audio. It then sends its
+        # rooms, and we send ours.
+        link.send_packet(REGISTER_UDP, struct.pack('!H', self.port))
+        self.sync_trunks()
+
+    def link_down(self, link_id: bytes) -> None:
+        """
+        Called when a link to another server is lost, from either end. The
+        other server's clients leave every room.
+        """
+        self.links.pop(link_id, None)
+        self._synced.pop(link_id, None)
+        self.forget_listener(link_id)
+        self.km.forget(link_id)
+        self.replicate('forget', link_id)
+        self.sm.set_remote_rooms(link_id, {})
+
+    def send_trunk(self, link_id: bytes, opcode: int, payload: bytes) -> None:
+        """
+        Send a packet to a linked server.
+        """
+        link = self.links[link_id]
+        try:
+            if link is None:
+                self.sock.send_packet(opcode, payload, to=link_id,
+                                      client_id=link_id)
+            else:
+                link.send_packet(opcode, payload)
+        except OSError as e:
+            self.log.warning(f'Failed to send to linked server: {e}')
+
+    def sync_trunks(self) -> None:
+        """
+        Send the rooms of our own clients to every linked server which does
+        not already have them.
+        """
+        if not self.links:
+            return
+        payload = pack_rooms(self.sm.local_rooms())
+        for link_id in list(self.links):
+            if self._synced.get(link_id) != payload:
+                self._synced[link_id] = payload
+                self.send_trunk(link_id, TRUNK_ROOMS, payload)
+
+    def handle_trunk(self, link_id: bytes, packet) -> None:
+        """
+        Handle a single packet received from a linked server.
+        """
+        if packet.opcode == TRUNK_ROOMS:
+            try:
+                members = unpack_rooms(packet.payload)
+            except ValueError as e:
+                self.log.warning(f'Invalid TRUNK_ROOMS packet: {e}')
+                return
+            self.sm.set_remote_rooms(link_id, members)
 
-            # Inform the control surface a client has left.
-            self.cont_sock.send_packet(CLIENT_LEAVE, client_id)
+    def room_key_changed(self, room: int, epoch: int, key: bytes) -> None:
+        """
+        A hook bound to the state manager, called when a room's media key is
+        rotated or discarded.
+        """
+        self.routes_changed()
+        self.replicate('room_key', room, epoch, key)
 
     def new_tcp(self, sock: socket, addr, client_id: bytes) -> None:
         """
@@ -90,6 +269,20 @@ class Server:
         their handshake. This function is responsible for saving and loading
         data from the database to retain state between sessions.
         """
+        # Workers need the client's keys to handle their audio
+        _, __, key, iv = self.km.registered[client_id]
+        self.replicate('register', client_id, key, iv, self.km.get_caps(client_id))
+
+        if self.km.get_caps(client_id) & CAP_TRUNK:
+            # Another server linking to us, which has nothing to restore.
+            # It introduces itself with REGISTER_UDP.
+            self.links[client_id] = None
+            return
+
+        if self.km.get_caps(client_id) & CAP_HEARTBEAT:
+            self.last_seen[client_id] = time.monotonic()
+            self.wheel.schedule(client_id, self.peer_timeout)
+
         # TODO: This!
         #       This should be based off the pubkey.
         target_device = Devices.select(deviceID=client_id.decode('latin-1'))
@@ -112,7 +305,7 @@ class Server:
 
             # Register the device to the database
             Devices.insert(target_device)
-        else:
+        elif client_id not in self.sm.resumed:
             self.log.debug('Restoring device config from database.')
             # Restore all the configuation from the located device
             dev = target_device[0]
@@ -130,183 +323,170 @@ class Server:
         # Log the event
         history.insert(target_device, history.EVENT_CONN)
         
-    def udp_mainloop(self):
+    def cont_mainloop(self):
         """
-        The mainloop for UDP sections of the server. This handles mainly
-        routing of audio between mutliple clients.
+        The mainloop responsible for interactions with the control surface.
         """
         while True:
-            pkt = self.udp_recv.get_packet(True)
-            self.log.debug(f'UDP packet from {pkt[1]}: {pkt[2].opcode}')
-            if pkt[2].opcode == AUDIO:
-                # Try feed the packet to the recorder. This may fail if there
-                # is a disk IO failure, or if the audio payload is malformed.
-                try:
-                    self.recorder.feed(pkt[2].client_id, pkt[2].payload)
-                except Exception as e:
-                    self.log.warning(f'Failed to record audio for {pkt[2].client_id}: {e}')
-
-                # Grab the UDP mutex for a short period
-                with self.udp_lock:
-                    listeners = dict(self.udp_listeners)
-                    # Locate all the clients in the same room
-                    can_listen = set(sum([i for i in self.sm.rooms
-                                          if pkt[2].client_id in i], []))
-                    # If a control surface is attached, forward the packet
-                    # there, too.
-                    if self.cont_udp_port is not None:
-                        can_listen.add(self.cont_udp_port)
-
-                    # Retransmit the audio to all clients allowed to listen.
-                    for i in can_listen:
-                        if pkt[2].client_id != i and i in listeners:
-                            self.udp_send.send_packet(
-                                AUDIO, pkt[2].payload, to=listeners[i],
-                                client_id=i, origin=pkt[2].client_id)
+            self.handle_cont(self.cont_sock.get_packet(True))
 
-    def cont_mainloop(self):
+    def handle_cont(self, pkt) -> None:
         """
-        The mainloop responsible for interactions with the control surface.
+        Handle a single packet received from the control surface.
         """
-        while True:
-            pkt = self.cont_sock.get_packet(True)
-
-            self.log.debug(f'CONT packet from {pkt[1]}: {pkt[2].opcode}')
-            if pkt[2].opcode == SET_GATE:
-                try:
-                    # Decode the parameters from the payload
-                    client_id = pkt[2].payload[:16]
-                    attack, hold, release, threshold, nonce = (
-                        struct.unpack('!4lH', pkt[2].payload[16:])
+        self.log.debug(f'CONT packet from {pkt[1]}: {pkt[2].opcode}')
+        if pkt[2].opcode == SET_GATE:
+            try:
+                # Decode the parameters from the payload
+                client_id = pkt[2].payload[:16]
+                attack, hold, release, threshold, nonce = (
+                    struct.unpack('!4lH', pkt[2].payload[16:])
+                )
+                attack = max(0, min(65535, attack))
+                hold = max(0, min(65535, hold))
+                release = max(0, min(65535, release))
+                threshold = max(0, min(65535, threshold))
+
+                # Locate the targeted client
+                sock = self.km.sock_from_id(client_id)
+                if sock is not None:
+                    # Inform the client of the change
+                    self.sock.send_packet(
+                        SET_GATE,
+                        pkt[2].payload[16:],
+                        to=sock,
+                        client_id=client_id
                     )
-                    attack = max(0, min(65535, attack))
-                    hold = max(0, min(65535, hold))
-                    release = max(0, min(65535, release))
-                    threshold = max(0, min(65535, threshold))
-
-                    # Locate the targeted client
-                    sock = self.km.sock_from_id(client_id)
-                    if sock is not None:
-                        # Inform the client of the change
-                        self.sock.send_packet(
-                            SET_GATE,
-                            pkt[2].payload[16:],
-                            to=sock,
-                            client_id=client_id
-                        )
-                        # Update the state manager
-                        self.sm.set_gate(
-                            client_id, (attack, hold, release, threshold)
-                        )
-                    # Inform the control surface of the success state
-                    self.cont_sock.send_packet(
-                        SET_FAIL if sock is None else SET_ACK,
-                        struct.pack('!H', nonce), to=pkt[0])
-                except struct.error:
-                    self.log.warning('Failed to decode CONT packet')
-            elif pkt[2].opcode == SET_COMP:
-                try:
-                    # Dedcode the parameters from the payload
-                    client_id = pkt[2].payload[:16]
-                    attack, release, threshold, nonce = (
-                        struct.unpack('!3lH', pkt[2].payload[16:])
+                    # Update the state manager
+                    self.sm.set_gate(
+                        client_id, (attack, hold, release, threshold)
                     )
-                    attack = max(0, min(65535, attack))
-                    release = max(0, min(65535, release))
-                    threshold = max(0, min(65535, threshold))
-
-                    # Locate the targeted client
-                    sock = self.km.sock_from_id(client_id)
-                    if sock is not None:
-                        # Inform the client of the changes
-                        self.sock.send_packet(
-                            SET_COMP,
-                            pkt[2].payload[16:],
-                            to=sock,
-                            client_id=client_id
-                        )
-                        # Update the state manager
-                        self.sm.set_compressor(
-                            client_id,
-                            (attack, release, threshold)
-                        )
-                    # Inform the control surface of the success state
-                    self.cont_sock.send_packet(
-                        SET_FAIL if sock is None else SET_ACK,
-                        struct.pack('!H', nonce), to=pkt[0])
-                except struct.error:
-                    self.log.warning('Failed to decode CONT packet')
-            elif pkt[2].opcode == SET_NAME:
-                # Extract the name from the payload
+                # Inform the control surface of the success state
+                self.cont_sock.send_packet(
+                    SET_FAIL if sock is None else SET_ACK,
+                    struct.pack('!H', nonce), to=pkt[0])
+            except struct.error:
+                self.log.warning('Failed to decode CONT packet')
+        elif pkt[2].opcode == SET_COMP:
+            try:
+                # Dedcode the parameters from the payload
                 client_id = pkt[2].payload[:16]
-                # Update the state manager
-                self.sm.set_name(
-                    client_id, pkt[2].payload[16:271].decode('latin-1')
+                attack, release, threshold, nonce = (
+                    struct.unpack('!3lH', pkt[2].payload[16:])
                 )
-            elif pkt[2].opcode == SET_ROOMS:
-                # Decode the list from the payload
-                client_id = pkt[2].payload[:16]
-                room_n = pkt[2].payload[16]
-                rooms = pkt[2].payload[17: 17 + room_n]
-                # Update the state manager
-                self.sm.set_rooms(client_id, rooms)
-
-                # Log the event
-                target_device = Devices.select(deviceID=client_id.decode('latin-1'))
-                if target_device:
-                    history.insert(target_device, history.EVENT_TEXT, 'Moved rooms')
-            elif pkt[2].opcode == START_RECORD:
-                # Decode the payload
-                client_id = pkt[2].payload[:16]
-                self.recorder.recording.add(client_id)
-                self.recorder.rec_start[client_id] = time.time()
-
-                # Log the event
-                target_device = Devices.select(deviceID=client_id.decode('latin-1'))
-                if target_device:
-                    history.insert(target_device, history.EVENT_TEXT, 'Recording started')
-            elif pkt[2].opcode == STOP_RECORD:
-                # Decode the payload
-                client_id = pkt[2].payload[:16]
-                if client_id in self.recorder.recording:
-                    # Stop recording the client
-                    self.recorder.recording.remove(client_id)
-                    if client_id in self.recorder.recordings:
-                        # Write any remaining buffer to disk
-                        self.recorder.recordings[client_id].flush()
-                        self.recorder.recordings[client_id].finish()
-                        # Clean up after the recorder
-                        del self.recorder.recordings[client_id]
-                        del self.recorder._decoders[client_id]
-                        del self.recorder._counts[client_id]
-                
-                # Log the event
-                target_device = Devices.select(deviceID=client_id.decode('latin-1'))
-                if target_device:
-                    history.insert(target_device, history.EVENT_TEXT, 'Recording stopped')
-            elif pkt[2].opcode == GET_RECORD:
-                # Decode the payload
-                client_id = pkt[2].payload[:16]
-                if client_id not in self.recorder.recording:
-                    # Send a dummy message
-                    self.cont_sock.send_packet(GET_RECORD, b'Not recording', to=pkt[0])
-                else:
-                    # Convert seconds into a nicer format
-                    rec_len = time.time() - self.recorder.rec_start.get(client_id, time.time())
-                    ms = int(round(rec_len % 1, 3) * 1000)
-                    mi, se = divmod(int(rec_len), 60)
-                    hr, mi = divmod(mi, 60)
-                    dur = f'{hr:02}:{mi:02}:{se:02}.{ms:0<3}'.encode()
-                    # Respond to the client
-                    self.cont_sock.send_packet(GET_RECORD, b'Recording.. ' + dur, to=pkt[0])
-            elif pkt[2].opcode == REGISTER_UDP:
-                # Register the UDP recieve port for the control surface.
-                try:
-                    self.cont_udp_port = struct.unpack('!H', pkt[2].payload)[0]
-                except struct.error:
-                    self.log.warning(
-                        'Invalid packet when registering UDP port'
+                attack = max(0, min(65535, attack))
+                release = max(0, min(65535, release))
+                threshold = max(0, min(65535, threshold))
+
+                # Locate the targeted client
+                sock = self.km.sock_from_id(client_id)
+                if sock is not None:
+                    # Inform the client of the changes
+                    self.sock.send_packet(
+                        SET_COMP,
+                        pkt[2].payload[16:],
+                        to=sock,
+                        client_id=client_id
+                    )
+                    # Update the state manager
+                    self.sm.set_compressor(
+                        client_id,
+                        (attack, release, threshold)
                     )
+                # Inform the control surface of the success state
+                self.cont_sock.send_packet(
+                    SET_FAIL if sock is None else SET_ACK,
+                    struct.pack('!H', nonce), to=pkt[0])
+            except struct.error:
+                self.log.warning('Failed to decode CONT packet')
+        elif pkt[2].opcode == SET_NAME:
+            # Extract the name from the payload
+            client_id = pkt[2].payload[:16]
+            # Update the state manager
+            self.sm.set_name(
+                client_id, pkt[2].payload[16:271].decode('latin-1')
+            )
+        elif pkt[2].opcode == SET_ROOMS:
+            # Decode the list from the payload
+            client_id = pkt[2].payload[:16]
+            room_n = pkt[2].payload[16]
+            rooms = pkt[2].payload[17: 17 + room_n]
+            # Update the state manager
+            self.sm.set_rooms(client_id, rooms)
+
+            # Log the event
+            target_device = Devices.select(deviceID=client_id.decode('latin-1'))
+            if target_device:
+                history.insert(target_device, history.EVENT_TEXT, 'Moved rooms')
+        elif pkt[2].opcode == SET_ROOM_MODE:
+            try:
+                room, mode = struct.unpack('!BB', pkt[2].payload[:2])
+            except struct.error:
+                self.log.warning('Failed to decode CONT packet')
+            else:
+                self.set_room_mode(room, mode)
+                self.replicate('room_mode', room, mode)
+                self.sm.set_room_mode(room, mode)
+        elif pkt[2].opcode == SET_SPEAKERS:
+            # Decode the room, followed by the id of each speaker
+            payload = pkt[2].payload
+            if not payload or (len(payload) - 1) % 16:
+                self.log.warning('Failed to decode CONT packet')
+                return
+            speakers = [payload[i:i + 16] for i in range(1, len(payload), 16)]
+            self.sm.set_speakers(payload[0], speakers)
+        elif pkt[2].opcode == SET_ROOM_TOPK:
+            try:
+                room, k = struct.unpack('!BB', pkt[2].payload[:2])
+            except struct.error:
+                self.log.warning('Failed to decode CONT packet')
+            else:
+                self.set_room_topk(room, k)
+                self.replicate('room_topk', room, k)
+        elif pkt[2].opcode == START_RECORD:
+            # Decode the payload
+            client_id = pkt[2].payload[:16]
+            self.recorder.start(client_id)
+            self.replicate('record', client_id, True)
+
+            # Log the event
+            target_device = Devices.select(deviceID=client_id.decode('latin-1'))
+            if target_device:
+                history.insert(target_device, history.EVENT_TEXT, 'Recording started')
+        elif pkt[2].opcode == STOP_RECORD:
+            # Decode the payload
+            client_id = pkt[2].payload[:16]
+            self.recorder.stop(client_id)
+            self.replicate('record', client_id, False)
+
+            # Log the event
+            target_device = Devices.select(deviceID=client_id.decode('latin-1'))
+            if target_device:
+                history.insert(target_device, history.EVENT_TEXT, 'Recording stopped')
+        elif pkt[2].opcode == GET_RECORD:
+            # Decode the payload
+            client_id = pkt[2].payload[:16]
+            if client_id not in self.recorder.recording:
+                # Send a dummy message
+                self.cont_sock.send_packet(GET_RECORD, b'Not recording', to=pkt[0])
+            else:
+                # Convert seconds into a nicer format
+                rec_len = time.time() - self.recorder.rec_start.get(client_id, time.time())
+                ms = int(round(rec_len % 1, 3) * 1000)
+                mi, se = divmod(int(rec_len), 60)
+                hr, mi = divmod(mi, 60)
+                dur = f'{hr:02}:{mi:02}:{se:02}.{ms:0<3}'.encode()
+                # Respond to the client
+                self.cont_sock.send_packet(GET_RECORD, b'Recording.. ' + dur, to=pkt[0])
+        elif pkt[2].opcode == REGISTER_UDP:
+            # Register the UDP recieve port for the control surface.
+            try:
+                self.cont_udp_port = struct.unpack('!H', pkt[2].payload)[0]
+                self.replicate('cont_udp_port', self.cont_udp_port)
+            except struct.error:
+                self.log.warning(
+                    'Invalid packet when registering UDP port'
+                )
 
     def mainloop(self):
         """
@@ -314,26 +494,111 @@ class Server:
         register UDP connections, as encryption is handler by socket
         controllers.
         """
+        if self.loop is not None:
+            # Every socket is serviced by the loop, so no threads are needed
+            self.loop.run()
+            return
+
         threading.Thread(target=self.udp_mainloop, daemon=True).start()
         threading.Thread(target=self.cont_mainloop, daemon=True).start()
+        threading.Thread(target=self.bundle_mainloop, daemon=True).start()
+        threading.Thread(target=self.wheel_mainloop, daemon=True).start()
 
         while True:
-            pkt = self.sock.get_packet(True)
+            self.handle_tcp(self.sock.get_packet(True))
 
-            self.log.debug(f'TCP packet from {pkt[1]}: {pkt[2].opcode}')
-            if pkt[2].opcode == REGISTER_UDP:
-                # Attempt to decode the packet
-                try:
-                    udp_port = struct.unpack('!H', pkt[2].payload)[0]
+    def wheel_mainloop(self) -> None:
+        """
+        Turn the timer wheel, disconnecting clients as they go quiet.
+        """
+        while True:
+            time.sleep(self.wheel.tick)
+            self.check_peers()
 
-                    self.udp_listeners[pkt[2].client_id] = (
-                        pkt[1][0],  # Source IP
-                        udp_port
-                    )
-                except struct.error:
-                    self.log.warning(
-                        'Invalid packet when registering UDP port'
-                    )
+    def _wheel_tick(self) -> None:
+        """
+        Event loop equivalent of :func:`wheel_mainloop`.
+        """
+        self.loop.call_later(self.wheel.tick, self._wheel_tick)
+        self.check_peers()
+
+    def seen(self, client_id: bytes) -> None:
+        """
+        Note that a client has been heard from. Their timer is left alone,
+        and only pushed back once it fires, so this is cheap enough to call
+        for every packet.
+        """
+        if client_id in self.last_seen:
+            self.last_seen[client_id] = time.monotonic()
+
+    def check_peers(self) -> None:
+        """
+        Disconnect every client sending heartbeats who has not been heard
+        from in `peer_timeout` seconds. Their connection may well still look
+        open, if it was lost without being closed.
+        """
+        now = time.monotonic()
+        for client_id in self.wheel.advance(now):
+            seen = self.last_seen.get(client_id)
+            if seen is None:
+                continue
+            if seen + self.peer_timeout > now:
+                # They have been heard from since the timer was set
+                self.wheel.schedule(client_id, seen + self.peer_timeout - now)
+                continue
+
+            self.log.warning(f'No heartbeat from {client_id}, disconnecting')
+            sock = self.km.sock_from_id(client_id)
+            if sock is not None:
+                self.sock.drop(sock)
+
+    def handle_udp(self, pkt) -> None:
+        self.seen(pkt[2].client_id)
+        super().handle_udp(pkt)
+
+    def handle_tcp(self, pkt) -> None:
+        """
+        Handle a single packet received from a client's TCP connection.
+        """
+        self.log.debug(f'TCP packet from {pkt[1]}: {pkt[2].opcode}')
+        self.seen(pkt[2].client_id)
+        if pkt[2].opcode == HEARTBEAT:
+            # Let the client know we are still here too
+            self.sock.send_packet(HEARTBEAT, b'', to=pkt[0],
+                                  client_id=pkt[2].client_id)
+        elif pkt[2].opcode == REGISTER_UDP:
+            # Attempt to decode the packet. The port may be followed by a
+            # byte of flags, which older clients do not send.
+            try:
+                udp_port = struct.unpack('!H', pkt[2].payload[:2])[0]
+                flags = pkt[2].payload[2] if len(pkt[2].payload) > 2 else 0
+
+                addr = (
+                    pkt[1][0],  # Source IP
+                    udp_port
+                )
+                self.register_listener(pkt[2].client_id, addr, flags)
+                self.replicate('listener', pkt[2].client_id, addr, flags)
+            except struct.error:
+                self.log.warning(
+                    'Invalid packet when registering UDP port'
+                )
+                return
+            if pkt[2].client_id in self.links:
+                # A newly linked server, which is now ready for our rooms
+                self._synced.pop(pkt[2].client_id, None)
+                self.sync_trunks()
+        elif pkt[2].client_id in self.links:
+            self.handle_trunk(pkt[2].client_id, pkt[2])
+
+    def replicate(self, op: str, *args) -> None:
+        """
+        Send a change in routing state to any worker processes.
+
+        :param str op: The name of the change, see :class:`Worker`
+        """
+        if self.replicator is not None:
+            self.replicator.publish(op, *args)
 
 
 if __name__ == '__main__':
@@ -3,19 +3,33 @@ import threading
 import time
 from socket import (
     socket, AF_INET, SOCK_STREAM, SOCK_DGRAM, SOL_SOCKET, SO_REUSEADDR,
+    SHUT_RDWR,
 )
-from typing import Union, Optional, Tuple, Callable
+try:
+    from socket import SO_REUSEPORT
+except ImportError:
+    SO_REUSEPORT = None
+from typing import Union, Optional, Tuple, Callable, List
 
 from Crypto import Random
 from Crypto.Cipher import PKCS1_v1_5, AES
 from Crypto.Hash import SHA
 from Crypto.PublicKey import RSA
-from Crypto.Util.Padding import pad, unpad
 
 from . import loggers
-from .key_manager import KeyManager
+from .demux import Channel
+from .event_loop import EventLoop, EVENT_READ, EVENT_WRITE
+from .handshake import (
+    HandshakePool, HandshakeFailed, X25519_KEY_SIZE, RESUME_RANDOM_SIZE,
+    x25519_key, x25519_exchange, derive_keys, open_client_id,
+)
+from .key_manager import KeyManager, RoomCipher
+from .key_pool import pool as key_pool
+from .tickets import TicketIssuer
 from .opcodes import *
-from .util.packets import Packet, PacketError
+from .util import mmsg
+from .util.framer import PacketFramer
+from .util.packets import Packet, PacketError, BufferPool, ROOM_HEADER
 
 
 Address = Tuple[str, int]
@@ -26,25 +40,42 @@ class SocketMode(enum.IntEnum):
     UDP = 1
 
 
-class HandshakeFailed(Exception):
-    """
-    Raised when a connected client initiates a handshake, then proceeds to fail
-    the handshake.
-    """
-    pass
-
-
 class SocketController:
-    # The maximum size of the packet queue before the controller begins to
-    # discard unprocessed packets. This should be sufficiently large that
-    # packet loss is minimized, however small enough that the program does not
-    # lock up when a single thread is failing to flush.
+    # The maximum number of control packets queued before the controller
+    # begins to discard unprocessed packets. This should be sufficiently large
+    # that packet loss is minimized, however small enough that the program
+    # does not lock up when a single thread is failing to flush.
     MAX_QUEUE = 10
-
-    def __init__(self, mode: SocketMode=SocketMode.TCP, km: KeyManager=None) -> None:
+    # Audio is queued seperately, so that it can never evict control packets.
+    # Rather than being limited by count, queued audio is discarded once it
+    # is older than MAX_AUDIO_AGE seconds, as it would only be played late.
+    # MAX_AUDIO_QUEUE is simply a hard upper bound on memory use.
+    MAX_AUDIO_QUEUE = 64
+    MAX_AUDIO_AGE = 0.06
+
+    # The largest datagram that will be received
+    MAX_DATAGRAM = 4096
+    # The most datagrams read by one system call, when batching is enabled
+    RECV_BATCH = 32
+    # The most datagrams written by one system call by :func:`send_many`
+    SEND_BATCH = 64
+
+    # The capabilities offered during the handshake
+    CAPS = CAP_AEAD | CAP_X25519
+
+    def __init__(self, mode: SocketMode=SocketMode.TCP, km: KeyManager=None,
+                 loop: Optional[EventLoop]=None, batched: bool=False) -> None:
         self.log = loggers.getLogger(__name__ + '.' + self.__class__.__name__)
         self._mode = mode
 
+        # When an event loop is provided, the controller never spawns any
+        # threads. Instead all of its sockets are serviced by the loop.
+        self.loop = loop
+        # Servers step each client's handshake in here as packets arrive
+        self.handshakes = HandshakePool(self)
+        self._framers = {}
+        self._out_buffers = {}
+
         self.km = km or KeyManager()
         self.state_manager = None
         self.cont_state_manager = None
@@ -55,14 +86,23 @@ class SocketController:
         else:
             self._sock = socket(AF_INET, SOCK_DGRAM)
 
-        self._queue_lock = threading.Lock()
-        self._queue_ready = threading.Event()
-        self._pa_queue_lock = threading.Lock()
-        self._pa_queue_ready = threading.Event()
-        # NOTE: queue.Queue doesn't work here because of not being able to
-        #       pop an item off based on a criteria.
-        self._queue = []
-        self._pa_queue = []
+        # Received packets are queued until collected. Pre-auth sockets use a
+        # seperate queue so that handshake packets are never collected by a
+        # mainloop.
+        self._queue = Channel(
+            self.MAX_QUEUE, self.MAX_AUDIO_QUEUE, self.MAX_AUDIO_AGE
+        )
+        self._pa_queue = Channel(self.MAX_QUEUE, 1)
+
+        # Datagrams are read straight into pooled buffers, and parsed in place
+        self._pool = BufferPool(self.MAX_DATAGRAM)
+        # Where supported, batched UDP sockets read many datagrams at once
+        self._batch = None
+        if batched and mode == SocketMode.UDP and mmsg.available:
+            self._batch = mmsg.DatagramBatch(self.RECV_BATCH, self.MAX_DATAGRAM)
+        self._sender = None
+        if mode == SocketMode.UDP and mmsg.available:
+            self._sender = mmsg.DatagramSender(self.SEND_BATCH)
 
         # Server stuff
         self.server = False
@@ -76,19 +116,25 @@ class SocketController:
         self.use_special_encryption = False
         self.send_address = None
         self.client_id = None
+        # Our X25519 key pair, and the session being resumed, while waiting
+        # on the reply to our HELLO
+        self._hello = None
 
-        # If we are a TCP socket, we are going to need a pair of keys to use
-        # during the initial handshake.
-        if self.mode == SocketMode.TCP:
-            self.log.info('Generating RSA key')
-            self.key = RSA.generate(1024, Random.new().read)
-            self.pub_key = self.key.publickey()
-            self.log.info('Key gen finished')
+        # Clients need a pair of keys to use during the initial handshake.
+        # Servers never use theirs, so the key is only taken from the key
+        # pool once it is first used.
+        self._key = None
+        # Servers issue resumption tickets to clients which accept them
+        self.tickets = TicketIssuer()
 
         self.sequence = 0
 
     # Pass-through configuration
-    def bind(self, host: str, port: int) -> None:
+    def bind(self, host: str, port: int, reuse_port: bool=False) -> None:
+        # Sockets sharing a port through SO_REUSEPORT have incoming datagrams
+        # spread between them by the kernel, hashed on the source address.
+        if reuse_port:
+            self._sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
         self._sock.bind((host, port))
 
     def connect(self, host: str, port: int) -> None:
@@ -105,7 +151,19 @@ class SocketController:
         return self._sock.accept()
 
     def close(self) -> None:
+        """
+        Close the socket. Threads reading from it, or waiting on its packets,
+        are woken and exit.
+        """
+        try:
+            # Closing alone does not wake a thread blocked reading
+            self._sock.shutdown(SHUT_RDWR)
+        except OSError:
+            # It was never connected
+            pass
         self._sock.close()
+        self._queue.close()
+        self._pa_queue.close()
 
     def getsockname(self) -> Address:
         return self._sock.getsockname()
@@ -120,6 +178,27 @@ class SocketController:
     def tcp_lost_hook(self, sock: socket, addr: Address) -> None:
         pass
 
+    def packet_hook(self, sock: socket, addr: Address, packet: Packet) -> None:
+        """
+        Called for every packet received once the sender has authenticated.
+        By default the packet is pushed onto the queue to be collected with
+        :func:`get_packet`. When running on an event loop, overriding this
+        hook allows packets to be handled as they arrive instead.
+        """
+        self._queue.put((sock, addr, packet))
+
+    def packets_hook(self, items: List[Tuple[socket, Address, Packet]]) -> None:
+        """
+        Called with every packet from a single batched receive. If
+        :func:`packet_hook` has been overridden, each packet is passed to it
+        in turn. Otherwise the whole batch is queued at once.
+        """
+        if getattr(self.packet_hook, '__func__', None) is SocketController.packet_hook:
+            self._queue.put_many(items)
+            return
+        for item in items:
+            self.packet_hook(*item)
+
     # Handlers
     def tcp_lost(self, sock: socket, addr: Address) -> None:
         """
@@ -131,9 +210,15 @@ class SocketController:
         :param tuple addr: The address of the disconnecting client
         """
         if self.server:
-            self.clients.remove((sock, addr))
+            if (sock, addr) in self.clients:
+                self.clients.remove((sock, addr))
             if sock in self._auth_clients:
                 self._auth_clients.remove(sock)
+        self.handshakes.forget(sock)
+        if self.loop is not None:
+            self.loop.unregister(sock)
+            self._framers.pop(sock, None)
+            self._out_buffers.pop(sock, None)
 
             # if addr in self.client_aes:
             #     del self.client_aes[addr]
@@ -143,6 +228,28 @@ class SocketController:
             self.state_manager.lost(sock, addr)
         self.tcp_lost_hook(sock, addr)
 
+        if self.loop is not None:
+            # Nothing else holds on to the socket, so release it now.
+            sock.close()
+
+    def drop(self, sock: socket, addr: Optional[Address]=None) -> None:
+        """
+        Disconnect a client, cleaning up after them as if they had left.
+
+        :param socket sock: The socket(5) of the client
+        :param tuple addr: The address of the client, if known
+        """
+        if self.loop is not None:
+            if addr is None:
+                addr = next((a for s, a in self.clients if s is sock), None)
+            self.tcp_lost(sock, addr)
+            return
+        # The client's reader thread notices, and cleans up after them
+        try:
+            sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
     def send(self, data: bytes,
              to: Optional[Union[socket, Address]]=None) -> Optional[int]:
         """
@@ -158,17 +265,35 @@ class SocketController:
             if to is None:
                 if self.server:
                     for i in self.clients:
-                        i[0].send(data)
+                        self._write(i[0], data)
                     return
                 else:
-                    return self._sock.send(data)
+                    return self._write(self._sock, data)
             if not isinstance(to, socket):
                 to = self.km.sock_from_id(to)
-            return to.send(data)
+            return self._write(to, data)
 
         addr = to or self.send_address
         self._sock.sendto(data, addr)
 
+    def send_many(self, datagrams: List[Tuple[Address, bytes]]) -> None:
+        """
+        Transmit a batch of packets from a UDP socket, each to its own
+        address. Where supported, the whole batch is handed to the kernel
+        with a single system call, rather than one call per packet.
+
+        :param list datagrams: (address, packet) pairs to send, where each
+                               packet is any bytes-like object
+        """
+        if not datagrams:
+            return
+        if self._sender is not None:
+            self._sender.send(self._sock, datagrams)
+            return
+
+        for addr, data in datagrams:
+            self._sock.sendto(data, addr)
+
     def start(self) -> None:
         """
         Initialise and begin this controller. This function spawns a number of
@@ -177,6 +302,23 @@ class SocketController:
         # Make sure we don't accidentally hog a port
         self._sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
 
+        if self.server and self.mode == SocketMode.TCP:
+            self.handshakes.start()
+
+        if self.loop is not None:
+            self._sock.setblocking(False)
+            if self.server and self.mode == SocketMode.TCP:
+                self.loop.register(self._sock, lambda _: self._on_accept())
+            elif self.mode == SocketMode.TCP:
+                self._framers[self._sock] = PacketFramer(self._sock)
+                self.loop.register(
+                    self._sock,
+                    lambda mask: self._on_stream(self._sock, None, mask)
+                )
+            else:
+                self.loop.register(self._sock, lambda _: self._on_datagram())
+            return
+
         if self.server and self.mode == SocketMode.TCP:
             threading.Thread(
                 target=self._acceptor_loop,
@@ -198,16 +340,16 @@ class SocketController:
         """
         while True:
             conn, addr = self.accept()
+            # The handshake must be in place before anything can arrive
+            if not self.handshakes.admit(conn, addr):
+                self.log.info(f'Refused handshake with {addr}')
+                conn.close()
+                continue
             threading.Thread(
                 target=self._handler_loop,
                 args=(conn, addr),
                 daemon=True,
             ).start()
-            threading.Thread(
-                target=self.do_tcp_server_auth,
-                args=(conn, addr),
-                daemon=True,
-            ).start()
             self.clients.append((conn, addr))
             self.log.debug(f'Got client {addr}')
 
@@ -220,13 +362,17 @@ class SocketController:
         :param socket sock: The socket(5) instance being wrapped
         :param tuple addr: The bound address
         """
+        if self._batch is not None:
+            while True:
+                self.packets_hook(self._recv_batch(sock))
+
+        framer = PacketFramer(sock) if self.mode == SocketMode.TCP else None
         while True:
             try:
-                if self.mode == SocketMode.TCP:
-                    packet = Packet.from_pipe(sock)
+                if framer is not None:
+                    packet = next(framer)
                 else:
-                    pdata, addr = sock.recvfrom(4096)
-                    packet = Packet.from_bytes(pdata)
+                    packet, addr = self._recv_datagram(sock)
             except PacketError:
                 # TODO: Proper handling here
                 self.log.warning('Invalid packet encountered')
@@ -234,88 +380,354 @@ class SocketController:
             except ConnectionResetError:
                 self.tcp_lost(sock, addr)
                 return
+            except OSError:
+                if sock.fileno() == -1:
+                    # We closed the socket ourself
+                    return
+                raise
+
+            self._handle_packet(sock, addr, packet)
 
-            # Un-apply any encryption scheme on this connection
-            if self.client_id is None or self.use_special_encryption:
-                aes = self.km.get_aes(packet.client_id)
+    def _recv_datagram(self, sock: socket) -> Tuple[Packet, Address]:
+        """
+        Receive a single datagram into a pooled buffer, and parse it in place.
+        The buffer is returned to the pool by :func:`Packet.release`.
+
+        :param socket sock: The socket(5) to receive from
+        """
+        buffer = self._pool.acquire()
+        try:
+            nbytes, addr = sock.recvfrom_into(buffer)
+            packet = Packet.from_bytes(
+                memoryview(buffer)[:nbytes], (self._pool, buffer)
+            )
+        except Exception:
+            self._pool.release(buffer)
+            raise
+        return packet, addr
+
+    def _handle_packet(self, sock: socket, addr: Address,
+                       packet: Packet) -> None:
+        """
+        Decrypt a freshly received packet, then pass it on to whichever part
+        of the controller is waiting for it.
+
+        :param socket sock: The socket(5) the packet arrived on
+        :param tuple addr: The address of the sender
+        :param Packet packet: The packet received
+        """
+        if not self._decrypt(addr, packet):
+            return
+
+        # Push the packet to the appropriate queue
+        packet.source_addr = addr
+        packet.source_sock = sock
+
+        if self.auth_done or sock in self._auth_clients or self.mode == SocketMode.UDP:
+            self.packet_hook(sock, addr, packet)
+        elif sock in self.handshakes:
+            self.handshakes.feed(sock, packet)
+        else:
+            if self._hello is not None:
+                self._accept_hello(packet)
+            self._pa_queue.put((sock, addr, packet))
+
+    def _accept_hello(self, packet: Packet) -> None:
+        """
+        Complete the handshake with the server's reply to our HELLO, when it
+        accepted our X25519 key or resumption ticket. This is done as the
+        reply is received, rather than once the handshake gets to it, so the
+        keys are in place for whatever the server sends straight after.
+        Anything else is left to :func:`do_tcp_client_auth`.
+
+        :param Packet packet: The first packet from the server
+        """
+        key_pair, resuming = self._hello
+        self._hello = None
+
+        payload = packet.payload
+        if packet.opcode != ACK or not payload:
+            return
+        caps = payload[0] & self.CAPS
+
+        try:
+            if (resuming is not None and caps & CAP_RESUME
+                    and len(payload) == 1 + RESUME_RANDOM_SIZE + 32):
+                client_id, secret, client_random = resuming
+                server_random = bytes(payload[1:1 + RESUME_RANDOM_SIZE])
+                key, iv, confirm = derive_keys(
+                    secret, client_random + server_random)
+                if open_client_id(
+                        confirm, payload[1 + RESUME_RANDOM_SIZE:]) != client_id:
+                    raise ValueError('Resumed the wrong session')
+            elif (key_pair is not None and caps & CAP_X25519
+                    and len(payload) == 1 + 2 * X25519_KEY_SIZE):
+                private, public = key_pair
+                server_key = bytes(payload[1:1 + X25519_KEY_SIZE])
+                key, iv, confirm = x25519_exchange(
+                    private, server_key, public + server_key)
+                client_id = open_client_id(
+                    confirm, payload[1 + X25519_KEY_SIZE:])
             else:
-                aes = self.km.get_aes(self.client_id)
-            ppl = len(packet.payload)
-            if aes is not None:
+                return
+        except ValueError:
+            self.log.warning('Server failed to confirm the key exchange')
+            return
+
+        self.km.register(client_id, AES.new(key, AES.MODE_CBC, iv),
+                         AES.new(key, AES.MODE_CBC, iv), key, iv,
+                         self._sock, caps=caps)
+        self.client_id = client_id
+        self.auth_done = True
+
+    def _recv_batch(self, sock: socket) -> List[Tuple[socket, Address, Packet]]:
+        """
+        Receive a batch of datagrams with a single system call, then parse
+        and decrypt each of them.
+
+        :param socket sock: The socket(5) to receive from
+        """
+        batch = self._batch
+        batch.recv(sock)
+
+        items = []
+        for n in range(len(batch)):
+            data, addr = batch[n]
+            try:
+                packet = Packet.from_bytes(data, (batch, n))
+            except PacketError:
+                self.log.warning('Invalid packet encountered')
+                continue
+            if self._decrypt(addr, packet):
+                packet.source_addr = addr
+                packet.source_sock = sock
+                items.append((sock, addr, packet))
+        return items
+
+    def _decrypt(self, addr: Address, packet: Packet) -> bool:
+        """
+        Un-apply any encryption scheme on a packet in place, then detach it
+        from its receive buffer.
+
+        :param tuple addr: The address of the sender
+        :param Packet packet: The packet to decrypt
+        :returns: If the packet could be decrypted
+        """
+        if self.client_id is None or self.use_special_encryption:
+            cipher = self.km.get_cipher(packet.client_id)
+        else:
+            cipher = self.km.get_cipher(self.client_id)
+        ppl = len(packet.payload_view)
+        if packet.opcode == ROOM_AUDIO:
+            # Room audio is sealed with the room's key, not our own
+            try:
+                self._open_room_packet(packet)
+            except ValueError as e:
+                self.log.warning(f'Failed to open room audio: {e}')
+                packet.release()
+                return False
+        elif cipher is not None:
+            try:
+                if packet.sealed != cipher.aead:
+                    raise ValueError('Packet does not match the negotiated scheme')
+                packet.payload = cipher.decrypt(
+                    packet.payload_view, Packet.associated_data(
+                        packet.opcode, packet.sequence, packet.client_id
+                    ) if cipher.aead else b''
+                )
+            except ValueError as e:
+                self.log.error(f'Failed to decrypt AES: {e}')
+                packet.release()
+                return False
+        # Nothing past this point needs the receive buffer
+        packet.release()
+
+        self.log.debug('{0} bytes from {1} ({2} encrypted)'.format(len(packet.payload), addr, ppl))
+        return True
+
+    def _open_room_packet(self, packet: Packet) -> None:
+        """
+        Unwrap a ROOM_AUDIO packet in place, leaving the packet that was
+        sealed inside of it.
+
+        :param Packet packet: The packet to open
+        :raises ValueError: If the packet can not be opened
+        """
+        view = packet.payload_view
+        if len(view) < ROOM_HEADER.size:
+            raise ValueError('Room packet too short')
+        room, epoch, opcode = ROOM_HEADER.unpack_from(view)
+
+        cipher = self.km.get_room_cipher(room, epoch)
+        if cipher is None:
+            raise ValueError(f'No key for room {room} epoch {epoch}')
+
+        aad = Packet.associated_data(ROOM_AUDIO, packet.sequence, packet.client_id)
+        packet.payload = cipher.decrypt(
+            view[ROOM_HEADER.size:], aad + bytes(view[:ROOM_HEADER.size])
+        )
+        packet.opcode = opcode
+
+    def _on_accept(self) -> None:
+        """
+        Event loop callback for a listening socket. Accepts every pending
+        connection, and starts a handshake with each of them.
+        This function should not be called manually.
+        """
+        while True:
+            try:
+                conn, addr = self.accept()
+            except BlockingIOError:
+                return
+            if not self.handshakes.admit(conn, addr):
+                self.log.info(f'Refused handshake with {addr}')
+                conn.close()
+                continue
+            conn.setblocking(False)
+
+            self.clients.append((conn, addr))
+            self._framers[conn] = PacketFramer(conn)
+            self.loop.register(
+                conn,
+                lambda mask, conn=conn, addr=addr: self._on_stream(conn, addr, mask)
+            )
+            self.log.debug(f'Got client {addr}')
+
+    def _on_stream(self, sock: socket, addr: Address, mask: int) -> None:
+        """
+        Event loop callback for a connected TCP socket. Flushes any pending
+        outbound data, then reads and handles every complete packet.
+        This function should not be called manually.
+        """
+        if mask & EVENT_WRITE:
+            self._flush(sock)
+        if not mask & EVENT_READ:
+            return
+
+        framer = self._framers[sock]
+        try:
+            nbytes = framer.recv()
+        except BlockingIOError:
+            return
+        except OSError:
+            nbytes = 0
+        if not nbytes:
+            self.tcp_lost(sock, addr)
+            return
+
+        packets = framer.packets()
+        while True:
+            try:
+                packet = next(packets, None)
+            except PacketError:
+                self.log.warning('Invalid packet encountered')
+                packets = framer.packets()
+                continue
+            if packet is None:
+                return
+            self._handle_packet(sock, addr, packet)
+            # The handler may have dropped the connection
+            if sock not in self._framers:
+                return
+
+    def _on_datagram(self) -> None:
+        """
+        Event loop callback for a UDP socket. Reads and handles every
+        datagram waiting on the socket.
+        This function should not be called manually.
+        """
+        if self._batch is not None:
+            while True:
                 try:
-                    packet.payload = unpad(aes[1].decrypt(packet.payload), 16)
-                except ValueError as e:
-                    self.log.error(f'Failed to decrypt AES: {e}')
-                    continue
-
-            self.log.debug('{0} bytes from {1} ({2} encrypted)'.format(len(packet.payload), addr, ppl))
-
-            # Push the packet to the appropriate queue
-            packet.source_addr = addr
-            packet.source_sock = sock
-
-            if self.auth_done or sock in self._auth_clients or self.mode == SocketMode.UDP:
-                with self._queue_lock:
-                    self._queue.append((sock, addr, packet))
-                    self._queue_ready.set()
-                    while len(self._queue) > self.MAX_QUEUE:
-                        self.log.error('Queue to large!')
-                        self._queue.pop(0)
-            else:
-                with self._pa_queue_lock:
-                    self._pa_queue.append((sock, addr, packet))
-                    self._pa_queue_ready.set()
+                    items = self._recv_batch(self._sock)
+                except BlockingIOError:
+                    return
+                self.packets_hook(items)
+                if len(self._batch) < self._batch.count:
+                    # The socket has been drained
+                    return
+
+        while True:
+            try:
+                packet, addr = self._recv_datagram(self._sock)
+            except BlockingIOError:
+                return
+            except ConnectionResetError:
+                # Windows reports ICMP port unreachable this way
+                continue
+            except PacketError:
+                self.log.warning('Invalid packet encountered')
+                continue
+            self._handle_packet(self._sock, addr, packet)
+
+    def _write(self, sock: socket, data: bytes) -> int:
+        """
+        Write data to a TCP socket. When running on an event loop, anything
+        the socket will not immediately accept is buffered, and sent once the
+        socket becomes writable again.
+
+        :param socket sock: The socket(5) to write to
+        :param bytes data: The data to write
+        """
+        if self.loop is None:
+            return sock.send(data)
+
+        pending = self._out_buffers.get(sock)
+        if pending:
+            # Preserve ordering behind data that is already waiting
+            pending += data
+            return len(data)
+
+        try:
+            sent = sock.send(data)
+        except BlockingIOError:
+            sent = 0
+        if sent < len(data):
+            self._out_buffers[sock] = bytearray(data[sent:])
+            self.loop.modify(sock, EVENT_READ | EVENT_WRITE)
+        return len(data)
+
+    def _flush(self, sock: socket) -> None:
+        """
+        Send as much buffered outbound data as a socket will accept.
+
+        :param socket sock: The socket(5) to flush
+        """
+        pending = self._out_buffers.get(sock)
+        if pending:
+            try:
+                del pending[:sock.send(pending)]
+            except BlockingIOError:
+                return
+        if not pending:
+            self._out_buffers.pop(sock, None)
+            self.loop.modify(sock, EVENT_READ)
 
     def get_packet(self, blocking: bool=False, check: Optional[Callable]=None,
-                  in_auth: bool=False) -> Optional[Packet]:
-        """x
+                   in_auth: bool=False,
+                   timeout: Optional[float]=None) -> Optional[Packet]:
+        """
         Pop up to one packet from the queue.
 
         :param bool blocking: Whether the function should block for a matching
                               packet, or return if no packets are avaiable.
         :param func check: The custom check function used to match specific
-                           packets.
+                           packets. This requires scanning the queue.
         :param bool in_auth: If the packet should be requested from the auth
                              queue. If this is true, a seperate queue is used.
+        :param float timeout: The longest time to block for
         """
         # The queue for pre-auth sockets is different from post-auth
         queue = self._queue if not in_auth else self._pa_queue
-        q_ready = self._queue_ready if not in_auth else self._pa_queue_ready
-        q_lock = self._queue_lock if not in_auth else self._pa_queue_lock
+        return queue.get(blocking, check, timeout)
 
-        if blocking:
-            n = 0
-            while True:
-                # Wait for an item on the queue
-                q_ready.wait()
-                with q_lock:
-                    # If the packet fails the custom check...
-                    try:
-                        if check is not None and not check(queue[n]):
-                            # ...ignore it
-                            n += 1
-                            q_ready.clear()
-                            continue
-                    except IndexError:
-                        continue
-
-                    # Reset the queue_ready flag to the correct value
-                    if len(queue) == 1:
-                        q_ready.clear()
-                    else:
-                        q_ready.set()
-                    return queue.pop(n)
-
-        with q_lock:
-            if queue:
-                # Find the first item on the queue matching the check
-                for n, i in enumerate(queue):
-                    if check is None or check(i):
-                        if len(queue) == 1:
-                            # Queue is empty, unset the flag.
-                            q_ready.clear()
-                        return queue.pop(n)
-            return None
+    def queue_stats(self, in_auth: bool=False) -> dict:
+        """
+        Return the occupancy and drop counters of the packet queues.
+
+        :param bool in_auth: If the auth queue should be reported instead
+        """
+        return (self._queue if not in_auth else self._pa_queue).stats()
 
     def send_packet(self, opcode: int, payload: bytes,
                     sequence: Optional[int]=None,
@@ -334,30 +746,69 @@ class SocketController:
                                 encryption scheme.
         :param bytes origin: The client id of the sending party.
         """
+        packet = self.make_packet(opcode, payload, sequence, client_id, origin)
+        self.send(packet, to=to)
+
+    def make_packet(self, opcode: int, payload: bytes,
+                    sequence: Optional[int]=None,
+                    client_id: Optional[bytes]=None,
+                    origin: Optional[bytes]=None) -> bytes:
+        """
+        Construct and encrypt a packet without sending it, for use with
+        :func:`send_many`. The parameters are as for :func:`send_packet`.
+        """
         if sequence is None:
-            sequence = self.sequence
-            self.sequence += 1
-            self.sequence %= 0xff_ff
+            sequence = self._next_sequence()
         ts = int(time.time())
 
+        origin = self.client_id or origin
+
         # If we're using an encryption scheme for this connection, apply it
-        if self.client_id is not None:
-            payload = self.km.get_aes(self.client_id)[0].encrypt(pad(payload, 16))
-        elif client_id is not None:
-            aes = self.km.get_aes(client_id)[0]
-            payload = aes.encrypt(pad(payload, 16))
+        cipher = self.km.get_cipher(self.client_id or client_id)
+        sealed = cipher is not None and cipher.aead
+        if cipher is not None:
+            payload = cipher.encrypt(payload, Packet.associated_data(
+                opcode, sequence, origin
+            ) if sealed else b'')
 
-        origin = self.client_id or origin
+        return Packet.make_bytes(opcode, payload, ts, sequence, origin, sealed)
 
-        # Construct and send the packet
-        packet = Packet.make_bytes(opcode, payload, ts, self.sequence, origin)
-        self.send(packet, to=to)
+    def make_room_packet(self, cipher: RoomCipher, opcode: int,
+                         payload: bytes, origin: Optional[bytes]=None) -> bytes:
+        """
+        Construct a packet sealed with a room's media key, rather than the key
+        of any one client, so that a single copy can be sent to every member
+        of the room. It is unwrapped back into a packet of `opcode` on receipt.
 
-    def do_tcp_client_auth(self) -> bytes:
+        :param RoomCipher cipher: The media key of the room
+        :param int opcode: The opcode of the packet being sealed
+        :param bytes payload: The packet payload
+        :param bytes origin: The client id of the sending party.
+        """
+        sequence = self._next_sequence()
+        header = ROOM_HEADER.pack(cipher.room, cipher.epoch, opcode)
+        aad = Packet.associated_data(ROOM_AUDIO, sequence, origin) + header
+        payload = header + cipher.encrypt(payload, aad)
+
+        return Packet.make_bytes(ROOM_AUDIO, payload, int(time.time()),
+                                 sequence, origin, sealed=True)
+
+    def _next_sequence(self) -> int:
+        sequence = self.sequence
+        self.sequence += 1
+        self.sequence %= 0xff_ff
+        return sequence
+
+    def do_tcp_client_auth(self, ticket: Optional[Tuple[bytes, bytes, bytes]]=None
+                           ) -> bytes:
         """
         Perform the authentication handshake with a server.
         This function can only be used when in TCP mode, and when acting as a
         client.
+
+        :param tuple ticket: A resumption ticket issued in a previous session,
+                             as (client id, secret, ticket). If the server
+                             accepts it, that session is resumed.
         """
         if self.mode != SocketMode.TCP:
             self.log.error('!! REFUSING TO DO HANDSHAKE OUTSIDE OF TCP !!')
@@ -371,10 +822,35 @@ class SocketController:
                 self.close()
                 raise HandshakeFailed
 
-        # Request authentication
-        self.send_packet(HELLO, b'')
+        # Request authentication, offering our capabilities. Servers which
+        # predate capabilities ACK with an empty payload.
+        hello = bytes((self.CAPS,))
+        key_pair = resuming = None
+        if self.CAPS & CAP_X25519:
+            key_pair = x25519_key()
+            hello += key_pair[1]
+        if self.CAPS & CAP_RESUME and ticket is not None:
+            client_id, secret, ticket = ticket
+            client_random = Random.get_random_bytes(RESUME_RANDOM_SIZE)
+            resuming = client_id, secret, client_random
+            hello += client_random + ticket
+        self._hello = key_pair, resuming
+        self.send_packet(HELLO, hello)
         resp = self.get_packet(True, in_auth=True)
         assert_op(resp, ACK)
+        payload = resp[2].payload
+        caps = payload[0] & self.CAPS if payload else 0
+
+        if len(payload) > 1:
+            # The server took our key or ticket, and the ACK completed the
+            # handshake as it arrived
+            if not self.auth_done:
+                self.send_packet(ABRT, b'')
+                self.close()
+                raise HandshakeFailed
+
+            self.log.info('Client-server handshake complete')
+            return self.client_id
 
         # Send our public key
         self.send_packet(RSA_KEY, self.pub_key.exportKey('DER'))
@@ -393,12 +869,12 @@ class SocketController:
         aes = AES.new(key, AES.MODE_CBC, iv)
         aes2 = AES.new(key, AES.MODE_CBC, iv)
 
+        # self.aes = (aes, aes2)
+        self.km.register(nonce, aes, aes2, key, iv, self._sock, caps=caps)
+
         # Return the encrypted nonce
         self.send_packet(AES_CHECK, aes.encrypt(nonce))
 
-        # self.aes = (aes, aes2)
-        self.km.register(nonce, aes, aes2, key, iv, self._sock)
-
         resp = self.get_packet(True, in_auth=True)
         self.auth_done = True
         assert_op(resp, ACK)
@@ -408,71 +884,34 @@ class SocketController:
         self.client_id = nonce
         return nonce
 
-    def do_tcp_server_auth(self, sock: socket, addr: Address) -> None:
-        """
-        Perform the authentication handshake with a client.
-        This function can only be used when operating in TCP mode, and acting
-        as a server.
+    def _server_auth_done(self, sock: socket, addr: Address, client_id: bytes,
+                          aes: AES, aes2: AES, key: bytes, iv: bytes,
+                          caps: int=0, reply: Optional[bytes]=None) -> None:
         """
-        if self.mode != SocketMode.TCP:
-            self.log.error('!! REFUSING TO DO HANDSHAKE OUTSIDE OF TCP !!')
-            return
-
-        self.log.debug('Starting server-client authentication')
-
-        def check(packet):
-            return packet[0] == sock
-
-        def assert_op(packet, opcode):
-            if packet[2].opcode != opcode:
-                self.send_packet(ABRT, b'', to=sock)
-                sock.close()
-                raise HandshakeFailed
-
-        # Get initial HELLO
-        hello = self.get_packet(True, check=check, in_auth=True)
-        assert_op(hello, HELLO)
-        # ACK it
-        self.send_packet(ACK, b'', to=sock)
-
-        # Get the client's RSA key
-        key = self.get_packet(True, check=check, in_auth=True)
-        assert_op(key, RSA_KEY)
-        client_key = RSA.importKey(key[2].payload)
-
-        # Construct a new AES 256 cipher
-        key = Random.get_random_bytes(16)
-        iv = Random.new().read(AES.block_size)
-        aes = AES.new(key, AES.MODE_CBC, iv)
-        aes2 = AES.new(key, AES.MODE_CBC, iv)
-        client_id = KeyManager.generate_client_id(key, addr)
-
-        # Encrypt the AES parameters using RSA
-        cipher = PKCS1_v1_5.new(client_key)
-        resp = cipher.encrypt(key + client_id + iv)
-
-        # Send the params to the client
-        self.send_packet(AES_KEY, resp, to=sock)
-
-        # Get the nonce-based AES check
-        nonce_resp = self.get_packet(True, check=check, in_auth=True)
-        assert_op(nonce_resp, AES_CHECK)
-
-        nonce_resp = aes2.decrypt(nonce_resp[2].payload)
-        if nonce_resp != client_id:
-            self.send_packet(ABRT, b'', to=sock)
-            sock.close()
-            raise HandshakeFailed
+        Called by :class:`ServerHandshake` once a client has successfully
+        completed the handshake. Registers the client, then propagates the
+        event to the bound hooks and state managers.
 
+        :param bytes reply: The payload of the ACK to the client's HELLO, if
+                            the handshake completes with it. This is sent in
+                            the clear, in place of the final ACK.
+        """
         self.log.info('Server-client handshake complete')
 
         # Register the client
-        self.km.register(client_id, aes, aes2, key, iv, sock)
+        self.km.register(client_id, aes, aes2, key, iv, sock, caps=caps,
+                         server=True)
 
         self._auth_clients.append(sock)
 
         # Send the final ACK to finish the handshake
-        self.send_packet(ACK, b'', to=client_id)
+        if reply is None:
+            self.send_packet(ACK, b'', to=client_id)
+        else:
+            self.send_packet(ACK, reply, to=sock)
+        if caps & CAP_RESUME:
+            self.send_packet(TICKET, self.tickets.issue(client_id, key),
+                             to=sock, client_id=client_id)
 
         if self.state_manager is not None:
             self.state_manager.new_client(sock, addr, client_id)
@@ -482,6 +921,19 @@ class SocketController:
         if self.cont_state_manager is not None:
             self.cont_state_manager.new_cont_client(sock, addr, client_id)
 
+    @property
+    def key(self) -> RSA.RsaKey:
+        """
+        The RSA key pair used when handshaking as a client.
+        """
+        if self._key is None:
+            self._key = key_pool.take()
+        return self._key
+
+    @property
+    def pub_key(self) -> RSA.RsaKey:
+        return self.key.publickey()
+
     @property
     def mode(self) -> SocketMode:
         return self._mode
@@ -0,0 +1,74 @@
+import time
+from typing import Optional
+
+
+class ActiveSpeakers:
+    """
+    Tracks the loudest speakers of a room, so that only they need to be
+    forwarded.
+
+    Each speaker's loudness is smoothed over several frames, using the RMS
+    amplitude carried at the start of every AUDIO payload. A speaker only
+    displaces one of the current active speakers once they are `MARGIN`
+    times louder, so two speakers of similar volume do not flap between
+    being heard and not.
+    """
+    # The weight given to each new frame when smoothing loudness
+    SMOOTHING = 0.2
+    # How much louder a speaker must be to displace an active speaker
+    MARGIN = 1.5
+    # Speakers who send nothing for this long give up their place, and are
+    # forgotten
+    TIMEOUT = 0.5
+
+    def __init__(self, k: int) -> None:
+        """
+        :param int k: The number of speakers to forward
+        """
+        self.k = k
+        self.levels = {}
+        self.active = set()
+        self._last = {}
+        self._expired = 0
+
+    def _expire(self, now: float) -> None:
+        """
+        Forget every speaker who has fallen silent. This looks at every
+        speaker, so is only done a few times per timeout.
+        """
+        if now - self._expired < self.TIMEOUT / 4:
+            return
+        self._expired = now
+        for i in [i for i, t in self._last.items() if now - t > self.TIMEOUT]:
+            self.active.discard(i)
+            del self.levels[i]
+            del self._last[i]
+
+    def update(self, client_id: bytes, amp: int,
+               now: Optional[float]=None) -> bool:
+        """
+        Account for a frame of audio from a speaker.
+
+        :param bytes client_id: The speaker
+        :param int amp: The RMS amplitude of the frame
+        :returns: If the frame should be forwarded
+        """
+        now = time.monotonic() if now is None else now
+        level = self.levels.get(client_id, amp)
+        level += (amp - level) * self.SMOOTHING
+        self.levels[client_id] = level
+        self._last[client_id] = now
+        self._expire(now)
+
+        if client_id in self.active:
+            return True
+        if len(self.active) < self.k:
+            self.active.add(client_id)
+            return True
+
+        quietest = min(self.active, key=self.levels.__getitem__)
+        if level > self.levels[quietest] * self.MARGIN:
+            self.active.discard(quietest)
+            self.active.add(client_id)
+            return True
+        return False
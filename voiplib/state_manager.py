@@ -1,10 +1,14 @@
 import struct
+import threading
 import time
-from typing import Tuple, List
+from typing import Dict, FrozenSet, List, Optional, Tuple
 from socket import socket
 
+from Crypto import Random
+
 from .socket_controller import SocketController
 from .key_manager import KeyManager
+from .rooms import Rooms
 from .opcodes import *
 
 
@@ -37,21 +41,62 @@ class StateManager:
         self._sock = sock
         self._sock.state_manager = self
 
-        self.rooms = []
+        self.rooms = Rooms()
+        # The current media key generation of each room
+        self.room_epochs = {}
+        # Rooms whose media key is to be rotated by the next call to
+        # flush_room_keys
+        self._rekey = set()
+        self._rekey_lock = threading.Lock()
+        # The designated speakers of each room, who are the only members
+        # heard while the room is a stage
+        self.speakers = {}
+        # Members of rooms on linked servers, and the link each is reached
+        # through. This is replaced, rather than modified, when it changes.
+        self.remote = {}
+        # The state of clients who left holding a resumption ticket, and
+        # when the ticket expires, in case they return
+        self.parked = {}
+        # Clients whose state was restored when they reconnected
+        self.resumed = set()
 
         self._cont_sock = cont_sock
         self._cont_sock.cont_state_manager = self
 
+    # Hooks
+    def rooms_hook(self) -> None:
+        """
+        Called whenever the membership of any room changes.
+        """
+        pass
+
+    def room_key_hook(self, room: int, epoch: Optional[int],
+                      key: Optional[bytes]) -> None:
+        """
+        Called whenever a room is issued a new media key. Both `epoch` and
+        `key` are `None` when the room's key is discarded.
+        """
+        pass
+
     def new_cont_client(self, _, __, client_id: bytes) -> None:
         """
         A hook bound to a socket controller, called when a new control surface
         connects.
         """
-        # Deal with race conditions
+        # Deal with race conditions. The event loop must never be blocked, so
+        # there the delay is scheduled instead.
+        if self._cont_sock.loop is not None:
+            self._cont_sock.loop.call_later(0.5, self._send_cont_state)
+            return
         time.sleep(0.5)
+        self._send_cont_state()
 
+    def _send_cont_state(self) -> None:
+        """
+        Inform the control surface of every currently connected client.
+        """
         for ci in self.gates:
-            r_data = bytearray([n for n in range(len(self.rooms)) if ci in self.rooms[n]])
+            r_data = bytearray(sorted(self.rooms.rooms_of(ci)))
             r_data.insert(0, len(r_data))
             name = bytearray([len(self.names[ci])])
             name += self.names[ci].encode('latin-1')
@@ -67,18 +112,34 @@ class StateManager:
         """
         A hook bound to a socket controller, called when a new client connects.
         """
-        if client_id not in self.gates:
+        if self.km.get_caps(client_id) & CAP_TRUNK:
+            # Linked servers are never members of a room themselves
+            return
+
+        parked = self.parked.pop(client_id, None)
+        if parked is not None and parked[0] > time.time():
+            # They left recently, so pick up where they left off
+            _, gate, comp, name, rooms = parked
+            self.gates[client_id] = gate
+            self.compressors[client_id] = comp
+            self.names[client_id] = name
+            for n in rooms:
+                self.rooms.join(client_id, n)
+            self.resumed.add(client_id)
+        elif client_id in self.gates:
+            # They reconnected before we noticed them leave
+            self.resumed.add(client_id)
+        else:
             self.gates[client_id] = self.DEFAULT_GATE
             self.compressors[client_id] = self.DEFAULT_COMP
             self.names[client_id] = self.DEFAULT_NAME
 
-        if len(self.rooms) == 0:
-            self.rooms.append([])
-        for i in self.rooms:
-            if client_id in i:
-                break
-        else:
-            self.rooms[0].append(client_id)
+        if not self.rooms.rooms_of(client_id):
+            self.rooms.join(client_id, 0)
+        self.rooms_hook()
+        # A new connection holds no room keys yet
+        for n in self.rooms.rooms_of(client_id):
+            self.joined(n, client_id)
 
         sock = self.km.sock_from_id(client_id)
         if sock is not None:
@@ -95,7 +156,7 @@ class StateManager:
                 client_id=client_id
             )
 
-        r_data = bytearray([n for n in range(len(self.rooms)) if client_id in self.rooms[n]])
+        r_data = bytearray(sorted(self.rooms.rooms_of(client_id)))
         r_data.insert(0, len(r_data))
         name = bytearray([len(self.names[client_id])])
         name += self.names[client_id].encode('latin-1')
@@ -111,15 +172,144 @@ class StateManager:
         """
         Set the rooming state for a given client.
         """
-        for i in rooms:
-            while i >= len(self.rooms):
-                self.rooms.append([])
+        if rooms:
+            self.rooms.grow(max(rooms) + 1)
 
-        for n, i in enumerate(self.rooms):
-            if client_id in i and n not in rooms:
-                i.remove(client_id)
-            elif client_id not in i and n in rooms:
-                i.append(client_id)
+        for n in range(len(self.rooms)):
+            if n in rooms:
+                if self.rooms.join(client_id, n):
+                    self.joined(n, client_id)
+            elif self.rooms.leave(client_id, n):
+                self.rotate_room_key_later(n)
+        self.rooms_hook()
+
+    def set_room_mode(self, room: int, mode: int) -> None:
+        """
+        Make a room a stage, or stop it being one. Other modes are handled
+        by the router alone.
+        """
+        if mode == ROOM_STAGE:
+            self.rooms.set_stage(room, self.speakers.get(room, ()))
+        elif self.rooms.stage(room) is not None:
+            self.rooms.set_stage(room, None)
+        else:
+            return
+        self.rooms_hook()
+
+    def set_speakers(self, room: int, speakers: List[bytes]) -> None:
+        """
+        Set the designated speakers of a room. They need not be members, and
+        only take effect while the room is a stage.
+        """
+        self.speakers[room] = frozenset(speakers)
+        if self.rooms.stage(room) is not None:
+            self.rooms.set_stage(room, self.speakers[room])
+            self.rooms_hook()
+
+    def joined(self, room: int, client_id: bytes) -> None:
+        """
+        Issue keys for a client who has joined a room.
+
+        Rotating a room's key sends it to every member, so on a stage the
+        audience are instead sent the current key. Otherwise an audience of
+        thousands arriving would cost millions of ROOM_KEY packets. Anyone
+        leaving still rotates the key.
+        """
+        stage = self.rooms.stage(room)
+        cipher = self.km.get_room_cipher(room)
+        if stage is None or client_id in stage or cipher is None:
+            self.rotate_room_key_later(room)
+            return
+
+        sock = self.km.sock_from_id(client_id)
+        if sock is not None and self.km.get_caps(client_id) & CAP_ROOM_KEYS:
+            payload = struct.pack('!BH', room, cipher.epoch) + cipher.key
+            self._sock.send_packet(ROOM_KEY, payload, to=sock,
+                                   client_id=client_id)
+
+    def local_rooms(self) -> Dict[bytes, FrozenSet[int]]:
+        """
+        The rooms of every client connected to this server, as opposed to a
+        linked server.
+        """
+        return {ci: self.rooms.rooms_of(ci) for ci in list(self.gates)}
+
+    def set_remote_rooms(self, link_id: bytes,
+                         members: Dict[bytes, List[int]]) -> None:
+        """
+        Set the rooming state of every client of a linked server. Clients the
+        server no longer reports are removed from every room.
+
+        Remote members can not hold this server's room keys, so the keys are
+        left as they are.
+
+        :param bytes link_id: The link to the server
+        :param dict members: The rooms of each of the server's clients
+        """
+        remote = {i: l for i, l in self.remote.items() if l != link_id}
+        for client_id in self.remote:
+            if self.remote[client_id] == link_id and client_id not in members:
+                self.rooms.leave_all(client_id)
+
+        for client_id, rooms in members.items():
+            if client_id in self.gates or client_id in remote:
+                # Never let one server speak for another's clients
+                continue
+            remote[client_id] = link_id
+            for n in self.rooms.rooms_of(client_id) - set(rooms):
+                self.rooms.leave(client_id, n)
+            for n in rooms:
+                self.rooms.join(client_id, n)
+
+        self.remote = remote
+        self.rooms_hook()
+
+    def rotate_room_key_later(self, room: int) -> None:
+        """
+        Note that a room's media key must be rotated. Rather than being
+        rotated straight away, it is rotated by :func:`flush_room_keys`, so a
+        crowd joining or leaving the room costs only a single rotation.
+        """
+        with self._rekey_lock:
+            self._rekey.add(room)
+
+    def flush_room_keys(self) -> None:
+        """
+        Rotate the media key of every room noted by
+        :func:`rotate_room_key_later`. This should be called once per frame.
+        """
+        if not self._rekey:
+            return
+        with self._rekey_lock:
+            rooms, self._rekey = self._rekey, set()
+        for n in sorted(rooms):
+            self.rotate_room_key(n)
+
+    def rotate_room_key(self, room: int) -> None:
+        """
+        Issue a new media key for a room, and send it to every member able to
+        use one. This must happen whenever the membership of the room
+        changes, so that past members can not listen in, and new members can
+        not decrypt audio from before they joined.
+        """
+        members = [i for i in self.rooms[room]
+                   if self.km.get_caps(i) & CAP_ROOM_KEYS]
+        if not members:
+            self.km.forget_room(room)
+            self.room_key_hook(room, None, None)
+            return
+
+        epoch = (self.room_epochs.get(room, -1) + 1) % 0x1_00_00
+        self.room_epochs[room] = epoch
+        key = Random.get_random_bytes(16)
+        self.km.set_room_key(room, epoch, key, server=True)
+        self.room_key_hook(room, epoch, key)
+
+        payload = struct.pack('!BH', room, epoch) + key
+        for i in members:
+            sock = self.km.sock_from_id(i)
+            if sock is not None:
+                self._sock.send_packet(ROOM_KEY, payload, to=sock, client_id=i)
 
     def set_name(self, client_id: bytes, name: str) -> None:
         """
@@ -148,12 +338,25 @@ class StateManager:
         client_id = self.km.id_from_sock(sock)
         if client_id is None:
             return
+        self.resumed.discard(client_id)
+
+        now = time.time()
+        for i in [i for i, p in self.parked.items() if p[0] <= now]:
+            del self.parked[i]
+        if self.km.get_caps(client_id) & CAP_RESUME and client_id in self.gates:
+            # Hold on to their state until their ticket expires
+            self.parked[client_id] = (
+                now + self._sock.tickets.lifetime, self.gates[client_id],
+                self.compressors[client_id], self.names[client_id],
+                self.rooms.rooms_of(client_id),
+            )
+
         if client_id in self.gates:
             del self.gates[client_id]
         if client_id in self.compressors:
             del self.compressors[client_id]
         if client_id in self.names:
             del self.names[client_id]
-        for i in self.rooms:
-            if client_id in i:
-                i.remove(client_id)
+        for n in self.rooms.leave_all(client_id):
+            self.rotate_room_key_later(n)
+        self.rooms_hook()
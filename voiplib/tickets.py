@@ -0,0 +1,87 @@
+import struct
+import threading
+import time
+from typing import Optional, Tuple
+
+from Crypto import Random
+from Crypto.Cipher import AES
+
+
+class TicketIssuer:
+    """
+    Issues the resumption tickets handed to clients after a handshake, and
+    redeems them when the clients reconnect.
+
+    A ticket holds the client's id and a secret from their session, sealed
+    under a key only this server knows, so the server keeps nothing per
+    ticket until it is redeemed. A reconnecting client presents the ticket
+    with their HELLO, and new session keys are derived from the secret,
+    skipping the key exchange. Each ticket may be redeemed once, and a fresh
+    one is issued after every handshake.
+
+    The sealing key lives only in memory, so tickets do not survive the
+    server restarting. Clients then fall back to a full handshake.
+    """
+    # Seconds a ticket remains valid for
+    LIFETIME = 600
+
+    _PLAIN = struct.Struct('!I16s16s')
+    _NONCE_SIZE = 12
+    _TAG_SIZE = 16
+    SIZE = _NONCE_SIZE + _PLAIN.size + _TAG_SIZE
+
+    def __init__(self, lifetime: int=LIFETIME) -> None:
+        """
+        :param int lifetime: Seconds a ticket remains valid for
+        """
+        self.lifetime = lifetime
+
+        self._key = Random.get_random_bytes(16)
+        # The nonces of redeemed tickets, and when each ticket expires
+        self._redeemed = {}
+        self._lock = threading.Lock()
+
+    def issue(self, client_id: bytes, secret: bytes) -> bytes:
+        """
+        Seal a new ticket.
+
+        :param bytes client_id: The client the ticket is for
+        :param bytes secret: The secret new session keys will be derived from
+        """
+        nonce = Random.get_random_bytes(self._NONCE_SIZE)
+        cipher = AES.new(self._key, AES.MODE_GCM, nonce=nonce)
+        expires = int(time.time()) + self.lifetime
+        sealed, tag = cipher.encrypt_and_digest(
+            self._PLAIN.pack(expires, client_id, secret))
+        return nonce + sealed + tag
+
+    def redeem(self, ticket: bytes) -> Optional[Tuple[bytes, bytes]]:
+        """
+        Open a ticket presented by a client, and prevent it being used again.
+
+        :param bytes ticket: The ticket
+        :returns: The client id and secret, or `None` if the ticket is
+                  invalid, expired or has already been redeemed
+        """
+        if len(ticket) != self.SIZE:
+            return None
+        nonce = bytes(ticket[:self._NONCE_SIZE])
+        cipher = AES.new(self._key, AES.MODE_GCM, nonce=nonce)
+        try:
+            plain = cipher.decrypt_and_verify(
+                ticket[self._NONCE_SIZE:-self._TAG_SIZE],
+                ticket[-self._TAG_SIZE:],
+            )
+        except ValueError:
+            return None
+        expires, client_id, secret = self._PLAIN.unpack(plain)
+
+        now = time.time()
+        with self._lock:
+            # Redeemed tickets need only be remembered until they expire
+            for i in [i for i, t in self._redeemed.items() if t < now]:
+                del self._redeemed[i]
+            if expires < now or nonce in self._redeemed:
+                return None
+            self._redeemed[nonce] = expires
+        return client_id, secret
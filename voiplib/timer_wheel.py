@@ -0,0 +1,123 @@
+import math
+import threading
+import time
+from typing import Hashable, List, Optional
+
+
+class TimerWheel:
+    """
+    Timers for a large number of keys, each of which has at most one timer.
+
+    Rather than a heap, which costs O(log n) for every timer set, timers are
+    kept in a hierarchy of wheels of slots. The innermost wheel has a slot
+    per tick, and each wheel out has a slot per turn of the wheel within it.
+    Setting or cancelling a timer is O(1), as is each tick. A timer set far
+    in the future sits in an outer wheel until that wheel's slot comes
+    round. It is then cascaded inwards, until it reaches the innermost wheel
+    and fires.
+
+    Timers fire on the first tick at or after they are due, so are up to a
+    tick late. Timers beyond the reach of the outermost wheel fire when it
+    runs out.
+    """
+    TICK = 0.25
+    SLOTS = 64
+    LEVELS = 3
+
+    def __init__(self, tick: float=TICK, slots: int=SLOTS,
+                 levels: int=LEVELS) -> None:
+        """
+        :param float tick: Seconds per tick of the innermost wheel
+        :param int slots: The slots in each wheel
+        :param int levels: The number of wheels. With the defaults, timers
+                           can be set up to 18 hours ahead.
+        """
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+
+        self._wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        # Where each key is held, and the tick it is due on
+        self._timers = {}
+        self._ticks = 0
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._timers
+
+    def schedule(self, key: Hashable, delay: float) -> None:
+        """
+        Set the timer of a key, replacing any timer it already has.
+
+        :param key: The key, which is returned by :func:`advance` once due
+        :param float delay: Seconds until the timer is due
+        """
+        with self._lock:
+            self._cancel(key)
+            self._place(key, self._ticks + max(1, math.ceil(delay / self.tick)))
+
+    def cancel(self, key: Hashable) -> None:
+        """
+        Cancel the timer of a key, if it has one.
+        """
+        with self._lock:
+            self._cancel(key)
+
+    def advance(self, now: Optional[float]=None) -> List[Hashable]:
+        """
+        Turn the wheels up to the present.
+
+        :param float now: The present, as from :func:`time.monotonic`
+        :returns: Every key whose timer is now due. Their timers are removed.
+        """
+        if now is None:
+            now = time.monotonic()
+        target = int((now - self._start) / self.tick)
+
+        due = []
+        with self._lock:
+            while self._ticks < target:
+                self._ticks += 1
+                self._cascade()
+                slot = self._wheels[0][self._ticks % self.slots]
+                for key in slot:
+                    del self._timers[key]
+                due.extend(slot)
+                slot.clear()
+        return due
+
+    def _cancel(self, key: Hashable) -> None:
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            self._wheels[timer[0]][timer[1]].discard(key)
+
+    def _place(self, key: Hashable, due: int) -> None:
+        # Timers out of reach wait in the last slot the outermost wheel can
+        # reach
+        due = min(due, self._ticks + self.slots ** self.levels - 1)
+        delta = due - self._ticks
+        level = 0
+        while delta >= self.slots ** (level + 1):
+            level += 1
+        slot = (due // self.slots ** level) % self.slots
+        self._wheels[level][slot].add(key)
+        self._timers[key] = (level, slot, due)
+
+    def _cascade(self) -> None:
+        """
+        Move the timers in each outer wheel's current slot inwards, whenever
+        the wheel within it completes a turn.
+        """
+        level = 1
+        while level < self.levels and not self._ticks % self.slots ** level:
+            slot = self._wheels[level][(self._ticks // self.slots ** level)
+                                       % self.slots]
+            timers = [(key, self._timers[key][2]) for key in slot]
+            slot.clear()
+            for key, due in timers:
+                self._place(key, due)
+            level += 1
@@ -0,0 +1,154 @@
+import threading
+import time
+from typing import Dict, Iterable, List
+
+from .handshake import HandshakeFailed
+from .key_manager import KeyManager
+from .socket_controller import SocketController
+from .util.packets import Packet
+from .opcodes import *
+from . import loggers
+
+
+def pack_rooms(members: Dict[bytes, Iterable[int]]) -> bytes:
+    """
+    Pack the rooms of a set of clients into a TRUNK_ROOMS payload.
+
+    :param dict members: The rooms each client is a member of
+    """
+    payload = bytearray()
+    for client_id, rooms in members.items():
+        rooms = bytes(sorted(rooms))
+        payload += client_id + bytes((len(rooms),)) + rooms
+    return bytes(payload)
+
+
+def unpack_rooms(payload: bytes) -> Dict[bytes, List[int]]:
+    """
+    The inverse of :func:`pack_rooms`.
+
+    :raises ValueError: If the payload is truncated
+    """
+    members = {}
+    offset = 0
+    while offset < len(payload):
+        if offset + 17 > len(payload):
+            raise ValueError('Truncated TRUNK_ROOMS entry')
+        client_id = bytes(payload[offset:offset + 16])
+        count = payload[offset + 16]
+        offset += 17
+        if offset + count > len(payload):
+            raise ValueError('Truncated TRUNK_ROOMS entry')
+        members[client_id] = list(payload[offset:offset + count])
+        offset += count
+    return members
+
+
+class TrunkLink:
+    """
+    The outgoing end of a trunk, linking this server to another so that rooms
+    can span both.
+
+    A trunk is an ordinary client connection, made with the usual handshake
+    while offering `CAP_TRUNK`. The peer then treats the connection as a
+    server rather than a client: it is never a member of any room, and is
+    instead told of, and sent the audio of, the members of rooms on the
+    peer's side. The connection is retried until the peer can be reached,
+    and again whenever it is lost.
+    """
+    # Seconds to wait between attempts to reach the peer
+    RETRY = 2
+
+    def __init__(self, host: str, port: int, km: KeyManager) -> None:
+        """
+        :param str host: The host of the peer
+        :param int port: The TCP port of the peer, which is also its UDP port
+        :param KeyManager km: The key manager of this server. The keys of the
+                              link are held there, so that trunk audio can be
+                              sent and received alongside that of clients.
+        """
+        self.log = loggers.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.host = host
+        self.port = port
+        self.km = km
+
+        self.sock = None
+        self.link_id = None
+        self._lost = threading.Event()
+
+    # Hooks
+    def up_hook(self, link_id: bytes) -> None:
+        """
+        Called once the link is established.
+        """
+        pass
+
+    def packet_hook(self, link_id: bytes, packet: Packet) -> None:
+        """
+        Called for every packet the peer sends over the link.
+        """
+        pass
+
+    def down_hook(self, link_id: bytes) -> None:
+        """
+        Called when an established link is lost.
+        """
+        pass
+
+    @property
+    def address(self) -> tuple:
+        return self.host, self.port
+
+    def start(self) -> None:
+        """
+        Begin maintaining the link. This spawns a thread, then returns.
+        """
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _connect(self) -> bytes:
+        """
+        Connect and authenticate to the peer.
+
+        :returns: The id of the link
+        """
+        self._lost.clear()
+        sock = SocketController(km=self.km)
+        sock.CAPS = SocketController.CAPS | CAP_TRUNK
+        sock.tcp_lost_hook = lambda *_: self._lost.set()
+        sock.packet_hook = lambda _, __, packet: self.packet_hook(
+            self.link_id, packet)
+        self.sock = sock
+        sock.connect(self.host, self.port)
+        sock.start()
+
+        link_id = sock.do_tcp_client_auth()
+        if not self.km.get_caps(link_id) & CAP_TRUNK:
+            # The peer took us for a client
+            self.km.forget(link_id)
+            sock.close()
+            raise HandshakeFailed('Peer does not support trunks')
+        return link_id
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.link_id = self._connect()
+            except (OSError, HandshakeFailed) as e:
+                self.log.debug(f'Failed to link to {self.address}: {e!r}')
+                self.sock.close()
+                time.sleep(self.RETRY)
+                continue
+
+            self.log.info(f'Linked to {self.address}')
+            self.up_hook(self.link_id)
+            self._lost.wait()
+
+            self.log.warning(f'Lost link to {self.address}')
+            self.down_hook(self.link_id)
+            time.sleep(self.RETRY)
+
+    def send_packet(self, opcode: int, payload: bytes) -> None:
+        """
+        Send a packet to the peer over the link.
+        """
+        self.sock.send_packet(opcode, payload)
@@ -0,0 +1,169 @@
+from typing import Iterator, Optional
+
+from .packets import Packet, PacketError
+
+
+class PacketFramer:
+    """
+    Split a stream, such as a TCP socket, into packets.
+
+    Data is received with `recv_into` directly into a growable buffer, and
+    every complete packet in the buffer is parsed per read. Compared to
+    reading each field of a packet seperately, this takes a single call for
+    any number of packets, rather than at least four per packet.
+
+    Packets are parsed in place, viewing the receive buffer rather than being
+    copied out of it, and the framer acts as the pool the buffer is returned
+    to by :func:`Packet.release`. Data viewed by a packet which has not been
+    released is never moved or overwritten.
+
+    When iterated, the framer blocks on the stream until the next packet is
+    available. Alternatively, :func:`recv` and :func:`packets` can be used
+    to read from a non-blocking stream.
+    """
+
+    # The space reserved for the header, client id, and CRC of a packet
+    OVERHEAD = Packet.PAYLOAD_START + Packet.CRC_LENGTH
+
+    def __init__(self, stream, size: int=65536) -> None:
+        """
+        :param stream: The stream to read from. This must support either
+                       `recv_into` or `readinto`.
+        :param int size: The initial size of the receive buffer
+        """
+        self._recv_into = getattr(
+            stream, 'recv_into', getattr(stream, 'readinto', None)
+        )
+        self._buffer = bytearray(size)
+        # Unparsed data lives between _start and _end
+        self._start = 0
+        self._end = 0
+        # Packets handed out which may still view the buffer
+        self._outstanding = 0
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    def _reserve(self, needed: int) -> None:
+        """
+        Make sure there is room for at least `needed` bytes after the
+        unparsed data, first by moving it to the front of the buffer, and
+        failing that by growing the buffer.
+        """
+        if len(self._buffer) - self._end >= needed:
+            return
+
+        pending = self._end - self._start
+        size = max(len(self._buffer), pending + needed)
+        if self._outstanding or size > len(self._buffer):
+            # Packets may still view the old buffer, so rather than moving
+            # data underneath them it is moved to a new buffer
+            buffer = bytearray(size)
+            buffer[:pending] = self._buffer[self._start:self._end]
+            self._buffer = buffer
+            self._outstanding = 0
+        else:
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+        self._start, self._end = 0, pending
+
+    def _rewind(self) -> None:
+        """
+        Start again at the front of the buffer, if nothing is left in it.
+        """
+        if self._start == self._end and not self._outstanding:
+            self._start = self._end = 0
+
+    def release(self, buffer: bytearray) -> None:
+        """
+        Called by :func:`Packet.release` once a packet no longer views the
+        buffer it was parsed from.
+        """
+        if buffer is self._buffer:
+            self._outstanding -= 1
+            self._rewind()
+
+    def _next_size(self) -> Optional[int]:
+        """
+        The total size of the next packet, if enough of it has arrived to
+        read the header.
+        """
+        if self._end - self._start < Packet.ID_START:
+            return None
+        length = Packet.HEADER.unpack_from(self._buffer, self._start)[2]
+        return self.OVERHEAD + length
+
+    def _wanted(self) -> int:
+        """
+        The number of bytes still needed to complete the next packet.
+        """
+        total = self._next_size() or self.OVERHEAD
+        return max(1, total - (self._end - self._start))
+
+    def recv(self) -> int:
+        """
+        Perform a single read from the stream.
+
+        :returns: The number of bytes read. Zero means the stream has ended.
+        :raises BlockingIOError: If the stream is non-blocking and empty
+        """
+        self._reserve(self._wanted())
+        with memoryview(self._buffer) as view:
+            nbytes = self._recv_into(view[self._end:])
+        self._end += nbytes or 0
+        return nbytes or 0
+
+    def feed(self, data: bytes) -> None:
+        """
+        Append data which was read from the stream by some other means.
+        """
+        self._reserve(len(data))
+        self._buffer[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def next_packet(self) -> Optional[Packet]:
+        """
+        Parse the next complete packet held in the buffer, if any.
+
+        :raises PacketError: If the next packet was corrupted. The packet is
+                             still consumed, so parsing can continue after.
+        """
+        total = self._next_size()
+        if total is None or self._end - self._start < total:
+            return None
+
+        data = memoryview(self._buffer)[self._start:self._start + total]
+        self._start += total
+        try:
+            packet = Packet.from_bytes(data, (self, self._buffer))
+        except PacketError:
+            self._rewind()
+            raise
+        self._outstanding += 1
+        return packet
+
+    def packets(self) -> Iterator[Packet]:
+        """
+        Yield every complete packet currently held in the buffer, without
+        reading from the stream.
+        """
+        while True:
+            packet = self.next_packet()
+            if packet is None:
+                return
+            yield packet
+
+    def __iter__(self) -> 'PacketFramer':
+        return self
+
+    def __next__(self) -> Packet:
+        """
+        Return the next packet, reading from the stream as required.
+
+        :raises ConnectionResetError: If the stream ends
+        """
+        while True:
+            packet = self.next_packet()
+            if packet is not None:
+                return packet
+            if not self.recv():
+                raise ConnectionResetError('Stream closed')
@@ -0,0 +1,261 @@
+from ctypes import (
+    POINTER, Structure, c_char, c_int, c_uint, c_size_t, c_ushort, c_void_p,
+    addressof, cast, get_errno, memmove, pointer, sizeof, string_at,
+)
+from socket import (
+    socket, gethostbyname, inet_ntop, inet_pton, AF_INET, AF_INET6,
+)
+from typing import List, Tuple
+import ctypes.util
+import errno
+import struct
+import sys
+import threading
+
+
+# recvmmsg(2) and sendmmsg(2) are Linux specific. Everywhere else,
+# `available` is False and callers are expected to fall back to one
+# recvfrom(2) or sendto(2) per datagram.
+libc = None
+if sys.platform.startswith('linux'):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.recvmmsg, libc.sendmmsg
+    except (OSError, AttributeError):
+        libc = None
+available = libc is not None
+
+# Block for the first datagram, then take whatever else is already waiting
+MSG_WAITFORONE = 0x10000
+
+
+class IOVec(Structure):
+    _fields_ = [
+        ('iov_base', c_void_p),
+        ('iov_len', c_size_t),
+    ]
+
+
+class MsgHdr(Structure):
+    _fields_ = [
+        ('msg_name', c_void_p),
+        ('msg_namelen', c_uint),
+        ('msg_iov', POINTER(IOVec)),
+        ('msg_iovlen', c_size_t),
+        ('msg_control', c_void_p),
+        ('msg_controllen', c_size_t),
+        ('msg_flags', c_int),
+    ]
+
+
+class MMsgHdr(Structure):
+    _fields_ = [
+        ('msg_hdr', MsgHdr),
+        ('msg_len', c_uint),
+    ]
+
+
+class SockaddrStorage(Structure):
+    _fields_ = [
+        ('family', c_ushort),
+        ('data', c_char * 126),
+    ]
+
+
+if available:
+    libc.recvmmsg.argtypes = (c_int, POINTER(MMsgHdr), c_uint, c_int, c_void_p)
+    libc.recvmmsg.restype = c_int
+    libc.sendmmsg.argtypes = (c_int, POINTER(MMsgHdr), c_uint, c_int)
+    libc.sendmmsg.restype = c_int
+
+
+def _sockaddr(addr: Tuple[str, int]) -> bytes:
+    """
+    Convert a (host, port) tuple into a raw sockaddr_in.
+    """
+    host, port = addr
+    try:
+        packed = inet_pton(AF_INET, host)
+    except OSError:
+        packed = inet_pton(AF_INET, gethostbyname(host))
+    return struct.pack('=H', AF_INET) + struct.pack('!H', port) + packed + bytes(8)
+
+
+def _address(storage: SockaddrStorage) -> tuple:
+    """
+    Convert a raw sockaddr into the (host, port) tuple Python uses.
+    """
+    raw = string_at(addressof(storage), 24)
+    port = int.from_bytes(raw[2:4], 'big')
+    if storage.family == AF_INET6:
+        return inet_ntop(AF_INET6, raw[8:24]), port
+    return inet_ntop(AF_INET, raw[4:8]), port
+
+
+class DatagramBatch:
+    """
+    A set of preallocated buffers which many datagrams can be received into
+    with a single recvmmsg(2) call.
+
+    The datagrams are exposed as memoryviews over the buffers, so they are
+    only valid until the next call to :func:`recv`. This class provides the
+    same `release` interface as :class:`BufferPool`, so packets parsed from a
+    batch can be detached from it with :func:`Packet.release`.
+    """
+
+    def __init__(self, count: int=32, size: int=4096) -> None:
+        """
+        :param int count: The largest number of datagrams read per call
+        :param int size: The largest datagram that will be received
+        """
+        self.count = count
+        self.size = size
+        self.received = 0
+
+        # One contiguous block is used to back every datagram
+        self._buffer = bytearray(count * size)
+        self._view = memoryview(self._buffer)
+        self._data = (c_char * len(self._buffer)).from_buffer(self._buffer)
+        self._names = (SockaddrStorage * count)()
+        self._iov = (IOVec * count)()
+        self._msgs = (MMsgHdr * count)()
+
+        base = addressof(self._data)
+        for i in range(count):
+            self._iov[i].iov_base = base + i * size
+            self._iov[i].iov_len = size
+
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = addressof(self._names[i])
+            hdr.msg_namelen = sizeof(SockaddrStorage)
+            hdr.msg_iov = pointer(self._iov[i])
+            hdr.msg_iovlen = 1
+
+    def recv(self, sock: socket) -> int:
+        """
+        Receive up to `count` datagrams from a socket. On a blocking socket
+        this waits for at least one datagram to arrive.
+
+        :param socket sock: The socket(5) to receive from
+        :returns: The number of datagrams received
+        :raises BlockingIOError: If the socket is non-blocking and empty
+        """
+        # The kernel overwrites the address lengths, so they need resetting
+        for i in range(self.received):
+            self._msgs[i].msg_hdr.msg_namelen = sizeof(SockaddrStorage)
+
+        res = libc.recvmmsg(sock.fileno(), self._msgs, self.count,
+                            MSG_WAITFORONE, None)
+        if res < 0:
+            err = get_errno()
+            if err == errno.EINTR:
+                # Interrupted by a signal before anything arrived
+                self.received = 0
+                return 0
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise BlockingIOError(err, 'No datagrams waiting')
+            raise OSError(err, errno.errorcode.get(err, 'recvmmsg failed'))
+
+        self.received = res
+        return res
+
+    def __len__(self) -> int:
+        return self.received
+
+    def __getitem__(self, n: int) -> tuple:
+        """
+        Return the n-th datagram of the last batch as a (data, addr) pair.
+        """
+        if not 0 <= n < self.received:
+            raise IndexError(n)
+        start = n * self.size
+        data = self._view[start:start + self._msgs[n].msg_len]
+        return data, _address(self._names[n])
+
+    def release(self, _) -> None:
+        # The buffers are reused wholesale on the next call to recv, so
+        # there is nothing to hand back.
+        pass
+
+
+class DatagramSender:
+    """
+    Send many datagrams, each to its own address, with a single sendmmsg(2)
+    call. The message headers are preallocated and reused between calls, so
+    only one thread may be sending at a time.
+    """
+
+    def __init__(self, count: int=64) -> None:
+        """
+        :param int count: The most datagrams sent per system call
+        """
+        self.count = count
+        # Converting addresses is comparatively slow, so they are cached
+        self._sockaddrs = {}
+        self._lock = threading.Lock()
+
+        self._names = (SockaddrStorage * count)()
+        self._iov = (IOVec * count)()
+        self._msgs = (MMsgHdr * count)()
+        for i in range(count):
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = addressof(self._names[i])
+            hdr.msg_iov = pointer(self._iov[i])
+            hdr.msg_iovlen = 1
+
+    def _sockaddr(self, addr: Tuple[str, int]) -> bytes:
+        raw = self._sockaddrs.get(addr)
+        if raw is None:
+            if len(self._sockaddrs) > 4096:
+                self._sockaddrs.clear()
+            raw = self._sockaddrs[addr] = _sockaddr(addr)
+        return raw
+
+    def send(self, sock: socket,
+             datagrams: List[Tuple[Tuple[str, int], bytes]]) -> int:
+        """
+        Send a list of datagrams.
+
+        :param socket sock: The socket(5) to send from
+        :param list datagrams: (address, data) pairs to send. The data may be
+                               any bytes-like object, though anything other
+                               than `bytes` is copied first.
+        :returns: The number of datagrams sent. Datagrams the kernel refuses
+                  are skipped, rather than failing the whole batch.
+        """
+        with self._lock:
+            return self._send(sock, datagrams)
+
+    def _send(self, sock: socket,
+              datagrams: List[Tuple[Tuple[str, int], bytes]]) -> int:
+        sent = 0
+        for start in range(0, len(datagrams), self.count):
+            chunk = datagrams[start:start + self.count]
+            # Copies which must outlive the system call
+            copies = []
+            for i, (addr, data) in enumerate(chunk):
+                if type(data) is not bytes:
+                    # Only bytes objects can be cast to a pointer
+                    data = bytes(data)
+                    copies.append(data)
+                raw = self._sockaddr(addr)
+                memmove(addressof(self._names[i]), raw, len(raw))
+                self._msgs[i].msg_hdr.msg_namelen = len(raw)
+                # The data is sent straight from the bytes object
+                self._iov[i].iov_base = cast(data, c_void_p)
+                self._iov[i].iov_len = len(data)
+
+            done = 0
+            while done < len(chunk):
+                msgs = cast(addressof(self._msgs) + done * sizeof(MMsgHdr),
+                            POINTER(MMsgHdr))
+                res = libc.sendmmsg(sock.fileno(), msgs, len(chunk) - done, 0)
+                if res < 0:
+                    if get_errno() == errno.EINTR:
+                        continue
+                    # Skip the datagram which failed, and carry on
+                    done += 1
+                    continue
+                done += res
+                sent += res
+        return sent
@@ -23,6 +23,7 @@ FUNCTIONS = {
         (c_int, c_int, c_int, POINTER(c_int)),
         POINTER(OpusEncoder_)),
     'opus_encoder_ctl': (None, c_int32),
+    'opus_decoder_ctl': (None, c_int32),
 
     'opus_decoder_create': (
         (c_int, c_int, POINTER(c_int)),
@@ -98,6 +99,8 @@ class OpusEncoder:
 
 
 class OpusDecoder:
+    CTL_RESET_STATE = 4028
+
     def __init__(self):
         err = c_int()
         self.decoder = opuslib.opus_decoder_create(
@@ -106,6 +109,9 @@ class OpusDecoder:
         if err.value < 0:
             raise OpusError(err)
 
+    def reset(self):
+        opuslib.opus_decoder_ctl(self.decoder, self.CTL_RESET_STATE)
+
     def decode(self, data, frame_size=None, fec=False):
         if frame_size is None:
             frames = opuslib.opus_packet_get_nb_frames(data, len(data))
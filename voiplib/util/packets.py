@@ -1,4 +1,6 @@
 import struct
+import threading
+from typing import Iterable, Iterator, Tuple
 
 from .._voiplib.crc import CRC
 from . import util
@@ -8,67 +10,242 @@ class PacketError(Exception):
     pass
 
 
+# Each frame in an AUDIO_BUNDLE payload is prefixed with the origin client id,
+# the sequence number, and the length of the frame
+BUNDLE_ENTRY = struct.Struct('!16sHH')
+# ROOM_AUDIO payloads start with the room, key epoch, and the opcode of the
+# packet sealed inside
+ROOM_HEADER = struct.Struct('!BHB')
+
+
+def pack_bundle(frames: Iterable[Tuple[bytes, int, bytes]]) -> bytes:
+    """
+    Pack several audio frames into a single AUDIO_BUNDLE payload.
+
+    :param frames: (origin, sequence, payload) triples to pack
+    """
+    parts = []
+    for origin, sequence, payload in frames:
+        parts.append(BUNDLE_ENTRY.pack(origin, sequence, len(payload)))
+        parts.append(payload)
+    return b''.join(parts)
+
+
+def unpack_bundle(payload: bytes) -> Iterator[Tuple[bytes, int, bytes]]:
+    """
+    Split an AUDIO_BUNDLE payload back into its frames.
+
+    :param bytes payload: The bundle to unpack
+    :returns: An iterator of (origin, sequence, payload) triples
+    :raises PacketError: If the bundle is truncated
+    """
+    offset = 0
+    while offset < len(payload):
+        if len(payload) - offset < BUNDLE_ENTRY.size:
+            raise PacketError('Truncated bundle')
+        origin, sequence, length = BUNDLE_ENTRY.unpack_from(payload, offset)
+        offset += BUNDLE_ENTRY.size
+        if len(payload) - offset < length:
+            raise PacketError('Truncated bundle')
+        yield origin, sequence, payload[offset:offset + length]
+        offset += length
+
+
+class BufferPool:
+    """
+    A pool of preallocated receive buffers, so that reading a datagram does
+    not need to allocate.
+    """
+
+    def __init__(self, size: int=4096, count: int=64) -> None:
+        """
+        :param int size: The size of each buffer
+        :param int count: The number of buffers to keep preallocated
+        """
+        self.size = size
+        self.count = count
+        self._free = [bytearray(size) for _ in range(count)]
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bytearray:
+        """
+        Take a buffer from the pool, allocating a new one if it is empty.
+        """
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return bytearray(self.size)
+
+    def release(self, buffer: bytearray) -> None:
+        """
+        Return a buffer to the pool. Nothing may hold a view on it any more.
+        """
+        with self._lock:
+            if len(self._free) < self.count:
+                self._free.append(buffer)
+
+
 class Packet:
+    __slots__ = (
+        'opcode', 'timestamp', 'sequence', '_payload', '_client_id',
+        '_buffer', 'source_addr', 'source_sock', 'sealed',
+    )
+
     EPOCH = 1563520000
 
+    HEADER = struct.Struct('!BIHH')
+    ID_LENGTH = 16
+    NULL_ID = b'\0' * ID_LENGTH
+    # The offsets of the client id and payload within a packet
+    ID_START = HEADER.size
+    PAYLOAD_START = ID_START + ID_LENGTH
+
     CRC_LENGTH = 2
     CRC16 = CRC(CRC_LENGTH * 8, 0x1337)
+    NULL_CRC = b'\0' * CRC_LENGTH
+
+    # Set on the opcode of packets with an AEAD sealed payload. The AEAD tag
+    # already authenticates these, so their CRC is neither set nor checked.
+    SEALED = 0x80
 
-    def __init__(self, opcode, payload, timestamp, sequence, client_id=None):
+    def __init__(self, opcode, payload, timestamp, sequence, client_id=None,
+                 sealed=False):
         self.opcode = opcode
-        self.payload = payload
         self.timestamp = timestamp
         self.sequence = sequence
-        if client_id is None:
-            client_id = b'\0' * 16
-        self.client_id = client_id
+        self.sealed = sealed
+        # Both of these may be memoryviews over a receive buffer, in which
+        # case they are only copied out to bytes when first accessed.
+        self._payload = payload
+        self._client_id = client_id if client_id is not None else self.NULL_ID
+        self._buffer = None
 
         self.source_addr = None
         self.source_sock = None
 
+    @property
+    def payload(self) -> bytes:
+        if isinstance(self._payload, memoryview):
+            self._payload = self._payload.tobytes()
+        return self._payload
+
+    @payload.setter
+    def payload(self, value):
+        self._payload = value
+
+    @property
+    def payload_view(self) -> memoryview:
+        """
+        The payload, without copying it out of the receive buffer.
+        """
+        return memoryview(self._payload)
+
+    @property
+    def client_id(self) -> bytes:
+        if isinstance(self._client_id, memoryview):
+            self._client_id = self._client_id.tobytes()
+        return self._client_id
+
+    @client_id.setter
+    def client_id(self, value):
+        self._client_id = value
+
+    def release(self) -> None:
+        """
+        Hand the receive buffer backing this packet back to its pool. Any
+        fields still viewing the buffer are copied out first, so the packet
+        remains valid afterwards.
+        """
+        if self._buffer is None:
+            return
+        # Copy out any fields still viewing the buffer
+        self._payload = self.payload
+        self._client_id = self.client_id
+        pool, buffer = self._buffer
+        self._buffer = None
+        pool.release(buffer)
+
+    @classmethod
+    def associated_data(cls, opcode, sequence, client_id=None):
+        """
+        The fields of a packet which are authenticated, but not encrypted,
+        when sealing its payload.
+        """
+        return b''.join((
+            bytes((opcode,)), sequence.to_bytes(2, 'big'),
+            client_id or cls.NULL_ID,
+        ))
+
     @classmethod
-    def make_bytes(cls, opcode, payload, timestamp, sequence, client_id=None):
+    def make_bytes(cls, opcode, payload, timestamp, sequence, client_id=None,
+                   sealed=False):
         if len(payload) > 0xff_ff:
             raise PacketError('Payload too long')
         if not (0 <= timestamp - cls.EPOCH <= 0xff_ff_ff_ff):
             raise PacketError('Invalid timestamp')
 
         if client_id is None:
-            client_id = b'\0' * 16
-
-        packet = struct.pack('!BIHH', opcode, timestamp - cls.EPOCH, len(payload), sequence)
-        packet += client_id
-        packet += payload
-        packet += cls.CRC16(packet)
-
-        return packet
+            client_id = cls.NULL_ID
+        if sealed:
+            opcode |= cls.SEALED
+
+        packet = b''.join((
+            cls.HEADER.pack(opcode, timestamp - cls.EPOCH, len(payload), sequence),
+            client_id,
+            payload,
+        ))
+        if sealed:
+            return packet + cls.NULL_CRC
+        return packet + cls.CRC16(packet)
 
     def digest(self):
-        return self.make_bytes(self.opcode, self.payload, self.timestamp, self.sequence, self.client_id)
+        return self.make_bytes(self.opcode, self.payload, self.timestamp,
+                               self.sequence, self.client_id, self.sealed)
 
     @classmethod
-    def from_bytes(cls, packet):
-        opcode, timestamp, _, sequence = struct.unpack('!BIHH', packet[:9])
+    def from_bytes(cls, packet, buffer=None, check_crc=True):
+        """
+        Parse a packet without copying it. The payload and client id are
+        left as views on `packet` until they are accessed.
+
+        :param packet: The raw packet, as any bytes-like object
+        :param tuple buffer: The (pool, buffer) pair `packet` was read into,
+                             if it should be returned on :func:`release`
+        :param bool check_crc: Whether to validate the CRC. It is never
+                               checked on sealed packets, as they are
+                               authenticated when they are decrypted.
+        """
+        view = memoryview(packet)
+        if len(view) < cls.PAYLOAD_START + cls.CRC_LENGTH:
+            raise PacketError('Packet too short')
+
+        opcode, timestamp, _, sequence = cls.HEADER.unpack_from(view)
         timestamp += cls.EPOCH
-        payload = packet[9:-cls.CRC_LENGTH]
-        client_id = payload[:16]
-        payload = payload[16:]
+        sealed = bool(opcode & cls.SEALED)
 
-        if cls.CRC16(packet[:-cls.CRC_LENGTH]) != packet[-cls.CRC_LENGTH:]:
-            raise PacketError('Invalid CRC on packet')
+        if check_crc and not sealed:
+            if cls.CRC16(view[:-cls.CRC_LENGTH]) != view[-cls.CRC_LENGTH:]:
+                raise PacketError('Invalid CRC on packet')
 
-        return cls(opcode, payload, timestamp, sequence, client_id)
+        pkt = cls(
+            opcode & ~cls.SEALED, view[cls.PAYLOAD_START:-cls.CRC_LENGTH],
+            timestamp, sequence, view[cls.ID_START:cls.PAYLOAD_START], sealed
+        )
+        pkt._buffer = buffer
+        return pkt
 
     @classmethod
     def from_pipe(cls, pipe):
         head = util.read(pipe, 9)
-        opcode, timestamp, length, sequence = struct.unpack('!BIHH', head)
+        opcode, timestamp, length, sequence = cls.HEADER.unpack(head)
         timestamp += cls.EPOCH
         client_id = util.read(pipe, 16)
         payload = util.read(pipe, length)
         crc = util.read(pipe, cls.CRC_LENGTH)
+        sealed = bool(opcode & cls.SEALED)
 
-        if cls.CRC16(head + client_id + payload) != crc:
+        if not sealed and cls.CRC16(head + client_id + payload) != crc:
             raise PacketError('Invalid CRC on packet')
 
-        return cls(opcode, payload, timestamp, sequence, client_id)
+        return cls(opcode & ~cls.SEALED, payload, timestamp, sequence,
+                   client_id, sealed)
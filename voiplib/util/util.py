@@ -4,8 +4,11 @@ def read(pipe, length: int) -> bytes:
     read. Required in cases such as sockets where a read operationg will not
     always return all of the required data, due to buffering.
     """
-    data = b''
+    data = bytearray()
     recv = getattr(pipe, 'recv', getattr(pipe, 'read', None))
     while len(data) < length:
-        data += recv(length - len(data))
-    return data
+        chunk = recv(length - len(data))
+        if not chunk:
+            raise ConnectionResetError('Stream closed')
+        data += chunk
+    return bytes(data)
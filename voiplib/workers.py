@@ -0,0 +1,150 @@
+import multiprocessing
+import threading
+from multiprocessing.connection import Connection
+from typing import Optional
+
+from .key_manager import KeyManager
+from .mixer import Mixer
+from .router import AudioRouter
+from .socket_controller import SocketController, SocketMode
+from . import loggers
+
+
+class Replicator:
+    """
+    Starts the worker processes of a multi-process server, then keeps each of
+    them up to date with the routing state held by the main process.
+
+    Every worker binds the UDP port with SO_REUSEPORT, so the kernel spreads
+    the clients between them by source address. As any client may need to
+    hear any other, each worker is sent the full routing state, rather than
+    only that of its own clients.
+    """
+
+    def __init__(self, count: int, port: int) -> None:
+        """
+        :param int count: The number of worker processes to start
+        :param int port: The UDP port to share with the workers
+        """
+        self.log = loggers.getLogger(__name__ + '.' + self.__class__.__name__)
+
+        # Spawning, rather than forking, keeps the server's threads and
+        # sockets out of the workers
+        ctx = multiprocessing.get_context('spawn')
+        self._conns = []
+        self._lock = threading.Lock()
+        for shard in range(1, count + 1):
+            conn, child = ctx.Pipe()
+            ctx.Process(
+                target=run_worker,
+                args=(child, shard, port),
+                daemon=True,
+            ).start()
+            self._conns.append(conn)
+        self.log.info(f'Started {count} worker processes')
+
+    def publish(self, op: str, *args) -> None:
+        """
+        Send a change in state to every worker.
+
+        :param str op: The name of the change, see :class:`Worker`
+        """
+        with self._lock:
+            for conn in self._conns:
+                try:
+                    conn.send((op, *args))
+                except OSError as e:
+                    self.log.error(f'Failed to replicate {op}: {e}')
+
+
+class Worker(AudioRouter):
+    """
+    A process which routes the audio of whichever clients the kernel assigns
+    to it, using routing state replicated from the main process.
+    """
+
+    def __init__(self, conn: Connection, shard: int, port: int) -> None:
+        """
+        :param Connection conn: The pipe state changes arrive on
+        :param int shard: The number of this worker, counting from one
+        :param int port: The UDP port shared with the main process
+        """
+        self.log = loggers.getLogger(__name__ + '.' + self.__class__.__name__)
+        super().__init__(KeyManager(shard))
+        self.mixer = Mixer(self.decode_cache, shard)
+
+        self.conn = conn
+        self.udp_recv = SocketController(SocketMode.UDP, km=self.km,
+                                         batched=True)
+        self.udp_recv.bind('', port, reuse_port=True)
+        self.udp_recv.start()
+
+    def apply(self, op: str, *args) -> None:
+        """
+        Apply a single change in state, sent by the main process.
+        """
+        getattr(self, 'on_' + op)(*args)
+
+    def on_register(self, client_id: bytes, key: bytes, iv: bytes,
+                    caps: int, server: bool=True) -> None:
+        # Links this server made to another are the client end of their
+        # handshake
+        self.km.register(client_id, None, None, key, iv, None, caps=caps,
+                         server=server)
+
+    def on_forget(self, client_id: bytes) -> None:
+        self.forget_listener(client_id)
+        self.km.forget(client_id)
+
+    def on_listener(self, client_id: bytes, addr, flags: int) -> None:
+        self.register_listener(client_id, addr, flags)
+
+    def on_room_changes(self, changes: list, remote: Optional[dict]) -> None:
+        self.rooms.apply(changes)
+        if remote is not None:
+            self.remote_members = remote
+        self.routes_changed()
+
+    def on_room_key(self, room: int, epoch: int, key: bytes) -> None:
+        if key is None:
+            self.km.forget_room(room)
+        else:
+            self.km.set_room_key(room, epoch, key, server=True)
+        self.routes_changed()
+
+    def on_room_mode(self, room: int, mode: int) -> None:
+        self.set_room_mode(room, mode)
+
+    def on_room_topk(self, room: int, k: int) -> None:
+        self.set_room_topk(room, k)
+
+    def on_record(self, client_id: bytes, start: bool) -> None:
+        if start:
+            self.recorder.start(client_id)
+        else:
+            self.recorder.stop(client_id)
+
+    def on_cont_udp_port(self, port: int) -> None:
+        self.cont_udp_port = port
+
+    def mainloop(self) -> None:
+        """
+        Route audio until the main process goes away.
+        """
+        threading.Thread(target=self.udp_mainloop, daemon=True).start()
+        threading.Thread(target=self.bundle_mainloop, daemon=True).start()
+
+        while True:
+            try:
+                self.apply(*self.conn.recv())
+            except EOFError:
+                # The main process has exited
+                return
+
+
+def run_worker(conn: Connection, shard: int, port: int) -> None:
+    """
+    The entry point of a worker process.
+    """
+    loggers.createFileLogger(__name__ + f'.{shard}')
+    Worker(conn, shard, port).mainloop()